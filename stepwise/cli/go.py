@@ -4,7 +4,8 @@ import sys
 import byoc
 from pathlib import Path
 from inform import fatal
-from stepwise import ProtocolIO, Printer, get_default_printer_name, format_protocol, print_protocol
+from stepwise import ProtocolIO, Printer, OutputPipeline, PrinterSink, QueueSink, file_sink
+from stepwise import get_default_printer_name, get_printer_names
 from stepwise.config import StepwiseCommand, StepwiseConfig
 from byoc import Key, DocoptConfig
 from operator import not_
@@ -14,12 +15,14 @@ class Go(StepwiseCommand):
 Make copies of a protocol before starting an experiment.
 
 Usage:
-    stepwise go [-fFP] [-o PATH] [-O SUFFIX] [-p NAME]
+    stepwise go [-fFP] [-o PATH] [-O SUFFIX] [-p NAME] [--queue]
 
 Options:
     -o --output PATH
         The name of the file where the protocol will be recorded.  By default, 
         this name will follow the pattern: `YYYYMMDD_all_protocol_names.txt`
+        If the name ends with `.ps` or `.pdf`, the protocol will be recorded as 
+        a PostScript or PDF document, laid out exactly as it would be printed.
 
     -O --output-suffix SUFFIX
         A string to add to the end of the default output file name (but before 
@@ -37,9 +40,19 @@ Options:
         Only write the protocol to a file and don't attempt to print it.
 
     -p --printer NAME       
-        Print to the specified printer.  The default is: ${app.printer_name}
-        You can get a list of the printer names recognized on your system by 
-        running `lpstat -p -d`.
+        Print to the specified printer.  By default, the printer given by the 
+        `go.printer` setting (see below) is used, or else the system default 
+        printer.
+        % if app.help_requested:
+        The printers recognized on your system are: ${app.printer_names}
+        % endif
+
+    --queue
+        Add the protocol to the print queue, rather than printing it right 
+        away.  Use `stepwise print-queue flush` to print every protocol in the 
+        queue as a single job.  This is more efficient when making many 
+        protocols at once, e.g. from a script.  Queued protocols are always 
+        rendered with the builtin renderer (see below).
 
 Configuration:
     The settings described below can be set in the following files:
@@ -51,7 +64,9 @@ Configuration:
     go.printer:
         The printer to use if `--printer` is not specified.  If this setting is 
         not specified either, the default is taken from `lpstat -d`.  You can 
-        set this default by running `lpoptions -d <printer name>`.
+        set this default by running `lpoptions -d <printer name>`.  The result 
+        of `lpstat` is cached for 10 minutes, or until the CUPS configuration 
+        changes.
 
     printer.<name>.page_height
     printer.<name>.page_width
@@ -60,10 +75,23 @@ Configuration:
         Setting that control how protocols will be formatted when using this 
         printer.
 
+    printer.<name>.renderer
+        How to convert protocols to postscript before sending them to the 
+        printer.  The 'builtin' renderer uses a simple monospace renderer 
+        included with stepwise.  The 'paps' renderer uses the external `paps` 
+        program, which may support more fonts and characters.  The default is 
+        'paps' if `paps_flags` is set for this printer, and 'builtin' 
+        otherwise.
+
+    printer.<name>.font_size
+    printer.<name>.paper
+        The font size (in points) and paper size (e.g. 'letter', 'a4') to use 
+        with the builtin renderer.
+
     printer.<name>.paps_flags
-        Flags to pass to `paps`, the program used to convert text to 
-        postscript.  These flags can control things like font, paper size, etc.  
-        Note that you may have to use homebrew to install paps on Mac.
+        Flags to pass to `paps`, if that renderer is selected.  These flags can 
+        control things like font, paper size, etc.  Note that you may have to 
+        use homebrew to install paps on Mac.
 
     printer.<name>.lpr_flags
         Flags to pass to `lpr`, the program used to send the print job to a 
@@ -94,13 +122,38 @@ Configuration:
             Key(DocoptConfig, '--force'),
             default=False,
     )
+    queue = byoc.param(
+            Key(DocoptConfig, '--queue'),
+            default=False,
+    )
     printer_name = byoc.param(
             Key(DocoptConfig, '--printer'),
             Key(StepwiseConfig, 'go.printer'),
-            default_factory=get_default_printer_name,
+            default=None,
     )
     config_paths = byoc.config_attr()
 
+    @property
+    def help_requested(self):
+        # The usage text is rendered every time this command runs, but the 
+        # printers are only worth looking up if the user will see them.
+        return bool({'-h', '--help'} & set(sys.argv[1:]))
+
+    @property
+    def printer_names(self):
+        default = get_default_printer_name()
+        names = [
+                f'{x} (default)' if x == default else x
+                for x in get_printer_names()
+        ]
+        return ', '.join(names) or 'none'
+
+    @property
+    def printer(self):
+        # If no printer is specified, `Printer` will look up the default 
+        # printer, but only if it ends up being needed.
+        return Printer(self.printer_name)
+
     def main(self):
         byoc.load(self)
 
@@ -110,7 +163,8 @@ Configuration:
         if not io.protocol:
             fatal("No protocol specified.")
 
-        printer = Printer(self.printer_name)
+        printer = self.printer
+        pipeline = OutputPipeline(io.protocol, printer)
 
         # Write the protocol to a file.
         if self.send_to_file:
@@ -120,10 +174,14 @@ Configuration:
                 print(f"Aborting; protocol NOT sent to printer.")
                 sys.exit(1)
                 
-            path.write_text(format_protocol(io.protocol, printer))
-            print(f"Protocol saved to '{path}'")
+            pipeline.add_sink(file_sink(path))
 
         # Send to protocol to the printer.
         if self.send_to_printer:
-            print_protocol(io.protocol, printer)
-            print(f"Protocol sent to '{printer.name}'")
+            pipeline.add_sink(QueueSink() if self.queue else PrinterSink())
+
+        # Format the protocol once, then write the file and submit the print 
+        # job at the same time.
+        for message in pipeline.run():
+            if message:
+                print(message)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import byoc
+import byoc, sys, csv, json
 from itertools import groupby
 from operator import not_
 from stepwise import StepwiseCommand, Library
@@ -10,7 +10,7 @@ class List(StepwiseCommand):
 List protocols known to stepwise.
 
 Usage:
-    stepwise ls [-d] [-p] [<protocol>]
+    stepwise ls [-d] [-p] [--json | --tsv] [<protocol>]
 
 Options:
     -d --dirs
@@ -19,6 +19,14 @@ Options:
 
     -p --paths
         Don't organize paths by directory.
+
+    --json
+        List protocols in a machine-readable format, with one JSON object per 
+        line.
+
+    --tsv
+        List protocols in a machine-readable format, with one tab-separated 
+        row per line (preceded by a header row).
 """
     __config__ = [
             byoc.DocoptConfig,
@@ -27,12 +35,20 @@ Options:
     protocol = byoc.param('<protocol>', default=None)
     dirs_only = byoc.param('--dirs', default=False)
     organize_by_dir = byoc.param('--paths', cast=not_, default=True)
+    json = byoc.param('--json', default=False)
+    tsv = byoc.param('--tsv', default=False)
 
     def main(self):
         byoc.load(self)
 
+        # Print each protocol as soon as it's found, rather than waiting for 
+        # every collection to be searched.
         library = Library()
-        entries = library.find_entries(self.protocol)
+        entries = library.iter_entries(self.protocol)
+
+        if self.json or self.tsv:
+            return self.write_records(entries)
+
         indent = '  ' if self.organize_by_dir else ''
 
         for collection, entry_group in groupby(entries, lambda x: x.collection):
@@ -47,3 +63,26 @@ Options:
             if self.organize_by_dir:
                 print()
 
+    def write_records(self, entries):
+        if self.dirs_only:
+            fields = ['collection']
+            records = (
+                    {'collection': collection.name}
+                    for collection, _ in groupby(entries, lambda x: x.collection)
+            )
+        else:
+            fields = ['collection', 'name']
+            records = (
+                    {'collection': x.collection.name, 'name': x.name}
+                    for x in entries
+            )
+
+        if self.json:
+            for record in records:
+                print(json.dumps(record))
+
+        else:
+            writer = csv.writer(sys.stdout, dialect='excel-tab', lineterminator='\n')
+            writer.writerow(fields)
+            for record in records:
+                writer.writerow(record.values())
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import sys, inspect
+import os, sys, inspect
 import byoc
 from stepwise import ProtocolIO, StepwiseError, read_merge_write_exit, __version__
 from stepwise.utils import load_plugins
@@ -99,6 +99,17 @@ Examples:
         except StepwiseError as err:
             err.terminate()
 
+        # Exit quietly if the output is piped into a command that stops 
+        # reading early, e.g. `head`.  Python flushes stdout again on exit, 
+        # so point it at /dev/null to keep that from failing too.  Exit 
+        # successfully, so pipelines using `set -o pipefail` don't fail just 
+        # because the reader stopped early.  Output written to a pager is 
+        # handled by `open_pager()`.
+        except BrokenPipeError:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            sys.exit(0)
+
     @property
     def command_briefs(self):
         """
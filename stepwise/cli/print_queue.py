@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import sys, byoc
+from stepwise import StepwiseCommand, tabulate
+from inform import plural
+
+class PrintQueue(StepwiseCommand):
+    """\
+Manage protocols waiting to be printed.
+
+Usage:
+    stepwise print-queue [ls]
+    stepwise print-queue flush [-r <n>]
+    stepwise print-queue clear
+
+Commands:
+    [ls]
+        List the jobs in the print queue.  This is the default command.
+
+    flush
+        Print every job in the queue.  All of the protocols and attachments 
+        queued for the same printer are combined into a single print job.  Jobs 
+        that print successfully are removed from the queue.  Jobs that fail 
+        remain in the queue, so they can be flushed again later.
+
+    clear
+        Remove every job from the queue without printing anything.
+
+Options:
+    -r --retries <n>        [default: 2]
+        The number of times to retry a print job that fails (e.g. because the 
+        printer is temporarily unreachable) before giving up.
+
+Protocols are added to the print queue by `stepwise go --queue`.
+"""
+    __config__ = [
+            byoc.DocoptConfig,
+    ]
+
+    ls = byoc.param(default=None)
+    flush = byoc.param(default=None)
+    clear = byoc.param(default=None)
+    retries = byoc.param('--retries', cast=int, default=2)
+
+    def main(self):
+        byoc.load(self)
+
+        # Defer importing the spooler until it's needed.
+        from stepwise.spool import PrintQueue
+
+        queue = PrintQueue()
+
+        if self.flush:
+            jobs = queue.flush(retries=self.retries)
+            if not jobs:
+                print("No protocols to print.")
+                return
+
+            for job in jobs:
+                print(f"{job.status}: {job.name} ({job.id}) → {job.printer or 'default printer'}")
+                if job.error:
+                    print(f"    {job.error}")
+
+            if any(job.status == 'failed' for job in jobs):
+                sys.exit(1)
+
+        elif self.clear:
+            jobs = queue.clear()
+            print(f"Removed {plural(jobs):# job/s} from the print queue.")
+
+        else:
+            jobs = queue.find_jobs()
+            if not jobs:
+                print("No protocols waiting to be printed.")
+                return
+
+            rows = [
+                    [
+                        job.id,
+                        job.name or '',
+                        job.printer or '',
+                        len(job.pages),
+                        len(job.attachments),
+                        job.status,
+                    ]
+                    for job in jobs
+            ]
+            header = ["Job", "Protocol", "Printer", "Pages", "Files", "Status"]
+            print(tabulate(rows, header, truncate='-x----', align='<<<>><'))
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
-import byoc
-from inform import fatal, parse_range
-from stepwise import StepwiseCommand, ProtocolIO, read_merge_write_exit
+import sys, byoc
+from datetime import timedelta
+from byoc import Key, DocoptConfig
+from inform import fatal, parse_range, plural
+from stepwise import StepwiseCommand, StepwiseConfig, ProtocolIO, UsageError, read_merge_write_exit
 
 def parse_id(id):
     if id is None:
@@ -26,19 +28,32 @@ def parse_categories(categories):
 def parse_dependencies(dependencies):
     return parse_range(dependencies) if dependencies else []
 
+def parse_days(days):
+    return None if days is None else timedelta(days=float(days))
+
 def protocol_from_stdin():
     io = ProtocolIO.from_stdin()
     if io.errors:
         fatal("protocol has errors, not stashing.")
     return io.protocol
 
+def get_highlight():
+    import os, sys
+
+    if sys.stdout.isatty() and os.environ.get('TERM') not in ('dumb', 'emacs'):
+        return '\033[1m', '\033[0m'
+    else:
+        return '[', ']'
+
 class Stash(StepwiseCommand):
     """\
 Save protocols for later use.
 
 Usage:
     stepwise stash [add] [-m <message>] [-c <categories>] [-d <ids>]
-    stepwise stash [ls] [-a] [-c <categories>] [-d <ids> | -D]
+    stepwise stash [ls] [-a] [-c <categories>] [-d <ids> | -D] [--json | --tsv]
+    stepwise stash ls (-t | -r | --blocked-by <id> | --blocking <id>) [-a] [--json | --tsv]
+    stepwise stash grep <query>... [-a] [-n <int>]
     stepwise stash edit [<id>] [-m <message>] [-c <categories>] [-d <ids>] [-x]
     stepwise stash peek [<id>]
     stepwise stash pop [<id>]
@@ -46,6 +61,8 @@ Usage:
     stepwise stash restore <ids>
     stepwise stash clear
     stepwise stash reset
+    stepwise stash export [-a] [-c <categories>] [--pickle]
+    stepwise stash import
 
 Commands:
     [add]
@@ -58,6 +75,16 @@ Commands:
         command if stdin is not connected to a pipe.  By default, every stashed 
         protocol that hasn't been completed will be included in the output.
 
+    grep <query>...
+        Search the text, commands, messages, and dates of the stashed 
+        protocols, and list the matching protocols (best matches first) along 
+        with an excerpt showing where each one matched.  Only incomplete 
+        protocols are searched, unless `-a` is specified.  The query can use 
+        the full SQLite FTS5 syntax, e.g. `AND`/`OR`/`NOT`, "quoted phrases", 
+        prefix* searches, and column filters like `message: gibson`.  If 
+        SQLite was built without FTS5, only the names and messages of the 
+        protocols are searched, for every word in the query.
+
     edit [<id>]
         Provide new annotations (e.g. message, categories, dependencies) for 
         the indicated protocol.  If stdin is connected to a pipe, it will be 
@@ -69,21 +96,39 @@ Commands:
 
     pop [<id>]
         Display the indicated protocol, then mark it as completed (i.e. stop 
-        showing it with `stash ls`).
+        showing it with `stash ls`).  If `stash.archive_after` is set (see 
+        below), protocols that were completed long enough ago are also moved 
+        to the archive.
 
     drop [<ids>]
-        Mark the indicated protocols as completed.
+        Mark the indicated protocols as completed, and archive any old 
+        protocols (like `pop`).
 
     restore <ids>
         Mark the indicated protocols as not completed.
 
     clear
-        Mark every stashed protocol as completed.
+        Mark every stashed protocol as completed, and archive any old protocols 
+        (like `pop`).
 
     reset
-        Permanently delete every completed protocol, and reset the ID numbers 
-        to count consecutively from 1.  Be careful before running this command; 
-        it is destructive and cannot be undone!
+        Permanently delete every completed protocol (including those that have 
+        been archived), and reset the ID numbers to count consecutively from 1.  
+        Be careful before running this command; it is destructive and cannot be 
+        undone!
+
+    export
+        Write stashed protocols to stdout, e.g. to back them up or to move them 
+        to another computer.  By default, every incomplete protocol is 
+        exported as newline-delimited JSON, with one protocol per line.  This 
+        format can be read by any version of stepwise.  Use `--pickle` for a 
+        faster format that can only be read by the same version of stepwise.
+
+    import
+        Read protocols written by the `export` command from stdin, and add 
+        them to the stash.  The protocols are given new ids (in the same order 
+        as the original ids) that don't conflict with any protocols that are 
+        already stashed.
 
 Arguments:
     <id>
@@ -121,8 +166,42 @@ Options:
         stash.
 
     -a --all
-        List all stashed protocols, complete and incomplete.  This can be 
-        useful if you want to refer back to an old protocol.
+        List all stashed protocols, complete and incomplete (including those 
+        that have been archived).  This can be useful if you want to refer back 
+        to an old protocol.
+
+    -t --tree
+        List every incomplete protocol, with the protocols that depend on each 
+        one indented beneath it.  Protocols with multiple dependencies will be 
+        listed more than once.
+
+    -r --ready
+        List every incomplete protocol, in an order such that each protocol 
+        comes after all of its dependencies.  The protocols at the top of the 
+        list can be started right away.
+
+    --blocked-by <id>
+        List every protocol that depends on the given protocol, either 
+        directly or indirectly.
+
+    --blocking <id>
+        List every protocol that the given protocol depends on, either 
+        directly or indirectly.
+
+    -n --limit <int>
+        When searching, show at most this many matches.
+
+    --json
+        List stashed protocols in a machine-readable format, with one JSON 
+        object per line.
+
+    --tsv
+        List stashed protocols in a machine-readable format, with one 
+        tab-separated row per line (preceded by a header row).
+
+    --pickle
+        Export protocols in the same binary format that stepwise commands use 
+        to communicate via pipes, with one pickled record per protocol.
 
     -x --explicit
         When editing a stashed protocol, indicate that any annotations that are 
@@ -130,17 +209,34 @@ Options:
         This differs from the default, where only values that are specified are 
         updated.
 
+Configuration:
+    The settings described below can be set in the following files:
+
+        % for p in app.config_paths:
+        ${p}
+        %endfor
+
+    stash.archive_after:
+        The number of days after which completed protocols are moved from the 
+        stash into a separate archive, which keeps the stash itself small and 
+        fast to query.  Archived protocols are still listed by `-a`, and can 
+        still be accessed by id (e.g. with `peek` or `restore`).  By default, 
+        protocols are never archived.  Set this to 0 to archive protocols as 
+        soon as they are completed.
+
 Note that stashed protocols are not meant to be stored indefinitely.  It is 
 possible (although hopefully unlikely) that upgrading either stepwise or 
 python could corrupt the stash.
 """
 
     __config__ = [
-            byoc.DocoptConfig,
+            DocoptConfig,
+            StepwiseConfig.setup(root_key='stash'),
     ]
 
     add = byoc.param(default=None)
     ls = byoc.param(default=None)
+    grep = byoc.param(default=None)
     edit = byoc.param(default=None)
     peek = byoc.param(default=None)
     pop = byoc.param(default=None)
@@ -148,6 +244,8 @@ python could corrupt the stash.
     restore = byoc.param(default=None)
     clear = byoc.param(default=None)
     reset = byoc.param(default=None)
+    export = byoc.param(default=None)
+    import_ = byoc.param('import', default=None)
 
     id = byoc.param(
             '<id>',
@@ -159,6 +257,16 @@ python could corrupt the stash.
             default=[],
             cast=parse_ids,
     )
+    query = byoc.param(
+            '<query>',
+            default=[],
+            cast=' '.join,
+    )
+    limit = byoc.param(
+            '--limit',
+            default=None,
+            cast=int,
+    )
     message = byoc.param(
             '--message',
             default=None,
@@ -175,7 +283,19 @@ python could corrupt the stash.
     )
     show_dependents = byoc.param('--show-dependents', default=False)
     show_all = byoc.param('--all', default=False)
+    tree = byoc.param('--tree', default=False)
+    ready = byoc.param('--ready', default=False)
+    blocked_by = byoc.param('--blocked-by', default=None, cast=parse_id)
+    blocking = byoc.param('--blocking', default=None, cast=parse_id)
     explicit = byoc.param('--explicit', default=False)
+    json = byoc.param('--json', default=False)
+    tsv = byoc.param('--tsv', default=False)
+    pickle = byoc.param('--pickle', default=False)
+    archive_after = byoc.param(
+            Key(StepwiseConfig, 'archive_after', cast=parse_days),
+            default=None,
+    )
+    config_paths = byoc.config_attr()
 
     def main(self):
         byoc.load(self)
@@ -183,7 +303,25 @@ python could corrupt the stash.
         # Defer importing `sqlalchemy`.
         from . import model
 
-        with model.open_db() as db:
+        # Without a subcommand, the protocol on stdin (if any) is added to the 
+        # stash.  Otherwise the stash is listed.  Read stdin before opening 
+        # the database, so that listing doesn't have to lock it.
+        subcommands = [
+                self.ls, self.grep, self.edit, self.peek, self.pop, self.drop,
+                self.restore, self.clear, self.reset, self.export, self.import_,
+        ]
+        protocol = None if any(subcommands) else protocol_from_stdin()
+        list_default = not any(subcommands) and not protocol
+
+        if list_default and self.add:
+            fatal("no protocol specified.")
+
+        read_only = (
+                self.ls or self.grep or self.peek or self.export or
+                list_default
+        )
+
+        with model.open_db(read_only=read_only) as db:
             if self.ls:
                 model.list_protocols(
                         db,
@@ -191,6 +329,19 @@ python could corrupt the stash.
                         dependencies=self.dependencies,
                         include_dependents=self.show_dependents,
                         include_complete=self.show_all,
+                        tree=self.tree,
+                        ready=self.ready,
+                        blocked_by=self.blocked_by,
+                        blocking=self.blocking,
+                        format=self.list_format,
+                )
+
+            elif self.grep:
+                model.grep_protocols(
+                        db, self.query,
+                        include_complete=self.show_all,
+                        limit=self.limit,
+                        highlight=get_highlight(),
                 )
 
             elif self.edit:
@@ -208,32 +359,52 @@ python could corrupt the stash.
                 self.show_protocol(row)
 
             elif self.pop:
-                row = model.pop_protocol(db, self.id)
+                row = model.pop_protocol(
+                        db, self.id,
+                        archive_after=self.archive_after,
+                )
                 self.show_protocol(row)
 
             elif self.drop:
-                model.drop_protocols(db, self.ids)
+                model.drop_protocols(
+                        db, self.ids,
+                        archive_after=self.archive_after,
+                )
 
             elif self.restore:
                 model.restore_protocols(db, self.ids)
 
             elif self.clear:
-                model.clear_protocols(db)
+                model.clear_protocols(
+                        db,
+                        archive_after=self.archive_after,
+                )
 
             elif self.reset:
                 model.reset_protocols(db)
 
-            else:
-                protocol = protocol_from_stdin()
+            elif self.export:
+                model.export_protocols(
+                        db,
+                        sys.stdout.buffer if self.pickle else sys.stdout,
+                        categories=self.categories,
+                        include_complete=self.show_all,
+                        format='pickle' if self.pickle else 'json',
+                )
+
+            elif self.import_:
+                n = model.import_protocols(db, sys.stdin.buffer)
+                print(f"Imported {plural(n):# protocol/s}.", file=sys.stderr)
 
+            else:
                 if not protocol:
-                    if self.add: fatal("no protocol specified.")
                     model.list_protocols(
                             db,
                             categories=self.categories,
                             dependencies=self.dependencies,
                             include_dependents=self.show_dependents,
                             include_complete=self.show_all,
+                            format=self.list_format,
                     )
                 else:
                     model.add_protocol(
@@ -243,6 +414,12 @@ python could corrupt the stash.
                             dependencies=self.dependencies,
                     )
 
+    @property
+    def list_format(self):
+        if self.json: return 'json'
+        if self.tsv: return 'tsv'
+        return 'table'
+
     def show_protocol(self, row):
         read_merge_write_exit(
                 row.io,
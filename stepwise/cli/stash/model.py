@@ -1,19 +1,70 @@
 #!/usr/bin/env python3
 
+import sys, csv, json, pickle, threading, atexit, zlib
+
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
+from hashlib import sha256
+from itertools import chain, islice
 from contextlib import contextmanager
+from io import BufferedReader, TextIOWrapper
+from more_itertools import peekable, chunked
 from inform import format_range
-from stepwise import ProtocolIO, UsageError, tabulate, config_dirs
+from stepwise import Protocol, ProtocolIO, UsageError, tabulate, iter_tabulate_stream, open_pager, config_dirs
 from . import pickler
 
-from sqlalchemy import func, Table, Column, ForeignKey, Integer, DateTime, String, Boolean, PickleType
-from sqlalchemy.orm import relationship, aliased
+from sqlalchemy import event, func, select, insert, update, delete, union_all, literal, literal_column, table, column, DDL, Table, Column, ForeignKey, Integer, DateTime, String, Boolean, LargeBinary
+from sqlalchemy.orm import relationship, aliased, selectinload, object_session
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+# When listing protocols, read this many rows from the database at a time.
+_LIST_BATCH_SIZE = 100
+
+# When listing more protocols than this, start printing the table before all 
+# the rows have been read.
+_LIST_SAMPLE_SIZE = 100
+
+_LIST_HEADER = "#", "Err", "Dep", "Name", "Category", "Message"
+
+# These columns are left out of the table when they would be empty.
+_LIST_OPTIONAL_COLS = "Err", "Dep", "Category"
+
+# Increment this whenever the schema changes, so that existing databases will 
+# be migrated when they're next opened.
+_SCHEMA_VERSION = 4
+
+# Settings for each connection to the database.  WAL mode allows commands that 
+# only read the stash to proceed while another command is writing to it.
+_SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,    # KiB
+        'mmap_size': 2**28,      # bytes
+}
+
+# How long to wait for another command to release the database, in seconds.
+_BUSY_TIMEOUT = 30
+
+# The relative importance of each column in the full-text index, when ranking 
+# search results.  See `search_protocols()`.
+_SEARCH_WEIGHTS = {
+        'slug': 5.0,
+        'message': 5.0,
+        'commands': 2.0,
+        'text': 1.0,
+        'date': 1.0,
+}
+
+# One engine per database file, see `_get_engine()`.
+_engines = {}
+_engines_lock = threading.Lock()
+
+# These columns are derived from the protocol, see `_summarize_pickle()`.
+_SUMMARY_COLS = 'slug', 'has_errors', 'num_steps', 'num_bytes', 'content_hash'
+
 stash_categories = Table(
         'stash_categories', Base.metadata,
         Column('stash_pk', Integer, ForeignKey('stash.pk')),
@@ -32,8 +83,19 @@ class Stash(Base):
     id = Column(Integer, index=True, unique=True)
     date_added = Column(DateTime, default=datetime.now)
     is_complete = Column(Boolean, default=False)
+    date_completed = Column(DateTime)
     message = Column(String)
-    protocol = Column(PickleType(pickler=pickler))
+
+    # The protocol itself is stored in the blobs table (see `Blob`), and is 
+    # only loaded when it's actually accessed, because unpickling it can be 
+    # expensive.  The summary columns below are filled in whenever the 
+    # protocol is set, so that the stash can be listed without loading any 
+    # protocols.
+    slug = Column(String)
+    has_errors = Column(Boolean, default=False)
+    num_steps = Column(Integer)
+    num_bytes = Column(Integer)
+    content_hash = Column(String)
 
     categories = relationship(
             'Category',
@@ -48,12 +110,93 @@ class Stash(Base):
             backref='downstream_deps',
     )
 
+    # Existing databases can't have foreign key constraints added to them, so 
+    # the relationship is specified explicitly.
+    blob = relationship(
+            'Blob',
+            primaryjoin='foreign(Stash.content_hash) == Blob.hash',
+    )
+
     def __repr__(self):
         return f"Stash(id={self.id!r})"
 
+    @property
+    def protocol(self):
+        return self.blob.protocol if self.blob else None
+
+    @protocol.setter
+    def protocol(self, protocol):
+        # The row must already belong to a session, so that an existing blob 
+        # with the same content can be found.
+        data = pickler.dumps(protocol, pickle.HIGHEST_PROTOCOL)
+        for attr, value in _summarize_pickle(data).items():
+            setattr(self, attr, value)
+
+        self.blob = _get_or_create_blob(object_session(self), data)
+
     @property
     def io(self):
-        return ProtocolIO(self.protocol, errors=isinstance(self.protocol, str))
+        protocol = self.protocol
+        return ProtocolIO(protocol, errors=isinstance(protocol, str))
+
+# Protocols that were completed a while ago are moved out of the stash table 
+# and into this one (see `archive_protocols()`), so that the queries for 
+# incomplete protocols don't have to wade through them.  The archived rows 
+# keep their primary keys, so their categories, dependencies, blobs, and 
+# search entries all stay where they are.
+stash_archive = Table(
+        'stash_archive', Base.metadata,
+        *(
+            Column(
+                x.name, x.type,
+                primary_key=x.primary_key,
+                index=x.index,
+                unique=x.unique,
+            )
+            for x in Stash.__table__.columns
+        ),
+)
+
+class Blob(Base):
+    """
+    A pickled protocol, identified by the SHA-256 hash of the pickle.
+
+    Identical protocols (which are common when protocols are stashed by 
+    scripts) are only stored once, no matter how many stash rows refer to 
+    them.  Blobs that are no longer referred to by any rows are deleted by 
+    `reset_protocols()`.  The pickle is compressed, unless doing so doesn't 
+    make it any smaller.
+    """
+    __tablename__ = 'blobs'
+
+    hash = Column(String, primary_key=True)
+    data = Column(LargeBinary)
+    compression = Column(String)
+
+    def __repr__(self):
+        return f"Blob(hash={self.hash!r})"
+
+    @classmethod
+    def from_pickle(cls, data, hash=None):
+        blob = cls(hash=hash or sha256(data).hexdigest())
+        compressed = zlib.compress(data)
+
+        if len(compressed) < len(data):
+            blob.data, blob.compression = compressed, 'zlib'
+        else:
+            blob.data, blob.compression = data, None
+
+        return blob
+
+    @property
+    def pickle(self):
+        if self.compression == 'zlib':
+            return zlib.decompress(self.data)
+        return self.data
+
+    @property
+    def protocol(self):
+        return pickler.loads(self.pickle)
 
 
 class Category(Base):
@@ -68,18 +211,42 @@ class Category(Base):
     def __repr__(self):
         return f"Category(name={self.name!r})"
 
+# A full-text index of the stashed protocols, for `search_protocols()`.  The 
+# rowid of each entry is the primary key of the corresponding stash row.  
+# Virtual tables can't be described by `Table`, so create it with raw DDL 
+# whenever the rest of the schema is created.  Not every build of SQLite 
+# includes FTS5, so the index is optional (see `_has_search_index()`).
+stash_fts = table('stash_fts', column('rowid'), *map(column, _SEARCH_WEIGHTS))
+
+event.listen(Base.metadata, 'after_create', DDL(f'''\
+CREATE VIRTUAL TABLE IF NOT EXISTS stash_fts USING fts5(
+    {', '.join(_SEARCH_WEIGHTS)},
+    tokenize = 'porter unicode61'
+)''').execute_if(callable_=lambda ddl, target, bind, **kw: _has_fts5(bind)))
+
 @contextmanager
-def open_db(path=None):
-    from sqlalchemy import create_engine
-    from sqlalchemy.orm import sessionmaker
+def open_db(path=None, *, read_only=False):
+    """
+    Open a session connected to the stash database.
+
+    Unless *read_only* is true, the session immediately acquires the write 
+    lock for the database.  This prevents commands running concurrently (e.g. 
+    from different terminals or scripts) from interleaving their reads and 
+    writes, which would otherwise be a source of "database is locked" errors.  
+    Other commands wait for the lock (up to `_BUSY_TIMEOUT` seconds) rather 
+    than failing right away.
+    """
+    from sqlalchemy.orm import Session
 
     if not path:
         path = Path(config_dirs.user_data_dir) / 'stash.sqlite'
         path.parent.mkdir(parents=True, exist_ok=True)
 
-    engine = create_engine(f'sqlite:///{path}', echo=False)
-    Base.metadata.create_all(engine)
-    session = sessionmaker(bind=engine)()
+    engine = _get_engine(path)
+    if not read_only:
+        engine = engine.execution_options(sqlite_begin='IMMEDIATE')
+
+    session = Session(bind=engine)
 
     try:
         yield session
@@ -93,56 +260,436 @@ def open_db(path=None):
     finally:
         session.close()
 
-def list_protocols(db, *, categories=None, dependencies=None, include_dependents=False, include_complete=False):
-    stash = find_protocols(
-            db,
-            categories=categories,
-            dependencies=dependencies,
-            include_dependents=include_dependents,
-            include_complete=include_complete,
+def _get_engine(path):
+    """
+    Return the engine for the given database, creating it (and the schema) if 
+    necessary.
+
+    Engines are cached, so that opening the same database repeatedly (e.g. 
+    from a script or a long-running process) reuses the same connection pool.  
+    The schema is only created or migrated if the `user_version` recorded in 
+    the database is older than `_SCHEMA_VERSION`.  The cached engines are 
+    disposed of when the interpreter exits (see `_dispose_engines()`).
+    """
+    key = str(Path(path).resolve())
+
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = _create_engine(path)
+        return _engines[key]
+
+@atexit.register
+def _dispose_engines():
+    """
+    Close every connection held by the cached engines.
+
+    This lets SQLite checkpoint the write-ahead log and remove its temporary 
+    files when the last connection closes, rather than leaving that to the 
+    garbage collector.
+    """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+def _create_engine(path):
+    from sqlalchemy import create_engine, event
+
+    engine = create_engine(
+            f'sqlite:///{path}',
+            echo=False,
+            connect_args={'timeout': _BUSY_TIMEOUT},
     )
-    if not stash:
-        if categories or dependencies:
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_conn, record):
+        # Stop pysqlite from beginning transactions itself, so that we can 
+        # begin them as we see fit (see below).
+        dbapi_conn.isolation_level = None
+
+        cursor = dbapi_conn.cursor()
+        for pragma, value in _SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(conn):
+        mode = conn.get_execution_options().get('sqlite_begin', '')
+        conn.exec_driver_sql(f'BEGIN {mode}')
+
+    # Only lock the database if the schema actually needs to be updated.
+    # Otherwise, opening the database could block on another process that
+    # holds the write lock while waiting for this one, e.g. `sw stash export |
+    # sw stash import`.
+    with engine.connect() as conn:
+        version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+        if version >= _SCHEMA_VERSION:
+            return engine
+
+    # Check the version again after locking the database, so that if several
+    # processes try to initialize it at once, only one will.
+    with engine.execution_options(sqlite_begin='IMMEDIATE').begin() as conn:
+        version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+        if version < _SCHEMA_VERSION:
+            _init_schema(conn)
+
+    return engine
+
+def _init_schema(conn):
+    Base.metadata.create_all(conn)
+    _add_missing_columns(conn)
+    _move_protocols_to_blobs(conn)
+    _add_missing_search_entries(conn)
+    conn.exec_driver_sql(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+
+def _has_fts5(conn):
+    """
+    Return true if SQLite was compiled with the FTS5 full-text search 
+    extension.
+    """
+    query = "SELECT sqlite_compileoption_used('ENABLE_FTS5')"
+    return bool(conn.exec_driver_sql(query).scalar())
+
+def _has_search_index(db):
+    """
+    Return true if the full-text index exists and can be used.
+
+    The answer is remembered for each connection, since it can't change once 
+    the schema has been created.
+    """
+    from sqlalchemy import inspect
+
+    conn = db.connection()
+    info = conn.info
+
+    if 'has_search_index' not in info:
+        info['has_search_index'] = (
+                _has_fts5(conn) and
+                inspect(conn).has_table('stash_fts')
+        )
+
+    return info['has_search_index']
+
+def _add_missing_columns(conn):
+    """
+    Update databases created by older versions of stepwise, which don't have 
+    all the columns that are now part of the stash table.
+
+    The summary columns of any existing rows are filled in by unpickling each 
+    protocol once.
+    """
+    from sqlalchemy import inspect, text, bindparam
+
+    table = Stash.__table__
+    existing_cols = {x['name'] for x in inspect(conn).get_columns('stash')}
+    missing_cols = [x for x in table.columns if x.name not in existing_cols]
+
+    if not missing_cols:
+        return
+
+    for col in missing_cols:
+        type = col.type.compile(conn.dialect)
+        conn.execute(text(f'ALTER TABLE stash ADD COLUMN {col.name} {type}'))
+
+    # Databases that already have the summary columns (but are missing some 
+    # newer column) may not even have a protocol column to summarize.
+    if 'content_hash' in existing_cols:
+        return
+
+    rows = conn.execute(
+            text('SELECT pk, protocol FROM stash WHERE content_hash IS NULL'),
+    ).all()
+
+    # Prefix the parameter names, because sqlalchemy reserves the column 
+    # names for itself.
+    update = table.update()\
+            .where(table.c.pk == bindparam('_pk'))\
+            .values({k: bindparam(f'_{k}') for k in _SUMMARY_COLS})
+    params = [
+            {
+                '_pk': pk,
+                **{f'_{k}': v for k, v in _summarize_pickle(data).items()},
+            }
+            for pk, data in rows
+    ]
+    if params:
+        conn.execute(update, params)
+
+def _move_protocols_to_blobs(conn):
+    """
+    Move the pickled protocols from the `protocol` column of the stash table 
+    (where older versions of stepwise stored them) into the blobs table.
+
+    The protocols are moved in batches, to avoid loading the whole stash into 
+    memory.  The old column is left in place (SQLite can't always drop 
+    columns), but emptied.
+    """
+    from sqlalchemy import inspect, text, bindparam
+
+    existing_cols = {x['name'] for x in inspect(conn).get_columns('stash')}
+    if 'protocol' not in existing_cols:
+        return
+
+    select_batch = text(f'''\
+SELECT pk, protocol FROM stash
+WHERE protocol IS NOT NULL
+LIMIT {_LIST_BATCH_SIZE}''')
+    insert_blob = insert(Blob).prefix_with('OR IGNORE')
+    update_stash = text('''\
+UPDATE stash SET content_hash = :hash, protocol = NULL
+WHERE pk = :pk''')
+
+    while rows := conn.execute(select_batch).all():
+        blobs = [Blob.from_pickle(data) for pk, data in rows]
+        conn.execute(insert_blob, [
+            dict(hash=x.hash, data=x.data, compression=x.compression)
+            for x in blobs
+        ])
+        conn.execute(update_stash, [
+            dict(pk=pk, hash=blob.hash)
+            for (pk, data), blob in zip(rows, blobs)
+        ])
+
+def _add_missing_search_entries(conn):
+    """
+    Add any protocols that aren't in the full-text index (e.g. because they 
+    were stashed by an older version of stepwise) to it.
+    """
+    from sqlalchemy.orm import Session
+
+    db = Session(bind=conn)
+    if not _has_search_index(db):
+        return
+
+    indexed_pks = select(stash_fts.c.rowid)
+    rows = db.query(Stash).filter(Stash.pk.not_in(indexed_pks))
+
+    for row in rows.yield_per(_LIST_BATCH_SIZE):
+        _index_protocol(db, row)
+
+    db.flush()
+
+def _get_or_create_blob(db, data):
+    hash = sha256(data).hexdigest()
+
+    with db.no_autoflush:
+        blob = db.get(Blob, hash)
+
+    if blob is None:
+        blob = Blob.from_pickle(data, hash)
+        db.add(blob)
+
+    return blob
+
+def _summarize_pickle(data):
+    """
+    Calculate the values of the summary columns for the given pickled 
+    protocol.
+
+    The protocol is unpickled (even if the caller already has the unpickled 
+    object) to make sure that it can actually be loaded later.
+    """
+    data = data or b''
+    protocol = pickler.loads(data)
+    errors = not isinstance(protocol, Protocol)
+
+    return dict(
+            slug=None if errors else protocol.pick_slug(),
+            has_errors=errors,
+            num_steps=None if errors else len(protocol.steps),
+            num_bytes=len(data),
+            content_hash=sha256(data).hexdigest(),
+    )
+
+def list_protocols(db, *, categories=None, dependencies=None, include_dependents=False, include_complete=False, tree=False, ready=False, blocked_by=None, blocking=None, format='table'):
+    """
+    Print the stashed protocols matching the given criteria.
+
+    The protocols are read from the database in batches and printed as they 
+    are read, so the first results appear promptly even if the stash is very 
+    large.  The *format* argument can be 'table' (for humans), or 'json' or 
+    'tsv' (for scripts).  The machine-readable formats have one line per 
+    protocol.
+
+    The *tree*, *ready*, *blocked_by*, and *blocking* arguments select 
+    different views of the dependency graph, and take precedence over the 
+    other criteria.  See `query_tree()`, `query_ready()`, 
+    `query_blocked_by()`, and `query_blocking()` for details.
+    """
+    if tree:
+        query = query_tree(db)
+    elif ready:
+        query = query_ready(db)
+    elif blocked_by is not None:
+        query = query_blocked_by(db, blocked_by, include_complete=include_complete)
+    elif blocking is not None:
+        query = query_blocking(db, blocking, include_complete=include_complete)
+    else:
+        query = query_protocols(
+                db,
+                categories=categories,
+                dependencies=dependencies,
+                include_dependents=include_dependents,
+                include_complete=include_complete,
+        )
+
+    entity = _query_entity(query)
+    unbatched_query = query
+    query = query.options(
+            selectinload(entity.upstream_deps),
+            selectinload(entity.categories),
+    ).yield_per(_LIST_BATCH_SIZE)
+
+    # Pair each row with its depth in the tree, so that all the views can be 
+    # printed the same way.
+    if tree:
+        stash = ((row, depth) for row, depth, path in query)
+    else:
+        stash = ((row, None) for row in query)
+
+    if format == 'json':
+        return _write_protocols_json(stash, sys.stdout)
+    if format == 'tsv':
+        return _write_protocols_tsv(stash, sys.stdout)
+
+    header = list(_LIST_HEADER)
+    truncate = list('---x-x')
+    align = list('>^><<<')
+
+    rows = (_make_list_row(row, depth or 0) for row, depth in stash)
+    sample = list(islice(rows, _LIST_SAMPLE_SIZE))
+    rest = peekable(rows)
+
+    if not sample:
+        filters = categories, dependencies, blocked_by, blocking
+        if any(x is not None and x != [] for x in filters):
             print("No matching protocols found.")
         else:
             print("No stashed protocols.")
         return
 
-    rows = []
-    header = ["#", "Err", "Dep", "Name", "Category", "Message"]
-    truncate = list('---x-x')
-    align = list('>^><<<')
+    # Leave out any optional columns that would be empty.  If every row has 
+    # already been read, this can be decided by just looking at them.  
+    # Otherwise, ask the database, so that the same columns are shown no 
+    # matter how many protocols there are.
+    if rest:
+        empty_cols = _find_empty_list_cols(db, unbatched_query)
+    else:
+        empty_cols = {
+                col for col in _LIST_OPTIONAL_COLS
+                if not any(x[header.index(col)] for x in sample)
+        }
 
-    for row in stash:
-        rows.append([
-            row.id,
-            '!' if row.io.errors else '',
-            format_range(
-                x.id
-                for x in row.upstream_deps
-                if not x.is_complete
-            ),
-            row.protocol.pick_slug() if not row.io.errors else '',
-            ','.join(x.name for x in sorted(row.categories, key=lambda x: x.pk)),
-            row.message or '',
-        ])
+    i_empty = {header.index(x) for x in empty_cols}
+
+    def remove_empty_cols(row):
+        return [x for i, x in enumerate(row) if i not in i_empty]
 
-    def remove_empty_col(col):
-        i = header.index(col)
-        if not any(x[i] for x in rows):
-            del header[i]
-            del truncate[i]
-            del align[i]
-            for row in rows:
-                del row[i]
+    header = remove_empty_cols(header)
+    truncate = remove_empty_cols(truncate)
+    align = remove_empty_cols(align)
+
+    # If there are too many protocols to format all at once, fix the column 
+    # widths using the first few rows (and the largest id number) and stream 
+    # the rest of the table into a pager.
+    if rest:
+        max_id = db.query(func.max(entity.id)).scalar()
+        lines = iter_tabulate_stream(
+                map(remove_empty_cols, chain(sample, rest)),
+                header,
+                truncate=truncate,
+                align=align,
+                min_widths=[len(str(max_id))] + [0] * (len(header) - 1),
+                sample_size=_LIST_SAMPLE_SIZE,
+        )
+        with open_pager() as pager:
+            for line in lines:
+                print(line, file=pager)
+        return
 
-    remove_empty_col("Err")
-    remove_empty_col("Dep")
-    remove_empty_col("Category")
+    sample = [remove_empty_cols(x) for x in sample]
+    print(tabulate(sample, header, truncate=truncate, align=align))
 
-    print(tabulate(rows, header, truncate=truncate, align=align))
+def _find_empty_list_cols(db, query):
+    """
+    Return the names of the optional columns in the `list_protocols()` table 
+    that would be empty for every row selected by the given query.
+    """
+    entity = _query_entity(query)
+    pks = query.with_entities(entity.pk).order_by(None)
+
+    # Archived protocols are always complete, so only the live table needs to 
+    # be searched for incomplete dependencies.
+    upstream = Stash.__table__.alias()
+    deps = stash_dependencies
+
+    queries = {
+            "Err": pks.filter(entity.has_errors == True),
+            "Dep": pks\
+                    .join(deps, deps.c.downstream_pk == entity.pk)\
+                    .join(upstream, upstream.c.pk == deps.c.upstream_pk)\
+                    .filter(upstream.c.is_complete == False),
+            "Category": pks\
+                    .join(stash_categories, stash_categories.c.stash_pk == entity.pk),
+    }
+    return {
+            col for col, q in queries.items()
+            if not db.query(q.exists()).scalar()
+    }
+
+def _make_list_row(row, indent=0):
+    return [
+        row.id,
+        '!' if row.has_errors else '',
+        format_range(_iter_incomplete_dep_ids(row)),
+        '  ' * indent + (row.slug or ''),
+        ','.join(_sorted_category_names(row)),
+        row.message or '',
+    ]
+
+def _write_protocols_json(stash, file):
+    for row, depth in stash:
+        record = {
+                'id': row.id,
+                'errors': bool(row.has_errors),
+                'dependencies': list(_iter_incomplete_dep_ids(row)),
+                'name': row.slug,
+                'categories': _sorted_category_names(row),
+                'message': row.message,
+        }
+        if depth is not None:
+            record['depth'] = depth
+
+        print(json.dumps(record), file=file)
+
+def _write_protocols_tsv(stash, file):
+    writer = csv.writer(file, dialect='excel-tab', lineterminator='\n')
+    writer.writerow(_LIST_HEADER)
+
+    for row, depth in stash:
+        writer.writerow(_make_list_row(row))
+
+def _iter_incomplete_dep_ids(row):
+    return (
+            x.id
+            for x in row.upstream_deps
+            if not x.is_complete
+    )
+
+def _sorted_category_names(row):
+    return [x.name for x in sorted(row.categories, key=lambda x: x.pk)]
 
 def find_protocols(db, *, categories=None, dependencies=None, include_dependents=False, include_complete=False):
+    return query_protocols(
+            db,
+            categories=categories,
+            dependencies=dependencies,
+            include_dependents=include_dependents,
+            include_complete=include_complete,
+    ).all()
+
+def query_protocols(db, *, categories=None, dependencies=None, include_dependents=False, include_complete=False):
+    Stash = _stash_entity(include_complete)
     query = db.query(Stash).order_by(Stash.id)
 
     if categories:
@@ -151,7 +698,9 @@ def find_protocols(db, *, categories=None, dependencies=None, include_dependents
                 .filter(Category.name.in_(categories))
 
     if dependencies:
-        Upstream = aliased(Stash)
+        # The dependencies may have been archived, even if the protocols that 
+        # depend on them haven't been.
+        Upstream = _stash_entity(include_complete=True)
         query = query\
                 .outerjoin(Stash.upstream_deps.of_type(Upstream))\
                 .filter(Upstream.id.in_(dependencies))
@@ -172,22 +721,569 @@ def find_protocols(db, *, categories=None, dependencies=None, include_dependents
     if not include_complete:
         query = query.filter(Stash.is_complete == False)
 
-    return query.all()
+    return query
+
+def query_blocked_by(db, id, *, include_complete=False):
+    """
+    Query every protocol that depends on the given protocol, either directly 
+    or indirectly.
+    """
+    row = get_protocol(db, id)
+    downstream = _select_transitive_deps([row.pk], upstream=False)
+    return _query_pks(db, downstream, include_complete)
+
+def query_blocking(db, id, *, include_complete=False):
+    """
+    Query every protocol that the given protocol depends on, either directly 
+    or indirectly.
+    """
+    row = get_protocol(db, id)
+    upstream = _select_transitive_deps([row.pk], upstream=True)
+    return _query_pks(db, upstream, include_complete)
+
+def query_ready(db):
+    """
+    Query every incomplete protocol, in an order such that each protocol comes 
+    after all of its dependencies.
+
+    The protocols that can be started right away come first.  Each protocol 
+    after that is ordered by the length of the longest chain of incomplete 
+    dependencies leading up to it, then by id.
+    """
+    stash = Stash.__table__
+    deps = stash_dependencies
+    child = stash.alias()
+
+    depths = select(stash.c.pk, literal(0).label('depth'))\
+            .where(_is_ready(stash))\
+            .cte('depths', recursive=True)
+
+    # Use UNION rather than UNION ALL, so that each (pk, depth) pair is only 
+    # visited once.  The depth limit guarantees that the recursion stops, even 
+    # if an old database has a cycle in it.
+    depths = depths.union(
+            select(deps.c.downstream_pk, depths.c.depth + 1)
+            .join(depths, deps.c.upstream_pk == depths.c.pk)
+            .join(child, child.c.pk == deps.c.downstream_pk)
+            .where(child.c.is_complete == False)
+            .where(depths.c.depth < _count_protocols(db))
+    )
+    max_depths = select(depths.c.pk, func.max(depths.c.depth).label('depth'))\
+            .group_by(depths.c.pk)\
+            .subquery()
+
+    return db.query(Stash)\
+            .join(max_depths, max_depths.c.pk == Stash.pk)\
+            .order_by(max_depths.c.depth, Stash.id)
+
+def query_tree(db):
+    """
+    Query every incomplete protocol, arranged as a tree.
+
+    The roots of the tree are the protocols that can be started right away.  
+    Each protocol is followed by the protocols that depend on it, so a 
+    protocol with several dependencies will appear several times.  The query 
+    yields `(row, depth, path)` tuples, where *depth* is the number of 
+    dependencies between *row* and its root, and *path* is a string that 
+    identifies its position in the tree.  The path also keeps the query from 
+    merging the rows for protocols that appear more than once.
+    """
+    stash = Stash.__table__
+    deps = stash_dependencies
+    child = stash.alias()
+
+    def path_part(table):
+        return func.printf('%010d', table.c.id, type_=String)
+
+    tree = select(
+                stash.c.pk,
+                literal(0).label('depth'),
+                path_part(stash).label('path'),
+            )\
+            .where(_is_ready(stash))\
+            .cte('tree', recursive=True)
+
+    tree = tree.union_all(
+            select(
+                deps.c.downstream_pk,
+                tree.c.depth + 1,
+                tree.c.path + '/' + path_part(child),
+            )
+            .join(tree, deps.c.upstream_pk == tree.c.pk)
+            .join(child, child.c.pk == deps.c.downstream_pk)
+            .where(child.c.is_complete == False)
+            .where(tree.c.depth < _count_protocols(db))
+    )
+
+    return db.query(Stash, tree.c.depth, tree.c.path)\
+            .join(tree, tree.c.pk == Stash.pk)\
+            .order_by(tree.c.path)
+
+def _select_transitive_deps(pks, *, upstream):
+    """
+    Select the primary keys of every protocol that the given protocols depend 
+    on (if *upstream*) or that depend on the given protocols (otherwise).
+    """
+    deps = stash_dependencies
+    src, dest = deps.c.downstream_pk, deps.c.upstream_pk
+    if not upstream:
+        src, dest = dest, src
+
+    found = select(dest.label('pk'))\
+            .where(src.in_(pks))\
+            .cte('found', recursive=True)
+
+    # UNION (rather than UNION ALL) discards rows that have already been 
+    # found, so the recursion terminates even if there's a cycle.
+    return found.union(
+            select(dest).join(found, src == found.c.pk)
+    )
+
+def _query_pks(db, pks, include_complete):
+    Stash = _stash_entity(include_complete)
+    query = db.query(Stash)\
+            .filter(Stash.pk.in_(select(pks.c.pk)))\
+            .order_by(Stash.id)
+
+    if not include_complete:
+        query = query.filter(Stash.is_complete == False)
+
+    return query
+
+def _stash_entity(include_complete):
+    """
+    Return the entity to query for stashed protocols.
+
+    This is just `Stash` if only incomplete protocols are wanted.  Otherwise 
+    it's an alias that combines the stash table with the archive (see 
+    `archive_protocols()`), so that archived protocols are included too.  
+    Rows loaded from the archive are only meant to be read.
+    """
+    if not include_complete:
+        return Stash
+
+    stash = Stash.__table__
+    both = union_all(
+            select(stash),
+            select(*(stash_archive.c[x.name] for x in stash.c)),
+    ).subquery()
+
+    return aliased(Stash, both, adapt_on_names=True)
+
+def _query_entity(query):
+    return query.column_descriptions[0]['entity']
+
+def _is_ready(stash):
+    """
+    Return a condition that is true for incomplete protocols without any 
+    incomplete dependencies.
+    """
+    upstream = Stash.__table__.alias()
+    deps = stash_dependencies
+    waiting = select(deps.c.downstream_pk)\
+            .join(upstream, upstream.c.pk == deps.c.upstream_pk)\
+            .where(deps.c.downstream_pk == stash.c.pk)\
+            .where(upstream.c.is_complete == False)
+
+    return (stash.c.is_complete == False) & ~waiting.exists()
+
+def _count_protocols(db):
+    return db.query(func.count(Stash.pk)).scalar()
+
+def grep_protocols(db, query, *, include_complete=False, limit=None, highlight=('[', ']')):
+    """
+    Print the stashed protocols matching the given full-text search query, 
+    best matches first.
+
+    Each match is printed on one line (with its id, name, and message), 
+    followed by an excerpt showing where the query matched.  The matching 
+    words are surrounded by the strings in *highlight*.
+    """
+    hits = search_protocols(
+            db, query,
+            include_complete=include_complete,
+            limit=limit,
+            highlight=highlight,
+    )
+
+    # Messages are put on a single line, so that each row of the table 
+    # corresponds to exactly one line of output.
+    rows = [
+            [row.id, row.slug or '', ' '.join((row.message or '').split())]
+            for row, snippet in hits
+    ]
+    if not rows:
+        print("No matching protocols found.")
+        return
+
+    lines = tabulate(rows, truncate=list('--x')).splitlines()
+    indent = ' ' * (len(str(max(x[0] for x in rows))) + 2)
+
+    for line, (row, snippet) in zip(lines, hits):
+        print(line)
+        for snippet_line in snippet.splitlines():
+            if snippet_line.strip():
+                print(indent + snippet_line.strip())
+
+def search_protocols(db, query, *, include_complete=False, limit=None, highlight=('[', ']')):
+    """
+    Return `(row, snippet)` tuples for the stashed protocols matching the 
+    given full-text search query, best matches first.
+
+    The query can use any of the syntax supported by SQLite's FTS5 extension, 
+    e.g. boolean operators, phrases, prefixes, and column filters (the columns 
+    are: slug, message, commands, text, date).  If the query isn't valid FTS5 
+    syntax, each word is instead searched for literally.
+
+    If SQLite doesn't support FTS5, fall back to `_scan_protocols()`.
+    """
+    from sqlalchemy.exc import OperationalError
+
+    if not _has_search_index(db):
+        return _scan_protocols(
+                db, query,
+                include_complete=include_complete,
+                limit=limit,
+        )
+
+    fts = literal_column('stash_fts')
+    rank = func.bm25(fts, *_SEARCH_WEIGHTS.values())
+    snippet = func.snippet(fts, -1, *highlight, '…', 16)
+
+    Stash = _stash_entity(include_complete)
+
+    def search(query):
+        q = db.query(Stash, snippet)\
+                .join(stash_fts, stash_fts.c.rowid == Stash.pk)\
+                .filter(fts.op('MATCH')(query))\
+                .order_by(rank, Stash.id)
+
+        if not include_complete:
+            q = q.filter(Stash.is_complete == False)
+
+        return q.limit(limit).all()
+
+    try:
+        return search(query)
+    except OperationalError:
+        return search(_quote_search_terms(query))
+
+def _scan_protocols(db, query, *, include_complete=False, limit=None):
+    """
+    Search the names and messages of the stashed protocols for every word in 
+    the given query, without using the full-text index.
+
+    This is much less capable than the full-text search: the protocols 
+    themselves aren't searched, the FTS5 query syntax isn't supported, and 
+    the results aren't ranked.  The returned snippets are always empty.
+    """
+    Stash = _stash_entity(include_complete)
+    q = db.query(Stash)
+
+    for word in query.split():
+        q = q.filter(
+                Stash.slug.icontains(word, autoescape=True) |
+                Stash.message.icontains(word, autoescape=True)
+        )
+
+    if not include_complete:
+        q = q.filter(Stash.is_complete == False)
+
+    return [(row, '') for row in q.order_by(Stash.id).limit(limit)]
+
+def _quote_search_terms(query):
+    return ' '.join(
+            '"{}"'.format(x.replace('"', '""'))
+            for x in query.split()
+    )
+
+def _index_protocol(db, row):
+    """
+    Add the given protocol to the full-text index, or update it if it's 
+    already there.
+    """
+    if not _has_search_index(db):
+        return
+
+    db.flush()
+
+    entry = _make_search_entry(
+            row.pk,
+            row.slug,
+            row.message,
+            row.date_added,
+            None if row.has_errors else row.protocol,
+    )
+
+    db.execute(delete(stash_fts).where(stash_fts.c.rowid == row.pk))
+    db.execute(insert(stash_fts).values(entry))
+
+def _make_search_entry(pk, slug, message, date, protocol):
+    if protocol is None:
+        commands = rendered = ''
+    else:
+        commands = '\n'.join(protocol.commands)
+        rendered = protocol.format_text()
+
+    # Include the date in a few different formats, so that it can be searched 
+    # in whatever way is most natural, e.g. "March 2024" or "2024-03-15".
+    return dict(
+            rowid=pk,
+            slug=slug or '',
+            message=message or '',
+            commands=commands,
+            text=rendered,
+            date=f'{date:%A %B} {date.day} {date:%Y %Y-%m-%d}' if date else '',
+    )
+
+def export_protocols(db, file, *, categories=None, include_complete=False, format='json'):
+    """
+    Write the stashed protocols matching the given criteria to the given file, 
+    one record at a time.
+
+    Each record includes the protocol's id, dates, completion state, message, 
+    categories, and dependencies.  The *format* can be either 'json' or 
+    'pickle'.  In the JSON format, *file* must be a text stream, each record 
+    is written on its own line, and the protocol itself is written as text.  
+    This format can be read by any version of stepwise (or by other 
+    programs).  In the pickle format, *file* must be a binary stream, each 
+    record is a separate pickle, and the protocol is written as a `Protocol` 
+    object.  This format is faster and lossless, but can only be read by the 
+    same version of stepwise.
+
+    The records can be read back into a stash using `import_protocols()`.
+    """
+    query = query_protocols(
+            db,
+            categories=categories,
+            include_dependents=True,
+            include_complete=include_complete,
+    )
+    entity = _query_entity(query)
+    query = query.options(
+            selectinload(entity.categories),
+            selectinload(entity.blob),
+    ).yield_per(_LIST_BATCH_SIZE)
+
+    for batch in chunked(query, _LIST_BATCH_SIZE):
+        # The `upstream_deps` relationship doesn't include archived 
+        # protocols, so look up the dependencies explicitly.
+        dependency_ids = _query_dependency_ids(db, [x.pk for x in batch])
+
+        for row in batch:
+            protocol = row.protocol
+            errors = not isinstance(protocol, Protocol)
+            record = {
+                    'id': row.id,
+                    'date_added': _format_date(row.date_added),
+                    'is_complete': bool(row.is_complete),
+                    'date_completed': _format_date(row.date_completed),
+                    'message': row.message,
+                    'categories': _sorted_category_names(row),
+                    'dependencies': dependency_ids.get(row.pk, []),
+                    'errors': errors,
+                    'attachments': [] if errors else [str(x) for x in protocol.attachments],
+            }
+
+            if format == 'pickle':
+                record['protocol'] = protocol
+                pickle.dump(record, file, pickle.HIGHEST_PROTOCOL)
+            else:
+                record['protocol'] = str(protocol) if errors else protocol.format_text()
+                print(json.dumps(record), file=file)
+
+def _query_dependency_ids(db, pks):
+    """
+    Return a dictionary mapping each of the given primary keys to the ids of 
+    the protocols it depends on, including any that have been archived.
+    """
+    deps = stash_dependencies
+    Upstream = _stash_entity(include_complete=True)
+    query = db.query(deps.c.downstream_pk, Upstream.id)\
+            .join(Upstream, Upstream.pk == deps.c.upstream_pk)\
+            .filter(deps.c.downstream_pk.in_(pks))\
+            .order_by(Upstream.id)
+
+    dependency_ids = {}
+    for pk, id in query:
+        dependency_ids.setdefault(pk, []).append(id)
+
+    return dependency_ids
+
+def import_protocols(db, file):
+    """
+    Add the protocols from the given binary stream (in either of the formats 
+    written by `export_protocols()`, which is detected automatically) to the 
+    stash.
+
+    The imported protocols keep their relative order, but their ids are 
+    shifted so that they come after any protocols that are already stashed.  
+    Their dependencies are updated accordingly; dependencies on protocols that 
+    weren't exported are dropped.  The protocols are inserted in batches, so 
+    memory use doesn't depend on the number of protocols being imported.  
+    Return the number of protocols imported.
+    """
+    # Flush so that the max() queries below include any pending rows.
+    db.flush()
+
+    stash = Stash.__table__
+    id_offset = _get_max(db, 'id')
+    next_pk = _get_max(db, 'pk') + 1
+    category_pks = dict(db.query(Category.name, Category.pk))
+
+    # Dependencies can refer to protocols later in the file, so they have to 
+    # be added after all the protocols.  They're small, so it's fine to keep 
+    # them all in memory.
+    pks = {}
+    dependencies = []
+
+    def get_category_pk(name):
+        if name not in category_pks:
+            result = db.execute(insert(Category.__table__).values(name=name))
+            category_pks[name] = result.inserted_primary_key[0]
+        return category_pks[name]
+
+    has_search_index = _has_search_index(db)
+
+    for batch in chunked(_iter_import_records(file), _LIST_BATCH_SIZE):
+        stash_rows = []
+        blob_rows = {}
+        category_rows = []
+        search_entries = []
+
+        for record in batch:
+            pk = pks[record['id']] = next_pk
+            next_pk += 1
+
+            protocol = record['protocol']
+            data = pickler.dumps(protocol, pickle.HIGHEST_PROTOCOL)
+            summary = _summarize_pickle(data)
+            date = record.get('date_added') or datetime.now()
+
+            stash_rows.append(dict(
+                    pk=pk,
+                    id=record['id'] + id_offset,
+                    date_added=date,
+                    is_complete=record.get('is_complete', False),
+                    date_completed=record.get('date_completed'),
+                    message=record.get('message'),
+                    **summary,
+            ))
+
+            blob = Blob.from_pickle(data, summary['content_hash'])
+            blob_rows[blob.hash] = dict(
+                    hash=blob.hash,
+                    data=blob.data,
+                    compression=blob.compression,
+            )
+
+            for name in record.get('categories', []):
+                category_rows.append(dict(
+                    stash_pk=pk,
+                    category_pk=get_category_pk(name),
+                ))
+
+            for id in record.get('dependencies', []):
+                dependencies.append((pk, id))
+
+            if has_search_index:
+                search_entries.append(_make_search_entry(
+                        pk,
+                        summary['slug'],
+                        record.get('message'),
+                        date,
+                        None if summary['has_errors'] else protocol,
+                ))
+
+        db.execute(insert(stash), stash_rows)
+        db.execute(insert(Blob.__table__).prefix_with('OR IGNORE'), list(blob_rows.values()))
+        if search_entries:
+            db.execute(insert(stash_fts), search_entries)
+        if category_rows:
+            db.execute(insert(stash_categories), category_rows)
+
+    dependency_rows = [
+            dict(downstream_pk=pk, upstream_pk=pks[id])
+            for pk, id in dependencies
+            if id in pks
+    ]
+    if dependency_rows:
+        db.execute(insert(stash_dependencies), dependency_rows)
+
+    # The rows were inserted behind the ORM's back.
+    db.expire_all()
+
+    return len(pks)
+
+def _iter_import_records(file):
+    """
+    Yield the records exported by `export_protocols()` from the given binary 
+    stream, with the protocols and dates converted back into python objects.
+    """
+    if not hasattr(file, 'peek'):
+        file = BufferedReader(file)
+
+    # Pickles (with protocol 2 or higher) always start with the PROTO opcode.
+    if file.peek(1)[:1] == pickle.PROTO:
+        while True:
+            try:
+                record = pickle.load(file)
+            except EOFError:
+                break
+
+            _parse_dates(record)
+            yield record
+
+    else:
+        text = TextIOWrapper(file, encoding='utf-8')
+
+        try:
+            for line in text:
+                if not line.strip():
+                    continue
+
+                record = json.loads(line)
+                _parse_dates(record)
+
+                if not record.get('errors'):
+                    protocol = Protocol.parse(record['protocol'])
+                    protocol.attachments = record.get('attachments', [])
+                    record['protocol'] = protocol
+
+                yield record
+
+        # Don't close the underlying stream (e.g. stdin) when the wrapper is 
+        # garbage collected.
+        finally:
+            text.detach()
+
+def _parse_dates(record):
+    for key in ['date_added', 'date_completed']:
+        record[key] = _parse_date(record.get(key))
+
+def _parse_date(date):
+    return datetime.fromisoformat(date) if date else None
+
+def _format_date(date):
+    return date.isoformat() if date else None
 
 def add_protocol(db, protocol, *, message=None, categories=None, dependencies=None):
     protocol.date = None
     row = Stash(
+            pk=_get_max(db, 'pk') + 1,
             id=get_next_id(db),
             categories=get_or_create_categories(db, categories),
             message=message,
-            protocol=protocol,
             upstream_deps=get_protocols(db, dependencies),
     )
     db.add(row)
+    row.protocol = protocol
+    db.flush()
+    _index_protocol(db, row)
     return row
 
 def edit_protocol(db, id=None, protocol=None, *, message=None, categories=None, dependencies=None, explicit=False):
-    row = get_protocol(db, id)
+    row = get_protocol(db, id, unarchive=True)
     if message or explicit:
         row.message = message
     if categories or explicit:
@@ -195,54 +1291,211 @@ def edit_protocol(db, id=None, protocol=None, *, message=None, categories=None,
     if dependencies or explicit:
         if row.id in (dependencies or []):
             raise UsageError(f"Cannot add '{row.id}' as a dependency of itself.")
-        row.upstream_deps = get_protocols(db, dependencies)
+        upstream_deps = get_protocols(db, dependencies)
+        _check_for_cycles(db, row, upstream_deps)
+        row.upstream_deps = upstream_deps
     if protocol:
         protocol.date = None
         row.protocol = protocol
+    if message or protocol or explicit:
+        _index_protocol(db, row)
     return row
 
+def _check_for_cycles(db, row, upstream_deps):
+    """
+    Make sure that *row* can depend on the given protocols without creating a 
+    dependency cycle, i.e. that none of them already depend on *row*.
+
+    This only matters when editing a protocol: a newly added protocol can't 
+    have anything depending on it yet.
+    """
+    if row.pk is None or not upstream_deps:
+        return
+
+    db.flush()
+    downstream = _select_transitive_deps([row.pk], upstream=False)
+    downstream_pks = set(db.scalars(select(downstream.c.pk)))
+
+    for dep in upstream_deps:
+        if dep.pk in downstream_pks:
+            raise UsageError(
+                    f"Cannot add '{dep.id}' as a dependency of '{row.id}', because '{dep.id}' already depends on '{row.id}'.",
+            )
+
 def peek_protocol(db, id=None):
     return get_protocol(db, id)
 
-def pop_protocol(db, id=None):
-    row = peek_protocol(db, id)
-    row.is_complete = True
+def pop_protocol(db, id=None, *, archive_after=None):
+    row = get_protocol(db, id, unarchive=True)
+    _complete_protocols([row])
+
+    # Load the protocol before the row is (possibly) archived, because the 
+    # caller will want to display it.
+    row.blob
+    archive_protocols(db, archive_after)
     return row
 
-def drop_protocols(db, ids):
-    for id in ids:
-        row = get_protocol(db, id)
-        row.is_complete = True
+def drop_protocols(db, ids, *, archive_after=None):
+    _complete_protocols(get_protocols(db, ids, unarchive=True))
+    archive_protocols(db, archive_after)
 
 def restore_protocols(db, ids):
-    for id in ids:
-        row = get_protocol(db, id)
+    for row in get_protocols(db, ids, unarchive=True):
         row.is_complete = False
+        row.date_completed = None
+
+def clear_protocols(db, *, archive_after=None):
+    db.execute(
+            update(Stash)\
+                    .where(Stash.is_complete == False)\
+                    .values(is_complete=True, date_completed=datetime.now()),
+            execution_options={'synchronize_session': 'evaluate'},
+    )
+    archive_protocols(db, archive_after)
 
-def clear_protocols(db):
-    for row in db.query(Stash).all():
-        row.is_complete = True
+def _complete_protocols(rows):
+    now = datetime.now()
+    for row in rows:
+        if not row.is_complete:
+            row.is_complete = True
+            row.date_completed = now
+
+def archive_protocols(db, age):
+    """
+    Move every protocol that was completed more than *age* (a `timedelta`) 
+    ago from the stash table into the archive table.
+
+    Protocols that were completed before stepwise kept track of completion 
+    dates are archived regardless of *age*.  Nothing is archived if *age* is 
+    None.  Archived protocols are still included when listing or searching 
+    complete protocols, and can still be looked up by id.  They are only 
+    moved back into the stash table when they need to be modified (see 
+    `get_protocols()`).  Return the number of protocols archived.
+    """
+    if age is None:
+        return 0
+
+    db.flush()
+
+    stash = Stash.__table__
+    cutoff = datetime.now() - age
+    is_old = (stash.c.is_complete == True) & (
+            (stash.c.date_completed == None) |
+            (stash.c.date_completed <= cutoff)
+    )
+
+    _move_rows(db, stash, stash_archive, is_old)
+    result = db.execute(
+            delete(Stash).where(is_old),
+            execution_options={'synchronize_session': 'fetch'},
+    )
+    return result.rowcount
+
+def _unarchive_protocols(db, ids):
+    """
+    Move the protocols with the given ids (if there are any) from the archive 
+    table back into the stash table, so that they can be modified.
+    """
+    if not ids:
+        return
+
+    is_match = stash_archive.c.id.in_(set(ids))
+    _move_rows(db, stash_archive, Stash.__table__, is_match)
+    db.execute(delete(stash_archive).where(is_match))
+
+def _move_rows(db, src, dest, where):
+    names = [x.name for x in dest.c]
+    rows = select(*(src.c[x] for x in names)).where(where)
+    db.execute(insert(dest).from_select(names, rows))
 
 def reset_protocols(db):
-    # Use `db.delete()` rather than `query.delete()` because the latter does 
-    # not respect in-python delete cascades, which are used here to update the 
-    # association table.  Also, `query.delete()` is not compatible with joins.
+    # Use bulk statements (rather than loading, modifying, and deleting each 
+    # row in python) so that this is fast even for very large stashes.  This 
+    # means that the association tables have to be updated explicitly, since 
+    # the ORM's delete cascades don't apply.
 
-    for row in db.query(Stash).filter_by(is_complete=True).all():
-        db.delete(row)
+    db.flush()
 
-    for i, row in enumerate(db.query(Stash).order_by(Stash.id), 1):
-        row.id = i
+    stash = Stash.__table__
+    complete_pks = union_all(
+            select(stash.c.pk).where(stash.c.is_complete == True),
+            select(stash_archive.c.pk),
+    )
 
-    stale_categories = db.query(Category)\
-            .outerjoin(stash_categories)\
-            .filter(stash_categories.c.stash_pk == None)\
-            .all()
+    if _has_search_index(db):
+        db.execute(
+                delete(stash_fts)\
+                        .where(stash_fts.c.rowid.in_(complete_pks))
+        )
+    db.execute(
+            delete(stash_categories)\
+                    .where(stash_categories.c.stash_pk.in_(complete_pks))
+    )
+    db.execute(
+            delete(stash_dependencies)\
+                    .where(
+                        stash_dependencies.c.upstream_pk.in_(complete_pks) |
+                        stash_dependencies.c.downstream_pk.in_(complete_pks)
+                    )
+    )
+    db.execute(
+            delete(Stash).where(Stash.is_complete == True),
+            execution_options={'synchronize_session': 'fetch'},
+    )
+    db.execute(delete(stash_archive))
+
+    # Renumber the remaining rows in two steps, because the id column must 
+    # stay unique after each row is updated.  First make every id negative 
+    # (which can't collide with anything), then assign the final ids in 
+    # ascending order of the original ids.
+    db.execute(update(stash).values(id=-stash.c.id))
+
+    new_ids = select(
+            stash.c.pk,
+            func.row_number().over(order_by=stash.c.id.desc()).label('id'),
+    ).subquery()
 
-    for category in stale_categories:
-        db.delete(category)
+    if _supports_update_from(db):
+        db.execute(
+                update(stash)\
+                        .where(stash.c.pk == new_ids.c.pk)\
+                        .values(id=new_ids.c.id)
+        )
+
+    # `UPDATE ... FROM` requires SQLite 3.33.  For older versions, look up 
+    # each new id with a correlated subquery instead.  SQLite materializes the 
+    # row numbers just once, before any rows are updated.
+    else:
+        new_id = select(new_ids.c.id)\
+                .where(new_ids.c.pk == stash.c.pk)\
+                .scalar_subquery()
+        db.execute(update(stash).values(id=new_id))
+
+    # Delete any blobs that are no longer referred to.  Note that `NOT IN` 
+    # never matches if the subquery contains NULL.
+    used_hashes = select(stash.c.content_hash)\
+            .where(stash.c.content_hash != None)
+    db.execute(
+            delete(Blob)\
+                    .where(Blob.hash.not_in(used_hashes)),
+            execution_options={'synchronize_session': 'fetch'},
+    )
+
+    used_category_pks = select(stash_categories.c.category_pk)
+    db.execute(
+            delete(Category)\
+                    .where(Category.pk.not_in(used_category_pks)),
+            execution_options={'synchronize_session': 'fetch'},
+    )
 
-def get_protocol(db, id=None):
+    # The renumbering happened behind the ORM's back.
+    db.expire_all()
+
+def _supports_update_from(db):
+    version = db.get_bind().dialect.dbapi.sqlite_version_info
+    return version >= (3, 33, 0)
+
+def get_protocol(db, id=None, *, unarchive=False):
     if id is None:
         try:
             return db.query(Stash).filter_by(is_complete=False).one()
@@ -252,21 +1505,48 @@ def get_protocol(db, id=None):
             raise UsageError("Multiple stashed protocols, please specify an id")
 
     else:
-        try:
-            return db.query(Stash).filter_by(id=id).one()
-        except NoResultFound:
-            raise UsageError(f"No stashed protocol with id '{id}'")
-        except MultipleResultsFound:  # pragma: no cover
-            # Database constraints should prevent this from ever occurring.
-            raise AssertionError(f"Multiple stashed protocols with id '{id}'.  This should never happen!  Please report a bug: <https://github.com/kalekundert/stepwise/issues>")
-
-def get_protocols(db, ids):
-    # Get each protocol individually (as opposed to getting them all in one 
-    # query) to make sure that an error is raised if we're given an invalid id.
-    return [
-            get_protocol(db, id)
-            for id in ids or []
-    ]
+        return get_protocols(db, [id], unarchive=unarchive)[0]
+
+def get_protocols(db, ids, *, unarchive=False):
+    """
+    Return the protocols with the given ids, in the same order as the ids.
+
+    Protocols that have been archived (see `archive_protocols()`) are found 
+    too.  By default they are read directly from the archive, which doesn't 
+    require writing to the database.  Such rows are only meant to be read, 
+    though, so any caller that might modify the rows must specify *unarchive*.  
+    The archived rows are then moved back into the stash table first.
+    """
+    if not ids:
+        return []
+
+    # Get all the protocols in one query, then check that every id was found.  
+    # The rows are returned in the same order as the given ids.
+    def query_rows(Stash):
+        return {
+                row.id: row
+                for row in db.query(Stash).filter(Stash.id.in_(set(ids)))
+        }
+
+    rows = query_rows(Stash)
+
+    # Any protocols that weren't found may have been archived.
+    if len(rows) < len(set(ids)):
+        if unarchive:
+            _unarchive_protocols(db, [x for x in ids if x not in rows])
+            rows = query_rows(Stash)
+        else:
+            rows = query_rows(_stash_entity(include_complete=True))
+
+    missing_ids = list(dict.fromkeys(x for x in ids if x not in rows))
+
+    if len(missing_ids) == 1:
+        raise UsageError(f"No stashed protocol with id '{missing_ids[0]}'")
+    if missing_ids:
+        id_strs = ', '.join(f"'{x}'" for x in missing_ids)
+        raise UsageError(f"No stashed protocols with ids {id_strs}")
+
+    return [rows[id] for id in ids]
 
 def get_or_create_categories(db, names):
     if not names:
@@ -285,9 +1565,20 @@ def get_or_create_categories(db, names):
     return categories
 
 def get_next_id(db):
-    curr_id = db.query(func.max(Stash.id)).scalar()
+    return _get_max(db, 'id') + 1
 
-    # The max() function returns None if there are no rows in the table, so we
-    # have to handle this case specially.
-    return 1 if curr_id is None else curr_id + 1
+def _get_max(db, col):
+    """
+    Return the largest value of the given column in either the stash or the 
+    archive, so that ids and primary keys are never reused.  Return 0 if both 
+    tables are empty.
+    """
+    db.flush()
+
+    # The max() function returns None if there are no rows in the table, so 
+    # we have to handle this case specially.
+    return max(
+            db.scalar(select(func.max(Stash.__table__.c[col]))) or 0,
+            db.scalar(select(func.max(stash_archive.c[col]))) or 0,
+    )
 
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import byoc
-from stepwise import StepwiseCommand, ProtocolIO, replace_text
+from stepwise import StepwiseCommand, ProtocolIO, TextSpans
 from inform import fatal
 
 class Substitute(StepwiseCommand):
@@ -41,24 +41,19 @@ Options:
         if not io.protocol:
             fatal("no protocol specified.")
 
+        # Search the steps in reverse order, so that the most recently added 
+        # steps are edited first.
+        # Unlike `re.sub()`, a count of 0 means to not make any replacements.
         p = io.protocol
-        i = len(p.steps) - 1
-        n_remaining = self.n
+        spans = TextSpans(*p.steps)
+        n = 0
 
-        while (i >= 0) and n_remaining:
-            state = {}
-            step = replace_text(
-                    p.steps[i], self.pattern, self.replace,
-                    count=n_remaining,
-                    state=state,
-            )
-            if state['n'] > 0:
-                p.steps[i] = step
+        if self.n > 0:
+            n = spans.subn(self.pattern, self.replace, count=self.n, reverse=True)
 
-            i -= 1
-            n_remaining -= state['n']
-
-        if n_remaining == self.n:
+        if not n:
             fatal(f"pattern {self.pattern!r} not found in protocol.")
 
+        p.steps = spans.objs
+
         io.to_stdout(self.force_text)
@@ -84,7 +84,14 @@ class PresetConfig(byoc.Config):
             self.schema = schema
 
         def iter_values(self, key, log):
-            layer_1 = byoc.DictLayer(self.presets_getter())
+            presets = self.presets_getter()
+
+            # Don't bother getting the key (which may be expensive, e.g. 
+            # looking up the default printer) if there are no presets.
+            if not any(presets):
+                return
+
+            layer_1 = byoc.DictLayer(presets)
             preset = only(layer_1.iter_values(self.key_getter(), log))
 
             if preset is not None:
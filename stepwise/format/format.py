@@ -1,18 +1,97 @@
 #!/usr/bin/env python3
 
-import re
-import textwrap
+import re, threading
+from . import layout
+from math import inf
+from contextlib import contextmanager
 
 _UNINITIALIZED = object()
 
+# See `_key_memo()`.
+_key_memo_state = threading.local()
+
 class Formatter:
     
-    def format_text(self, content_width, page_width, **kwargs):
-        raise NotImplementedError
+    def __getstate__(self):
+        # Don't pickle the rendering cache; it can be large and it's cheap to 
+        # rebuild.  This also matters for copies, which shouldn't share a 
+        # cache with the original.
+        state = self.__dict__.copy()
+        state.pop('_format_cache', None)
+        return state
+
+    def format_text(self, width, **kwargs):
+        return '\n'.join(self.iter_lines(width, **kwargs))
+
+    def iter_lines(self, width, **kwargs):
+        """
+        Yield the formatted text one line at a time (without trailing 
+        newlines).
+
+        Subclasses must implement at least one of `format_text()` or 
+        `iter_lines()`.  Implementing `iter_lines()` is preferable, because it 
+        allows large documents to be rendered (e.g. written to a file) without 
+        ever building the whole document as a single string.
+        """
+        if type(self).format_text is Formatter.format_text:
+            raise NotImplementedError
+
+        yield from self.format_text(width, **kwargs).split('\n')
 
     def replace_text(self, pattern, repl, **kwargs):
+        """
+        Substitute the given pattern in every string contained by this 
+        formatter.
+
+        Subclasses must implement either this method or `_iter_text_slots()`.  
+        Implementing `_iter_text_slots()` is preferable, because it allows 
+        `TextSpans` to search the formatter without any recursive calls.
+        """
+        if type(self)._iter_text_slots is Formatter._iter_text_slots:
+            raise NotImplementedError
+
+        replace_text(self, pattern, repl, **kwargs)
+
+    def canonical_text(self):
+        """
+        Return the text of this formatter with no line wrapping.
+
+        The return value is the same as ``format_text(self, math.inf)``.  It's 
+        meant to be used for comparing and hashing formatted content, e.g. 
+        when looking for duplicate footnotes.  Subclasses can override this 
+        method if they have a faster way to calculate the same result.
+        """
+        return format_text(self, inf)
+
+    def _cache_key(self):
+        """
+        Return an object that compares equal to any previous return value if 
+        and only if this formatter would produce the same text.
+
+        The default implementation raises `_Uncacheable`, which simply means 
+        that this formatter will be rendered from scratch every time.  
+        Subclasses can override this method to take advantage of the 
+        rendering cache.
+        """
+        raise _Uncacheable
+
+    def _iter_text_slots(self):
+        """
+        Yield a ``(value, setter)`` tuple for each item directly contained by 
+        this formatter.
+
+        The values can be strings or other formatters.  Calling the setter 
+        with a new value should replace the corresponding item.
+        """
         raise NotImplementedError
 
+class _Uncacheable(Exception):
+    """
+    Raised by `Formatter._cache_key()` to indicate that a formatter must not 
+    be cached.
+    """
+    pass
+
 def format_text(obj, width, **kwargs):
     """
     Has the same signature as `textwrap.fill()`, except:
@@ -29,52 +108,350 @@ def format_text(obj, width, **kwargs):
     """
 
     if not isinstance(obj, str):
-        return obj.format_text(width, **kwargs)
-
-    # Trim trailing whitespace.  This prevents `textwrap.fill()` from turning 
-    # 'a \nb' into 'a  b' (note the duplicate space).
-    text = re.sub(r'(?m) $', '', obj)
-    text = textwrap.dedent(text)
+        return _format_cached(
+                obj, width, kwargs,
+                lambda: obj.format_text(width, **kwargs),
+        )
 
     # This is the only keyword argument allowed to `format_text()` that doesn't 
     # correspond to a `textwrap.fill()` keyword argument.
     kwargs.pop('truncate_width', None)
 
-    return textwrap.fill(
-        text, width,
-        drop_whitespace=True,
-        break_long_words=False,
-        **kwargs,
+    # The layout engine caches the words in each paragraph, so reformatting 
+    # the same text at a different width is cheap.
+    return layout.fill(obj, width, **kwargs)
+
+def canonical_text(obj):
+    """
+    Return the given object formatted with no line wrapping.
+
+    This is equivalent to ``format_text(obj, math.inf)``, but faster.  The 
+    result for each string is memoized, and the general line-wrapping 
+    machinery is skipped entirely.
+    """
+    if isinstance(obj, str):
+        return layout.canonicalize(obj)
+
+    try:
+        obj_canonical_text = obj.canonical_text
+    except AttributeError:
+        return format_text(obj, inf)
+
+    return obj_canonical_text()
+
+def iter_lines(obj, width, **kwargs):
+    """
+    Yield the lines of the given object, formatted as if by `format_text()`.
+
+    Joining the yielded lines with newlines reproduces the return value of 
+    `format_text()` exactly.  At least one line is always yielded, even if it's 
+    empty.
+    """
+    if isinstance(obj, str):
+        yield from format_text(obj, width, **kwargs).split('\n')
+        return
+
+    try:
+        obj_iter_lines = obj.iter_lines
+    except AttributeError:
+        yield from format_text(obj, width, **kwargs).split('\n')
+        return
+
+    yield from _iter_cached(
+            obj, width, kwargs,
+            lambda: obj_iter_lines(width, **kwargs),
     )
 
 def replace_text(obj, pattern, repl, state=_UNINITIALIZED, **kwargs):
     if state is _UNINITIALIZED: state = {}
     state.setdefault('n', 0)
 
+    # Adjust the count parameter to account for substitutions that were made 
+    # in other calls.  Avoid going into this conditional if the user 
+    # explicitly specified `count=0`, because that means to replace every 
+    # occurrence of the pattern as per the `re` module documentation.
+
+    if kwargs.get('count'):
+        kwargs['count'] -= state['n']
+        if kwargs['count'] <= 0:
+            return obj
+
+    spans = TextSpans(obj)
+    state['n'] += spans.subn(pattern, repl, **kwargs)
+    return spans.objs[0]
+
+class TextSpans:
+    """
+    A flat list of all the strings in one or more formatters, each with a 
+    reference back to where it came from.
+
+    The formatter trees are flattened just once, when this object is created.  
+    After that, patterns can be substituted into every string without any 
+    recursion or bookkeeping between the levels of the tree.  Substitutions 
+    are written back to the original formatters.
+
+    Note that each string is still searched separately, so a match can never 
+    span multiple strings (e.g. two items in a list).  This is the same 
+    behavior as `replace_text()`.
+    """
+
+    def __init__(self, *objs):
+        self.objs = list(objs)
+        self._roots = [
+                list(_iter_spans(obj, _item_setter(self.objs, i)))
+                for i, obj in enumerate(self.objs)
+        ]
+
+    def subn(self, pattern, repl, count=0, flags=0, reverse=False):
+        """
+        Replace occurrences of the given pattern, and return the number of 
+        replacements that were made.
+
+        The arguments have the same meaning as for `re.subn()`, except for 
+        *reverse*.  If true, the objects given to the constructor are searched 
+        from last to first.  The strings within each object are still searched 
+        from first to last.  This is the order in which `sw sub` searches the 
+        steps of a protocol.
+        """
+        pattern = re.compile(pattern, flags)
+        roots = reversed(self._roots) if reverse else self._roots
+        n = 0
+
+        for spans in roots:
+            for span in spans:
+                n += span.subn(pattern, repl, count and count - n)
+                if count and n >= count:
+                    return n
+
+        return n
+
+class _StrSpan:
+
+    def __init__(self, text, setter):
+        self.text = text
+        self.setter = setter
+
+    def subn(self, pattern, repl, count):
+        text, n = pattern.subn(repl, self.text, count)
+        if n:
+            self.text = text
+            self.setter(text)
+        return n
+
+class _OpaqueSpan:
+    """
+    A formatter that doesn't support `_iter_text_slots()`, and must therefore 
+    make its own substitutions.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def subn(self, pattern, repl, count):
+        state = {'n': 0}
+        self.obj.replace_text(pattern, repl, state=state, count=count)
+        return state['n']
+
+def _iter_spans(obj, setter):
+    # Falsey values (including empty strings) are ignored by the list 
+    # formatters, so patterns that match empty text (e.g. '^') shouldn't add 
+    # anything to them.
+    if not obj:
+        return
+
     if isinstance(obj, str):
+        yield _StrSpan(obj, setter)
+        return
+
+    try:
+        slots = obj._iter_text_slots()
+    except (AttributeError, NotImplementedError):
+        yield _OpaqueSpan(obj)
+        return
+
+    for child, child_setter in slots:
+        yield from _iter_spans(child, child_setter)
+
+def _item_setter(items, i):
+    def setter(value):
+        items[i] = value
+    return setter
+
+def _format_cached(obj, width, kwargs, render):
+    """
+    Return the text rendered by `render()`, or a copy of that text saved from a 
+    previous call with the same arguments and the same content.
+
+    The cache is stored on `obj` itself, and is keyed by the given width and 
+    keyword arguments.  Each cache entry also remembers the content key (see 
+    `_get_cache_key()`) of the object it was rendered from.  This key is 
+    recalculated for every top-level render (which is much cheaper than 
+    rendering), so any change to the object, e.g. via `replace_text()` or by 
+    modifying a list of steps, invalidates the cache automatically.  Within a 
+    render, the key of each object is only calculated once (see 
+    `_key_memo()`).
+    """
+    with _key_memo():
+        try:
+            cache, render_key, content_key = _open_cache(obj, width, kwargs)
+        except _Uncacheable:
+            return render()
+
+        hit = cache.get(render_key)
+        if hit and hit[0] == content_key:
+            return hit[1]
+
+        text = render()
+        cache[render_key] = content_key, text
+        return text
+
+def _iter_cached(obj, width, kwargs, iter_render):
+    """
+    Like `_format_cached()`, but yield lines rather than returning a string.
+
+    The lines are only added to the cache if the caller iterates through all 
+    of them.  The same content keys are used for every line, so the object 
+    must not be changed until all of its lines have been yielded.  But the 
+    keys aren't memoized while the caller is running, e.g. in case it renders 
+    other objects in between lines.
+    """
+    is_outermost = getattr(_key_memo_state, 'memo', None) is None
 
-        def subn_helper():
-            # Adjust the count parameter to account for substitutions that were 
-            # made in other calls.  Avoid going into this conditional if the 
-            # user explicitly specified `count=0`, because that means to 
-            # replace every occurrence of the pattern as per the `re` module 
-            # documentation.
+    with _key_memo() as memo:
+        try:
+            cache, render_key, content_key = _open_cache(obj, width, kwargs)
+        except _Uncacheable:
+            cache = None
 
-            if kwargs.get('count'):
-                kwargs['count'] -= state['n']
-                if kwargs['count'] <= 0:
-                    return obj, 0
+    if cache is not None:
+        hit = cache.get(render_key)
+        if hit and hit[0] == content_key:
+            yield from hit[1].split('\n')
+            return
 
-            return re.subn(pattern, repl, obj, **kwargs)
+    it = iter_render()
+    lines = []
 
-        obj_repl, n = subn_helper()
-        state['n'] += n
-        return obj_repl
+    # Nested generators are only ever advanced by the outermost one, so only 
+    # the outermost one needs to restore the memo for each line.
+    if not is_outermost:
+        for line in it:
+            lines.append(line)
+            yield line
 
     else:
-        obj.replace_text(pattern, repl, state=state, **kwargs)
+        while True:
+            with _key_memo(memo):
+                line = next(it, _UNINITIALIZED)
+            if line is _UNINITIALIZED:
+                break
+
+            lines.append(line)
+            yield line
+
+    if cache is not None:
+        cache[render_key] = content_key, '\n'.join(lines)
+
+def _open_cache(obj, width, kwargs):
+    try:
+        content_key = _get_cache_key(obj)
+        render_key = width, tuple(sorted(kwargs.items()))
+        hash(render_key)
+        cache = obj.__dict__.setdefault('_format_cache', {})
+    except (TypeError, AttributeError):
+        raise _Uncacheable
+
+    return cache, render_key, content_key
+
+@contextmanager
+def _key_memo(memo=None):
+    """
+    Calculate the content key of each object at most once within this context.
+
+    The key of a formatter depends on the keys of everything it contains, and 
+    nested formatters check their own caches as they're rendered, so without 
+    this memo the keys for deeply nested objects would be recalculated at 
+    every level.  The objects can't change during a single render, so it's 
+    safe to reuse their keys.
+
+    Nested contexts share the outermost memo.  A memo yielded by a previous 
+    context can be given to continue the same render later.
+    """
+    active_memo = getattr(_key_memo_state, 'memo', None)
+    if active_memo is not None:
+        yield active_memo
+        return
+
+    _key_memo_state.memo = {} if memo is None else memo
+    try:
+        yield _key_memo_state.memo
+    finally:
+        _key_memo_state.memo = None
+
+def _join_lines(pieces):
+    """
+    Concatenate the given pieces as if they were strings, yielding one line at 
+    a time.
+
+    Each piece should be an iterable of lines, e.g. as returned by 
+    `iter_lines()` or `str.split('\\n')`.  The last line of each piece is 
+    joined with the first line of the next, exactly like string concatenation.
+    """
+    pending = None
+
+    for piece in pieces:
+        for i, line in enumerate(piece):
+            if i == 0 and pending is not None:
+                pending += line
+            else:
+                if pending is not None:
+                    yield pending
+                pending = line
+
+    if pending is not None:
+        yield pending
+
+def _get_cache_key(obj):
+    """
+    Return an object that can be compared to determine if the given object 
+    would be rendered differently than before.
+
+    Raise `_Uncacheable` if no such object can be made.
+    """
+    if isinstance(obj, str):
         return obj
 
+    # Placeholders are ignored by the list formatters.
+    if obj is None:
+        return None
+
+    memo = getattr(_key_memo_state, 'memo', None)
+    if memo is None:
+        return _calc_cache_key(obj)
+
+    if id(obj) not in memo:
+        try:
+            key = _calc_cache_key(obj)
+        except _Uncacheable:
+            key = _Uncacheable
+
+        # Keep a reference to the object, so its id can't be reused by 
+        # another object while the memo is active.
+        memo[id(obj)] = obj, key
+
+    key = memo[id(obj)][1]
+    if key is _Uncacheable:
+        raise _Uncacheable
+
+    return key
+
+def _calc_cache_key(obj):
+    try:
+        get_key = obj._cache_key
+    except AttributeError:
+        raise _Uncacheable
+
+    return type(obj), get_key()
 
 def _align_indents_if_possible(kwargs):
     # If the initial indent contains any newlines, we only care about the 
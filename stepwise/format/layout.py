@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+Break paragraphs into lines.
+
+The same text is often wrapped at several different widths, e.g. at the
+printer's content width for `sw go`, at the terminal width for interactive
+output, and at infinite width when comparing footnotes.  The functions in this
+module split each paragraph into words (and the break opportunities between
+them) just once, then cache that representation so that the paragraph can be
+reflowed to any width in linear time.
+
+The resulting line breaks are identical to those produced by
+`textwrap.fill()` with ``drop_whitespace=True`` and
+``break_long_words=False``.
+"""
+
+import re
+import textwrap
+
+from functools import lru_cache
+from math import inf
+
+# `textwrap.fill()` arguments that affect how the text is split into chunks,
+# and their default values.
+_CHUNK_OPTIONS = {
+        'expand_tabs': True,
+        'tabsize': 8,
+        'replace_whitespace': True,
+        'fix_sentence_endings': False,
+        'break_on_hyphens': True,
+}
+
+# `textwrap.fill()` arguments that affect how the chunks are arranged into
+# lines, and their default values.
+_LINE_OPTIONS = {
+        'initial_indent': '',
+        'subsequent_indent': '',
+}
+
+_WHITESPACE_TO_SPACES = str.maketrans(
+        textwrap._whitespace,
+        ' ' * len(textwrap._whitespace),
+)
+
+class Paragraph:
+    """
+    A paragraph that has been split into chunks, but not yet into lines.
+
+    Each chunk is either a word or a run of whitespace.  A line break can
+    come between any two chunks.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.lens = [len(x) for x in chunks]
+        self.is_space = [not x.strip() for x in chunks]
+
+    @classmethod
+    def from_text(cls, text, **options):
+        """
+        Return the chunks for the given text, reusing a previous result if
+        possible.
+
+        Like `format_text()`, trailing spaces are removed from each line and
+        the text is dedented before being split.
+        """
+        return _paragraph_from_text(text, tuple(sorted(options.items())))
+
+    def wrap(self, width, *, initial_indent='', subsequent_indent=''):
+        """
+        Return a list of lines no longer than the given width (except for
+        words that are too long to fit on any line).
+        """
+        if width <= 0:
+            raise ValueError("invalid width %r (must be > 0)" % width)
+
+        chunks, lens, is_space = self.chunks, self.lens, self.is_space
+        n = len(chunks)
+        i = 0
+        lines = []
+
+        while i < n:
+            indent = subsequent_indent if lines else initial_indent
+            line_width = width - len(indent)
+
+            # Drop whitespace from the start of every line but the first.
+            if is_space[i] and lines:
+                i += 1
+
+            j = i
+            line_len = 0
+
+            while j < n and line_len + lens[j] <= line_width:
+                line_len += lens[j]
+                j += 1
+
+            # If the next word is too long to fit on any line, give it a line
+            # of its own.
+            if j == i and j < n:
+                j += 1
+
+            # Drop whitespace from the end of every line.
+            k = j
+            if k > i and is_space[k - 1]:
+                k -= 1
+
+            if k > i:
+                lines.append(indent + ''.join(chunks[i:k]))
+
+            i = j
+
+        return lines
+
+def fill(text, width, **kwargs):
+    """
+    Equivalent to ``textwrap.fill(text, width, drop_whitespace=True,
+    break_long_words=False, **kwargs)``, except that trailing spaces are
+    removed and the text is dedented first.
+    """
+    chunk_options = {}
+    line_options = {}
+
+    for k in list(kwargs):
+        if k in _CHUNK_OPTIONS:
+            chunk_options[k] = kwargs.pop(k)
+        elif k in _LINE_OPTIONS:
+            line_options[k] = kwargs.pop(k)
+
+    # Fall back on `textwrap` for any options that the layout engine doesn't
+    # support (e.g. `max_lines`).
+    if kwargs:
+        return textwrap.fill(
+                _normalize_text(text), width,
+                drop_whitespace=True,
+                break_long_words=False,
+                **chunk_options,
+                **line_options,
+                **kwargs,
+        )
+
+    paragraph = Paragraph.from_text(text, **chunk_options)
+    return '\n'.join(paragraph.wrap(width, **line_options))
+
+@lru_cache(maxsize=2**16)
+def canonicalize(text):
+    """
+    Equivalent to ``fill(text, math.inf)``, but faster.
+
+    At infinite width, the whole paragraph fits on one line.  That line is 
+    just the text with tabs expanded, every whitespace character replaced by a 
+    space, and trailing whitespace removed.
+    """
+    # `textwrap` only considers ASCII whitespace when splitting chunks, but 
+    # uses `str.strip()` to decide which chunks to drop.  The rules for text 
+    # ending in other kinds of whitespace (e.g. non-breaking spaces) are 
+    # subtle, so fall back on the general algorithm in that case.
+    line = _normalize_text(text)
+    line = line.expandtabs(_CHUNK_OPTIONS['tabsize'])
+    line = line.translate(_WHITESPACE_TO_SPACES)
+
+    if line[-1:].isspace() and line[-1] != ' ':
+        return fill(text, inf)
+
+    return line.rstrip(' ')
+
+@lru_cache(maxsize=2**16)
+def split_preformatted(content):
+    """
+    Split preformatted text into lines, keeping line endings.
+    """
+    return tuple(content.splitlines(True))
+
+@lru_cache(maxsize=2**16)
+def _paragraph_from_text(text, options):
+    wrapper = textwrap.TextWrapper(**dict(options))
+    chunks = wrapper._split_chunks(_normalize_text(text))
+    if wrapper.fix_sentence_endings:
+        wrapper._fix_sentence_endings(chunks)
+    return Paragraph(chunks)
+
+def _normalize_text(text):
+    # Trim trailing whitespace.  This prevents `textwrap.fill()` from turning
+    # 'a \nb' into 'a  b' (note the duplicate space).
+    text = re.sub(r'(?m) $', '', text)
+    return textwrap.dedent(text)
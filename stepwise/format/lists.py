@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 
 from .format import (
-        Formatter, format_text, replace_text, _align_indents_if_possible
+        Formatter, iter_lines, _align_indents_if_possible, _get_cache_key,
+        _join_lines, _item_setter, _Uncacheable,
 )
 from itertools import repeat
-from more_itertools import repeat_last, mark_ends, interleave, chunked
+from more_itertools import repeat_last, mark_ends, interleave
 from reprfunc import repr_from_init
 
-def _format_list(items, indents, width, br, force_alignment=True, **kwargs):
+def _iter_list_lines(items, indents, width, br, force_alignment=True, **kwargs):
         if force_alignment:
             # This function modifies `kwargs`, so it must called before any 
             # of those values are read.
@@ -33,22 +34,28 @@ def _format_list(items, indents, width, br, force_alignment=True, **kwargs):
                         next(kwargs_indent_iter) + subsequent_indent,
             }
 
-        list_str = ''
+        # Each item and line break is yielded as a separate piece, and the 
+        # pieces are joined line-by-line.  This avoids repeatedly copying the 
+        # whole list into ever-longer strings.
+        br_lines = br.split('\n')
 
-        if force_alignment:
-            list_str += next(kwargs_indent_iter) + '\n'
+        def iter_pieces():
+            if force_alignment:
+                yield [next(kwargs_indent_iter), '']
+
+            for is_first, is_last, (item, indent) in mark_ends(item_indent_iter):
+                yield iter_lines(item, width, **next_kwargs(indent))
+                if not is_last:
+                    yield br_lines
 
-        for is_first, is_last, (item, indent) in mark_ends(item_indent_iter):
-            list_str += format_text(item, width, **next_kwargs(indent))
-            list_str += br * (not is_last)
+        return _join_lines(iter_pieces())
 
-        return list_str
+def _iter_list_slots(items):
+    for i, item in enumerate(items):
+        yield item, _item_setter(items, i)
 
-def _replace_list(objs, pattern, repl, **kwargs):
-    return [
-            replace_text(x, pattern, repl, **kwargs) if x else x
-            for x in objs
-    ]
+def _cache_key_list(objs):
+    return tuple(_get_cache_key(x) for x in objs)
 
 def _abbreviate_cls_name(abbrevs):
     def cls(self):
@@ -66,6 +73,11 @@ class List(Formatter):
     default_br = '\n'
     force_alignment = True
 
+    # Lists that are made on the fly (e.g. by `Protocol.iter_lines()`) can 
+    # set this to false, so that they don't keep a copy of every line they 
+    # render.  The items themselves are still cached.
+    _cacheable = True
+
     @classmethod
     def from_iterable(cls, items, **kwargs):
         return cls(*items, **kwargs)
@@ -97,8 +109,8 @@ class List(Formatter):
         self._items.append(item)
         return self
 
-    def _format_items(self, width, *, indents, **kwargs):
-        return _format_list(
+    def _iter_items(self, width, *, indents, **kwargs):
+        return _iter_list_lines(
                 items=self._items,
                 indents=indents,
                 width=width,
@@ -107,10 +119,13 @@ class List(Formatter):
                 **kwargs,
         )
 
-    def replace_text(self, pattern, repl, **kwargs):
-        self._items = _replace_list(
-                self._items, pattern, repl, **kwargs,
-        )
+    def _iter_text_slots(self):
+        return _iter_list_slots(self._items)
+
+    def _cache_key(self):
+        if not self._cacheable:
+            raise _Uncacheable
+        return self.br, _cache_key_list(self._items)
 
     __repr__ = repr_from_init(
             cls=_abbreviate_cls_name({
@@ -133,8 +148,8 @@ class paragraph_list(List):
     def __init__(self, *items, br=None):
         super().__init__(*items, br=br)
 
-    def format_text(self, width, **kwargs):
-        return self._format_items(
+    def iter_lines(self, width, **kwargs):
+        return self._iter_items(
                 width,
                 indents=repeat(('', '')),
                 **kwargs,
@@ -147,8 +162,11 @@ class unordered_list(List):
         super().__init__(*items, br=br)
         self.prefix = prefix
 
-    def format_text(self, width, **kwargs):
-        return self._format_items(
+    def _cache_key(self):
+        return self.prefix, super()._cache_key()
+
+    def iter_lines(self, width, **kwargs):
+        return self._iter_items(
                 width,
                 indents=repeat((self.prefix, ' ' * len(self.prefix))),
                 **kwargs,
@@ -163,7 +181,11 @@ class ordered_list(List):
         self.start = start
         self.indices = indices
 
-    def format_text(self, width, **kwargs):
+    def _cache_key(self):
+        indices = self.indices and tuple(self.indices)
+        return self.prefix, self.start, indices, super()._cache_key()
+
+    def iter_lines(self, width, **kwargs):
         indices = self.indices or range(self.start, self.start + len(self))
         indices = list(indices)
 
@@ -175,7 +197,7 @@ class ordered_list(List):
         prefix_lens = (len(self.prefix.format(i)) for i in indices)
         max_prefix_len = n = max(prefix_lens, default=0)
 
-        return self._format_items(
+        return self._iter_items(
                 width,
                 indents=(
                     (f'{self.prefix.format(i):>{n}}', ' ' * n)
@@ -236,8 +258,8 @@ class definition_list(Formatter):
         self._values.append(value)
         return self
 
-    def format_text(self, width, **kwargs):
-        return _format_list(
+    def iter_lines(self, width, **kwargs):
+        return _iter_list_lines(
                 items=self._values,
                 indents=(
                     (self.prefix.format(k), self.indent)
@@ -248,11 +270,20 @@ class definition_list(Formatter):
                 **kwargs,
         )
 
-    def replace_text(self, pattern, repl, **kwargs):
-        objs = interleave(self._keys, self._values)
-        objs = _replace_list(objs, pattern, repl, **kwargs)
-        self._keys, self._values = map(list, zip(*chunked(objs, 2))) \
-                if objs else ([], [])
+    def _iter_text_slots(self):
+        return interleave(
+                _iter_list_slots(self._keys),
+                _iter_list_slots(self._values),
+        )
+
+    def _cache_key(self):
+        return (
+                self._prefix,
+                self._indent,
+                self.br,
+                tuple(self._keys),
+                _cache_key_list(self._values),
+        )
 
     @property
     def prefix(self):
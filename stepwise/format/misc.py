@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-from .format import Formatter, replace_text, _align_indents_if_possible
+from .format import Formatter, _align_indents_if_possible
+from .layout import split_preformatted
 from .lists import paragraph_list, unordered_list
 from more_itertools import mark_ends
 from reprfunc import repr_from_init
@@ -23,7 +24,7 @@ class preformatted(Formatter):
         initial_indent = kwargs.get('initial_indent', '')
         subsequent_indent = kwargs.get('subsequent_indent', '')
 
-        lines = self.content.splitlines(True)
+        lines = split_preformatted(self.content)
 
         if len(lines) == 0:
             return initial_indent
@@ -32,18 +33,27 @@ class preformatted(Formatter):
             return initial_indent + lines[0]
 
         if not aligned:
-            lines = ['\n', *lines]
+            lines = ('\n', *lines)
 
-        out = ''
-        for is_first, _, line in mark_ends(lines):
-            out += initial_indent if is_first else subsequent_indent
-            out += line
+        return ''.join(
+                (initial_indent if is_first else subsequent_indent) + line
+                for is_first, _, line in mark_ends(lines)
+        )
 
-        return out
+    def _iter_text_slots(self):
+        # Replacing text could mess up the formatting.
+        def setter(content):
+            self.content = content
 
-    def replace_text(self, pattern, repl, **kwargs):
-        # This could mess up the formatting.
-        self.content = replace_text(self.content, pattern, repl, **kwargs)
+        yield self.content, setter
+
+    def canonical_text(self):
+        # This is the same as `format_text(self, inf)`, because there are no 
+        # indents to align.
+        return self.content
+
+    def _cache_key(self):
+        return self.content
 
     __repr__ = repr_from_init(cls='pre', positional=['content'])
 
@@ -1,14 +1,14 @@
 #!/usr/bin/env python3
 
 from math import ceil, inf
+from functools import lru_cache
 from textwrap import shorten
 from shutil import get_terminal_size
-from itertools import repeat, zip_longest
+from itertools import repeat, islice, zip_longest
 from more_itertools import only
 from reprfunc import repr_from_init
 from inform import plural
-from .format import Formatter
-from .lists import _replace_list
+from .format import Formatter, _Uncacheable
 from .misc import preformatted
 
 _style = {
@@ -60,7 +60,10 @@ class table(Formatter):
         )
 
     def format_text(self, width, **kwargs):
-        truncate_width = kwargs.get('truncate_width')
+        # Fit the table to the given width (rather than to the terminal), so 
+        # that the text depends only on the arguments.  This is what allows 
+        # the text to be cached.
+        page_width = kwargs.get('truncate_width') or width
 
         table = tabulate(
                 rows=self.rows,
@@ -70,23 +73,71 @@ class table(Formatter):
                 align=self.align,
                 truncate=self.truncate,
                 max_width=self.max_width,
-                page_width=kwargs.get('truncate_width'),
+                page_width=page_width,
                 style=self.style,
         )
         return preformatted(table).format_text(width, **kwargs)
 
-    def replace_text(self, pattern, repl, **kwargs):
-
-        def replace_row(row):
-            return _replace_list(row, pattern, repl, **kwargs)
+    def _iter_text_slots(self):
+        # Reading the text shouldn't change the table, so the rows are only 
+        # copied into new lists (which can be modified) once a cell in them is 
+        # actually replaced.  Each row is copied at most once.
+        copies = {}
+
+        def get_row_copy(key):
+            if key not in copies:
+                if key in ('header', 'footer'):
+                    row = list(getattr(self, key))
+                    setattr(self, key, row)
+                else:
+                    if 'rows' not in copies:
+                        self.rows = copies['rows'] = list(self.rows)
+                    row = self.rows[key] = list(self.rows[key])
+                copies[key] = row
+            return copies[key]
+
+        def cell_setter(key, j):
+            def setter(value):
+                get_row_copy(key)[j] = value
+            return setter
+
+        def iter_row_slots(key, row):
+            for j, cell in enumerate(row):
+                yield cell, cell_setter(key, j)
 
         if self.header:
-            self.header = replace_row(self.header)
+            yield from iter_row_slots('header', self.header)
 
-        self.rows = [replace_row(row) for row in self.rows]
+        for i, row in enumerate(self.rows):
+            yield from iter_row_slots(i, row)
 
         if self.footer:
-            self.footer = replace_row(self.footer)
+            yield from iter_row_slots('footer', self.footer)
+
+    def _cache_key(self):
+        def tuple_or_none(x):
+            return x if x is None or x is True else tuple(x)
+
+        # Other kinds of cells might be mutable, or might not compare equal 
+        # exactly when they'd be formatted the same way, so only cache tables 
+        # made entirely of strings.
+        def cells(row):
+            row = tuple_or_none(row)
+            if row not in (None, True):
+                if not all(isinstance(x, str) for x in row):
+                    raise _Uncacheable
+            return row
+
+        return (
+                tuple(cells(row) for row in self.rows),
+                cells(self.header),
+                cells(self.footer),
+                tuple_or_none(self.format),
+                tuple_or_none(self.align),
+                tuple_or_none(self.truncate),
+                self.max_width,
+                tuple(self.style.items()),
+        )
 
     __repr__ = repr_from_init(
             positional=['rows'],
@@ -107,6 +158,7 @@ def tabulate(
         max_width=None,
         page_width=None,
         style=_style,
+        file=None,
 ):
     """
     Format tabular information.
@@ -130,9 +182,12 @@ def tabulate(
             not specified, or if the columns specified by `truncate` cannot are 
             too narrow to make up the difference.
         style (dict): Miscellaneous parameters used to render the table.
+        file (file-like): If given, write each line of the table to this 
+            stream as soon as it's formatted, rather than returning the whole 
+            table as a string.  This is useful for very large tables.
 
     Return:
-        table (str): The formatted table.
+        table (str): The formatted table, or None if *file* was given.
 
     Example:
         >>> import stepwise
@@ -144,6 +199,43 @@ def tabulate(
         enzyme   1 µL
         buffer   2 µL
 
+    """
+    lines = iter_tabulate(
+            rows,
+            header,
+            footer,
+            format=format,
+            align=align,
+            truncate=truncate,
+            max_width=max_width,
+            page_width=page_width,
+            style=style,
+    )
+
+    if file is None:
+        return '\n'.join(lines)
+
+    for i, line in enumerate(lines):
+        if i: file.write('\n')
+        file.write(line)
+
+def iter_tabulate(
+        rows,
+        header=None,
+        footer=None,
+        *,
+        format=None,
+        align=None, 
+        truncate=None,
+        max_width=None,
+        page_width=None,
+        style=_style,
+):
+    """
+    Yield the lines of the table that would be returned by `tabulate()`.
+
+    Every row must be converted to a string and measured before the first 
+    line can be formatted, but no further copies of the table are made.
     """
     table_unfmt, i_header, i_footer = _concat_rows(
             rows,
@@ -158,39 +250,129 @@ def tabulate(
             style['pad'],
     )
     col_alignments = align or _auto_align(rows)
+    format_row = _make_row_formatter(col_widths, col_alignments, style)
+
+    rule = style['rule'] * table_width
+
+    for i, row in enumerate(table_unfmt):
+        if header and i == i_header:
+            yield rule
+        if footer and i == i_footer:
+            yield rule
+        yield format_row(row)
+
+    # The header and footer rules can come after the last row, e.g. if the 
+    # table has a header but no body.
+    n = len(table_unfmt)
+    if header and i_header == n:
+        yield rule
+    if footer and i_footer == n:
+        yield rule
+
+def iter_tabulate_stream(
+        rows,
+        header=None,
+        *,
+        format=None,
+        align=None,
+        truncate=None,
+        min_widths=None,
+        sample_size=100,
+        max_width=None,
+        page_width=None,
+        style=_style,
+):
+    """
+    Yield the lines of a table whose rows are produced incrementally.
+
+    Unlike `iter_tabulate()`, this function doesn't need to see every row 
+    before yielding the first line.  Instead, the column widths (and 
+    alignments, if not specified) are determined from the first *sample_size* 
+    rows.  Later cells that are too wide for their columns are truncated if 
+    the column can be truncated, and allowed to overflow otherwise.  Use 
+    *min_widths* to reserve space for values that are known to appear later in 
+    the table, e.g. large id numbers.
+
+    If there are no more than *sample_size* rows, the output is identical to 
+    that of `iter_tabulate()`.
+    """
+    rows = iter(rows)
+    sample = list(islice(rows, sample_size))
+
+    if header is True:
+        header, *sample = sample
+        sample.extend(islice(rows, 1))
+
+    sample_unfmt, i_header, _ = _concat_rows(sample, header, None, format)
+    measure_unfmt = sample_unfmt
+
+    if min_widths:
+        measure_unfmt = [*sample_unfmt, [' ' * x for x in min_widths]]
+
+    col_widths, table_width = _measure_cols(
+            measure_unfmt,
+            truncate,
+            _eval_max_width(max_width, page_width),
+            style['pad'],
+    )
+    col_alignments = align or _auto_align(sample) or repeat('<')
+    col_truncatable = [x == 'x' for x in truncate or ()] or repeat(False)
+
+    format_row = _make_row_formatter(col_widths, col_alignments, style)
+    format_overflow_row = _make_row_formatter(
+            col_widths,
+            col_alignments,
+            style,
+            col_truncatable,
+    )
+    rule = style['rule'] * table_width
+
+    for i, row in enumerate(sample_unfmt):
+        if header and i == i_header:
+            yield rule
+        yield format_row(row)
+
+    if header and i_header == len(sample_unfmt):
+        yield rule
+
+    for row in rows:
+        for row_unfmt in _split_row(_format_cells(row, format)):
+            yield format_overflow_row(row_unfmt)
+
+def _make_row_formatter(col_widths, col_alignments, style, col_truncatable=None):
+    """
+    Return a function that formats a row of strings as a line of the table.
+
+    By default, every cell that doesn't fit in its column is truncated.  If 
+    *col_truncatable* is given, cells that don't fit in the columns it 
+    indicates are left intact instead.
+    """
+    pad = style['pad'] * ' '
+    dots = style['placeholder']
+
+    if col_truncatable is None:
+        col_truncatable = repeat(True)
+
+    # Materialize the arguments, since some may be infinite iterators.
+    col_args = list(zip(col_widths, col_alignments, col_truncatable))
 
     def format_row(row):
         cells = [
                 format_cell(*args)
-                for args in zip(row, col_widths, col_alignments)
+                for args in zip(row, col_args)
         ]
-        pad = style['pad'] * ' '
         return pad.join(cells).rstrip()
 
-    def format_cell(cell, width, align):
-        if len(cell) > width:
+    def format_cell(cell, col):
+        width, align, truncatable = col
+        if truncatable and len(cell) > width:
             if ' ' in cell:
-                cell = shorten(cell, width=width, placeholder=style['placeholder'])
+                cell = shorten(cell, width=width, placeholder=dots)
             else:
-                dots = style['placeholder']
                 cell = cell[:width - len(dots)] + dots
         return f'{cell:{align}{width}}'
 
-
-    table_fmt = [
-        format_row(x)
-        for x in table_unfmt
-    ]
-
-    # Add the footer first, because it won't affect the header index.
-    rule = style['rule'] * table_width
-    if footer:
-        table_fmt.insert(i_footer, rule)
-    if header:
-        table_fmt.insert(i_header, rule)
-
-    return '\n'.join(table_fmt)
-
+    return format_row
 
 def _concat_rows(rows, header, footer, format):
     """
@@ -212,12 +394,7 @@ def _concat_rows(rows, header, footer, format):
         rows = rows[:-1]
 
     def process(row, format=None, *, valign='top'):
-        if not format:
-            format = [str] * len(row)
-        if len(format) != len(row):
-            raise ValueError(f"given {plural(format):# formatter/s}, expected {len(row)}")
-
-        row = [fmt(x) for x, fmt in zip(row, format)]
+        row = _format_cells(row, format)
         row = _split_row(row, valign)
         table.extend(row)
 
@@ -236,10 +413,24 @@ def _concat_rows(rows, header, footer, format):
 
     return table, i_header, i_footer
 
+def _format_cells(row, format=None):
+    """
+    Convert each value in the given row to a string.
+    """
+    if not format:
+        return [str(x) for x in row]
+    if len(format) != len(row):
+        raise ValueError(f"given {plural(format):# formatter/s}, expected {len(row)}")
+
+    return [fmt(x) for x, fmt in zip(row, format)]
+
 def _split_row(row, align='top'):
     """
     Resolve any newlines in the given row.
     """
+    if row and not any('\n' in x for x in row):
+        return [row]
+
     align_funcs = {
             'top': lambda x: x,
             'bottom': reversed,
@@ -262,23 +453,37 @@ def _auto_align(rows):
         return all(map(is_numeric, xs))
 
     def is_numeric(x):
-        from stepwise import Quantity
-
-        try: float(x)
-        except ValueError: pass
-        else: return True
+        if isinstance(x, (int, float)):
+            return True
 
-        try: Quantity.from_anything(x)
-        except ValueError: pass
-        else: return True
-
-        return False
+        # Large tables tend to repeat the same values many times, and parsing 
+        # quantities is relatively expensive, so remember the result for any 
+        # values that can be hashed.
+        try:
+            return _is_numeric_cached(x)
+        except TypeError:
+            return _is_numeric(x)
 
     return [
             '>' if is_col_numeric(col) else '<'
             for col in zip(*rows)
     ]
 
+def _is_numeric(x):
+    from stepwise import Quantity
+
+    try: float(x)
+    except ValueError: pass
+    else: return True
+
+    try: Quantity.from_anything(x)
+    except ValueError: pass
+    else: return True
+
+    return False
+
+_is_numeric_cached = lru_cache(maxsize=2**12)(_is_numeric)
+
 def _eval_max_width(max_width, page_width):
     if not page_width:
         page_width = get_terminal_size().columns - 1
@@ -319,18 +524,58 @@ def _measure_cols(table, truncate, max_width, pad):
     if not trunc_cols:
         return col_widths, table_width
 
-    # There's probably a smarter/faster way to do this...
-
-    while overfull_width > 0:
-        widest_col = max(
-                trunc_cols, 
-                key=lambda i: col_widths[i],
-        )
-        col_widths[widest_col] -= 1
-        overfull_width -= 1
+    widths = _shrink_widest(
+            [col_widths[i] for i in trunc_cols],
+            overfull_width,
+    )
+    for i, width in zip(trunc_cols, widths):
+        col_widths[i] = width
 
     return col_widths, sum_col_widths()
 
+def _shrink_widest(widths, excess):
+    """
+    Reduce the sum of the given widths by *excess*, always taking from the 
+    widest column.
+
+    This is equivalent to repeatedly subtracting 1 from the widest column (or 
+    the first of the widest columns, in the case of ties) *excess* times, but 
+    is calculated in closed form, i.e. by "water-filling" the columns down to 
+    a common level.
+    """
+    if excess <= 0 or not widths:
+        return widths
+
+    # Find the number of columns, k, that must be cut down to a common level, 
+    # and then what that level is.  The k widest columns can be cut down to 
+    # the width of the next widest column without touching any other columns.
+
+    desc = sorted(widths, reverse=True)
+    total = 0
+
+    for k, width in enumerate(desc, 1):
+        total += width
+        next_width = desc[k] if k < len(desc) else None
+        if next_width is None or total - k * next_width >= excess:
+            break
+
+    level = -((excess - total) // k)  # ceil((total - excess) / k)
+    remainder = excess - (total - k * level)
+
+    # Any columns that end up at the common level are tied.  Ties are broken 
+    # by taking from the leftmost columns first.
+
+    shrunk = []
+    for width in widths:
+        if width >= level:
+            width = level
+            if remainder:
+                width -= 1
+                remainder -= 1
+        shrunk.append(width)
+
+    return shrunk
+
 def _count_cols(table):
     """
     Return the number of columns in the table.
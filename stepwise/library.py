@@ -134,6 +134,25 @@ class Library:
                 if score == best_score
         ]
 
+    def iter_entries(self, tag=None):
+        """
+        Yield the best-scoring entries matching the given tag, as soon as 
+        possible.
+
+        If no tag is given, every entry matches equally well, so the entries 
+        from each collection are yielded as soon as that collection is loaded.  
+        Otherwise, every collection must be searched before it's possible to 
+        know which entries match best, so this is no faster than 
+        `find_entries()`.
+        """
+        if tag is not None:
+            yield from self.find_entries(tag)
+            return
+
+        for collection in self.collections:
+            for _, entry in collection.find_entries(tag):
+                yield entry
+
     def find_entry(self, tag):
         """
         Return the single entry matching the given tag.
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
 import sys
+import os
+import json
+import time
 import shlex
 import byoc
 import autoprop
 
+from math import inf
+from pathlib import Path
 from inform import warn, format_range
 from .config import StepwiseConfig, PresetConfig
 from .errors import *
@@ -37,9 +42,21 @@ class Printer:
             PresetConfig,
             default=10,
     )
+    renderer = byoc.param(
+            PresetConfig,
+            default=None,
+    )
+    font_size = byoc.param(
+            PresetConfig,
+            default=12,
+    )
+    paper = byoc.param(
+            PresetConfig,
+            default='letter',
+    )
     paps_flags = byoc.param(
             PresetConfig,
-            default='--font "FreeMono 12" --paper letter --left-margin 0 --right-margin 0 --top-margin 12 --bottom-margin 12',
+            default=None,
     )
     lpr_flags = byoc.param(
             PresetConfig,
@@ -47,7 +64,16 @@ class Printer:
     )
 
     def __init__(self, preset=None):
-        self.preset = preset or get_default_printer_name()
+        self._preset = preset
+
+    def get_preset(self):
+        # Don't look up the default printer until it's actually needed.
+        if self._preset is None:
+            self._preset = get_default_printer_name()
+        return self._preset
+
+    def set_preset(self, preset):
+        self._preset = preset
 
     def get_name(self):
         return self.preset
@@ -93,46 +119,15 @@ class Printer:
 
         The return value is a list of "pages", where each page is a list of lines 
         (without trailing newlines).
+
+        Paragraphs (i.e. runs of non-blank lines) are never split between 
+        pages, and two consecutive blank lines always start a new page.  
+        Otherwise, the paragraphs are arranged to use as few pages as 
+        possible, and then to make the pages as evenly filled as possible.
         """
         pages = []
-        current_page = []
-        skip_next_line = False
-
-        def add_page(current_page):
-            if any(line.strip() for line in current_page):
-                pages.append(current_page[:])
-            current_page[:] = []
-
-        for i, line_i in enumerate(lines):
-
-            if skip_next_line:
-                skip_next_line = False
-                continue
-
-            # If the line isn't blank, add it to the current page like usual.
-
-            if line_i.strip():
-                current_page.append(line_i)
-
-            # If the line is blank, find the next blank line and see if it fits on 
-            # the same page.  If it does, add the blank line to the page and don't 
-            # do anything special.  If it doesn't, make a new page.  Also interpret 
-            # two consecutive blank lines as a page break.
-
-            else:
-                for j, line_j in enumerate(lines[i+1:], i+1):
-                    if not line_j.strip():
-                        break
-                else:
-                    j = len(lines)
-
-                if len(current_page) + (j-i) > self.page_height or j == i+1:
-                    skip_next_line = (j == i+1)
-                    add_page(current_page)
-                elif current_page:
-                    current_page.append(line_i)
-
-        add_page(current_page)
+        for paragraphs, separators in _find_paragraphs(lines):
+            pages += _break_pages(paragraphs, separators, self.page_height)
         return pages
 
     def add_margin(self, pages):
@@ -142,22 +137,88 @@ class Printer:
         left_margin = ' ' * self.margin_width + '│ '
         return [[left_margin + line for line in page] for page in pages]
 
+    def render_pages(self, pages, format='ps'):
+        """
+        Render the given pages as a PostScript (``format='ps'``) or PDF 
+        (``format='pdf'``) document, and return the resulting bytes.
+
+        The pages are rendered in-process using a monospace font, so this 
+        doesn't depend on any external programs.
+        """
+        from .render import render_postscript, render_pdf
+
+        renderers = {
+                'ps': render_postscript,
+                'pdf': render_pdf,
+        }
+        try:
+            render = renderers[format]
+        except KeyError:
+            raise UsageError(f"unknown document format: {format!r}") from None
+
+        return render(
+                pages,
+                font_size=self.font_size,
+                paper=self.paper,
+                lines_per_page=self.page_height,
+        )
+
+    def write_pages(self, pages, path):
+        """
+        Render the given pages to a PostScript or PDF file, depending on the 
+        file extension of the given path.
+        """
+        from pathlib import Path
+
+        path = Path(path)
+        format = 'pdf' if path.suffix.lower() == '.pdf' else 'ps'
+        path.write_bytes(self.render_pages(pages, format))
+
     def print_pages(self, pages):
         """
         Print the given pages.
         """
+        renderer = self.renderer
+
+        # Presets that were set up for `paps` (i.e. before the builtin 
+        # renderer existed) should keep using it.
+        if renderer is None:
+            renderer = 'paps' if self.paps_flags is not None else 'builtin'
+
+        if renderer == 'paps':
+            return self._print_pages_paps(pages)
+        if renderer != 'builtin':
+            raise UsageError(f"unknown renderer: {renderer!r}", codicil="expected 'builtin' or 'paps'")
+
+        from subprocess import run
+        run(self._get_lpr_cmd(), input=self.render_pages(pages))
+
+    def _print_pages_paps(self, pages):
         from subprocess import Popen, PIPE
         form_feed = ''
         document = form_feed.join(
                 ('\n'.join(x) for x in pages)
         ).encode()
+        paps_flags = self.paps_flags
+        if paps_flags is None:
+            paps_flags = DEFAULT_PAPS_FLAGS
+
         print_cmd = ' | '.join([
-                f'paps {self.paps_flags}',
-                f'lpr -P {self.preset} {self.lpr_flags}',
+                f'paps {paps_flags}',
+                shlex.join(self._get_lpr_cmd()),
         ])
         lpr = Popen(print_cmd, shell=True, stdin=PIPE)
         lpr.communicate(input=document)
 
+    def _get_lpr_cmd(self):
+        # If there's no default printer, let `lpr` decide what to do.
+        preset = self.preset
+        return [
+                'lpr',
+                *(['-P', preset] if preset else []),
+                *shlex.split(self.lpr_flags),
+        ]
+
     def print_files(self, files):
         from subprocess import run
 
@@ -169,38 +230,401 @@ def format_protocol(protocol, printer=None, **kwargs):
     printer = printer or Printer()
     return protocol.format_text(printer.content_width, **kwargs)
 
+def iter_protocol_lines(protocol, printer=None, **kwargs):
+    printer = printer or Printer()
+    return protocol.iter_lines(printer.content_width, **kwargs)
+
 def print_protocol(protocol, printer):
-    text = format_protocol(
-            protocol, printer,
-            truncate_width=printer.page_width - printer.margin_width,
-    )
-    lines = text.splitlines()
-    lines = printer.truncate_lines(lines)
+    pages = make_protocol_pages(protocol, printer)
+    printer.print_pages(pages)
+    printer.print_files(protocol.attachments)
 
-    try:
-        printer.check_for_long_lines(lines)
-    except PrinterWarning as err:
-        err.report(informant=warn)
+def make_protocol_pages(protocol, printer):
+    """
+    Format the given protocol and divide it into pages (with margins) for the 
+    given printer.
+    """
+    return ProtocolLayout(protocol, printer).pages
 
-    pages = printer.make_pages(lines)
-    pages = printer.add_margin(pages)
+@autoprop
+class ProtocolLayout:
+    """
+    A protocol formatted for a particular printer.
+
+    The result is available both as a list of lines (e.g. for writing to a 
+    text file) and as a list of pages with margins (e.g. for printing).  The 
+    lines are the full protocol, while the pages are formatted to fit on the 
+    paper (e.g. wide tables are truncated).  Each is computed just once, the 
+    first time it's needed, and shared by every output that needs it.
+    """
+
+    def __init__(self, protocol, printer=None):
+        self.protocol = protocol
+        self.printer = printer or Printer()
+        self._lines = None
+        self._pages = None
+
+    def get_lines(self):
+        if self._lines is None:
+            self._lines = list(iter_protocol_lines(self.protocol, self.printer))
+        return self._lines
+
+    def get_pages(self):
+        if self._pages is None:
+            printer = self.printer
+            lines = iter_protocol_lines(
+                    self.protocol, printer,
+                    truncate_width=printer.page_width - printer.margin_width,
+            )
+            lines = printer.truncate_lines(lines)
+
+            try:
+                printer.check_for_long_lines(lines)
+            except PrinterWarning as err:
+                err.report(informant=warn)
+
+            pages = printer.make_pages(lines)
+            self._pages = printer.add_margin(pages)
+
+        return self._pages
+
+class OutputPipeline:
+    """
+    Format a protocol, then send it to any number of destinations.
+
+    Each destination is a "sink" object with a `needs_pages` attribute and a 
+    `write(layout)` method, which receives a `ProtocolLayout` and returns a 
+    message to show the user (or None).  The sinks run concurrently, since 
+    most of them spend their time waiting on the file system or on other 
+    processes.
+    """
+
+    def __init__(self, protocol, printer=None, sinks=()):
+        self.layout = ProtocolLayout(protocol, printer)
+        self.sinks = list(sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def run(self):
+        """
+        Send the protocol to every sink, and return the resulting messages (in 
+        the same order as the sinks).
 
-    printer.print_pages(pages)
-    printer.print_files(protocol.attachments)
+        If any sink fails, the others are still allowed to finish before the 
+        first error is raised.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if not self.sinks:
+            return []
+
+        # Do all the formatting up front, so that any warnings are reported 
+        # once, and so that the sinks don't race to fill in the layout.
+        layout = self.layout
+        if not all(x.needs_pages for x in self.sinks):
+            layout.lines
+        if any(x.needs_pages for x in self.sinks):
+            layout.pages
+
+        if len(self.sinks) <= 1:
+            return [x.write(layout) for x in self.sinks]
+
+        with ThreadPoolExecutor(max_workers=len(self.sinks)) as executor:
+            futures = [executor.submit(x.write, layout) for x in self.sinks]
+
+        return [x.result() for x in futures]
+
+class TextFileSink:
+    """
+    Write the formatted protocol to a plain text file.
+    """
+    needs_pages = False
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, layout):
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(layout.lines))
+        return f"Protocol saved to '{self.path}'"
+
+class DocumentSink:
+    """
+    Write the paginated protocol to a PostScript or PDF file.
+    """
+    needs_pages = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, layout):
+        layout.printer.write_pages(layout.pages, self.path)
+        return f"Protocol saved to '{self.path}'"
+
+class PrinterSink:
+    """
+    Send the paginated protocol (and any attachments) to the printer.
+    """
+    needs_pages = True
+
+    def write(self, layout):
+        printer = layout.printer
+        printer.print_pages(layout.pages)
+        printer.print_files(layout.protocol.attachments)
+        return f"Protocol sent to '{printer.name}'"
+
+class QueueSink:
+    """
+    Add the paginated protocol (and any attachments) to the print queue.
+    """
+    needs_pages = True
+
+    def __init__(self, queue=None):
+        self.queue = queue
+
+    def write(self, layout):
+        from .spool import PrintQueue
+
+        queue = self.queue or PrintQueue()
+        job = queue.add_pages(
+                layout.pages,
+                layout.printer,
+                attachments=layout.protocol.attachments,
+                name=layout.protocol.pick_slug(),
+        )
+        return f"Protocol queued for '{layout.printer.name}' ({job.id})"
+
+def file_sink(path):
+    """
+    Return the appropriate sink for writing to the given path, based on its 
+    file extension.
+    """
+    if Path(path).suffix.lower() in ('.ps', '.pdf'):
+        return DocumentSink(path)
+    else:
+        return TextFileSink(path)
+
+def _find_paragraphs(lines):
+    """
+    Divide the given lines into sections that must start on new pages, and 
+    divide each section into paragraphs.
+
+    Each section is yielded as a tuple of two lists: the paragraphs (each a 
+    list of lines) and the blank lines separating them.  Sections are 
+    separated by two or more consecutive blank lines.  Blank lines at the 
+    beginning or end of a section are dropped.
+    """
+    paragraphs = []
+    separators = []
+    paragraph = []
+    i, n = 0, len(lines)
+
+    while i < n:
+        if lines[i].strip():
+            paragraph.append(lines[i])
+            i += 1
+            continue
+
+        j = i + 1
+        while j < n and not lines[j].strip():
+            j += 1
+
+        if paragraph:
+            paragraphs.append(paragraph)
+            paragraph = []
+
+        # A single blank line separates paragraphs; two or more (or blank 
+        # lines at the very end) end the section.
+        if j - i == 1 and j < n:
+            if paragraphs:
+                separators.append(lines[i])
+        elif paragraphs:
+            yield paragraphs, separators
+            paragraphs, separators = [], []
+
+        i = j
+
+    if paragraph:
+        paragraphs.append(paragraph)
+    if paragraphs:
+        yield paragraphs, separators
+
+def _break_pages(paragraphs, separators, page_height):
+    """
+    Arrange the given paragraphs into pages.
+
+    The pages are chosen by dynamic programming.  The primary goal is to use 
+    as few pages as possible, and the secondary goal is to minimize the sum of 
+    the squares of the number of unused lines on each page.  Ties are broken 
+    in favor of putting more content on earlier pages.  A paragraph that is 
+    too long to fit on any page gets a page to itself.
+
+    The running time is linear in the number of paragraphs, since no page can 
+    hold more than about half as many paragraphs as it has lines.
+    """
+    n = len(paragraphs)
+    heights = [len(x) for x in paragraphs]
+
+    # best[i]: the cost of laying out paragraphs i and beyond, as a tuple of 
+    # (number of pages, sum of squared slack).  next_page[i]: the first 
+    # paragraph of the page after the one starting with paragraph i.
+    best = [None] * n + [(0, 0)]
+    next_page = [None] * n
+
+    for i in reversed(range(n)):
+        used = -1
+        for j in range(i + 1, n + 1):
+            used += heights[j - 1] + 1
+            if used > page_height and j > i + 1:
+                break
+
+            slack = max(page_height - used, 0)
+            num_pages, sum_slack2 = best[j]
+            cost = num_pages + 1, sum_slack2 + slack**2
+
+            if best[i] is None or cost <= best[i]:
+                best[i] = cost
+                next_page[i] = j
+
+    pages = []
+    i = 0
+
+    while i < n:
+        j = next_page[i]
+        page = list(paragraphs[i])
+        for k in range(i + 1, j):
+            page.append(separators[k - 1])
+            page += paragraphs[k]
+        pages.append(page)
+        i = j
+
+    return pages
 
 def get_default_printer_name():
+    """
+    Return the name of the system's default printer, or None if there isn't 
+    one.
+
+    The result is cached; see `discover_printers()`.
+    """
+    return discover_printers()['default']
+
+def get_printer_names():
+    """
+    Return the names of all the printers known to the system.
+
+    The result is cached; see `discover_printers()`.
+    """
+    return discover_printers()['printers']
+
+def discover_printers():
+    """
+    Ask CUPS which printers are available, and which is the default.
+
+    Running `lpstat` takes long enough to be noticeable, and the answer rarely 
+    changes, so the result is cached both in memory and on disk (so that it 
+    can be shared between commands).  The cache expires after 
+    `PRINTER_CACHE_TTL` seconds, or as soon as any of the CUPS configuration 
+    files (or environment variables) that affect the answer change.
+
+    Returns:
+        dict: A dictionary with keys 'default' (the name of the default 
+        printer, or None) and 'printers' (a list of printer names).
+    """
+    global _printer_cache
+
+    stamp = _get_cups_stamp()
+    now = time.time()
+
+    def is_fresh(cache):
+        return (
+                cache is not None and
+                cache.get('stamp') == stamp and
+                0 <= now - cache.get('time', -inf) < PRINTER_CACHE_TTL
+        )
+
+    if is_fresh(_printer_cache):
+        return _printer_cache
+
+    path = _get_printer_cache_path()
+
+    try:
+        cache = json.loads(path.read_text())
+    except (OSError, ValueError):
+        cache = None
+
+    if not is_fresh(cache):
+        cache = {
+                **_query_printers(),
+                'time': now,
+                'stamp': stamp,
+        }
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(cache))
+        except OSError:
+            pass
+
+    _printer_cache = cache
+    return cache
+
+def _query_printers():
     import re
     from subprocess import run
 
-    lpstat = shlex.split('lpstat -d')
+    lpstat = shlex.split('lpstat -d -p')
     try:
         p = run(lpstat, capture_output=True, text=True)
     except FileNotFoundError:
-        return None
-
-    if p.returncode == 0:
-        m = re.match(r'system default destination: (.*)$', p.stdout)
-        return m.group(1).strip() if m else None
-    else:
-        return None
-
+        return {'default': None, 'printers': []}
+
+    m = re.search(r'^system default destination: (.*)$', p.stdout, re.MULTILINE)
+    return {
+            'default': m.group(1).strip() if m else None,
+            'printers': re.findall(r'^printer (\S+)', p.stdout, re.MULTILINE),
+    }
+
+def _get_cups_stamp():
+    """
+    Return a JSON-compatible value that will change whenever the default 
+    printer or the list of available printers might have changed.
+    """
+    stamp = []
+
+    for path in _CUPS_CONFIG_PATHS:
+        path = Path(path).expanduser()
+        try:
+            stamp.append([str(path), path.stat().st_mtime])
+        except OSError:
+            pass
+
+    for var in _CUPS_ENV_VARS:
+        stamp.append([var, os.environ.get(var)])
+
+    return stamp
+
+def _get_printer_cache_path():
+    from .config import config_dirs
+    return Path(config_dirs.user_cache_dir) / 'printers.json'
+
+# The flags to pass to `paps`, if that renderer is selected but the preset 
+# doesn't specify any flags.
+DEFAULT_PAPS_FLAGS = '--font "FreeMono 12" --paper letter --left-margin 0 --right-margin 0 --top-margin 12 --bottom-margin 12'
+
+# How long (in seconds) to remember which printers are available.
+PRINTER_CACHE_TTL = 600
+
+_printer_cache = None
+
+_CUPS_CONFIG_PATHS = [
+        '/etc/cups/printers.conf',
+        '/etc/cups/lpoptions',
+        '~/.cups/lpoptions',
+        '~/.lpoptions',
+]
+_CUPS_ENV_VARS = [
+        'CUPS_SERVER',
+        'LPDEST',
+        'PRINTER',
+]
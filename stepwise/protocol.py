@@ -6,7 +6,8 @@ from pathlib import Path
 from math import inf
 from inform import plural, parse_range, format_range
 from .format import paragraph_list, ordered_list, unordered_list, preformatted
-from .format import format_text, replace_text
+from .format import format_text, canonical_text, TextSpans
+from .format.format import _format_cached, _get_cache_key
 from .errors import *
 
 import functools
@@ -47,6 +48,11 @@ class Protocol:
     def __getitem__(self, i):
         return self.steps[i]
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_format_cache', None)
+        return state
+
     @classmethod
     def parse(cls, x):
         """
@@ -217,34 +223,64 @@ class Protocol:
             err.reraise(content='\n'.join(lines))
         
     def format_text(self, width=inf, **kwargs):
-        pl = paragraph_list(
+        # The rendered text is cached, because the same protocol is often 
+        # formatted several times (e.g. `sw go` formats once for the file and 
+        # once for the printer).  Any change to the date, commands, steps, or 
+        # footnotes will invalidate the cache.
+        return _format_cached(
+                self, width, kwargs,
+                lambda: self._format_protocol().format_text(width, **kwargs),
+        )
+
+    def iter_lines(self, width=inf, **kwargs):
+        """
+        Yield the formatted protocol one line at a time.
+
+        This is equivalent to splitting the return value of `format_text()` on 
+        newlines, but doesn't require the whole protocol to be rendered into a 
+        single string first.  Unlike `format_text()`, the result isn't cached, 
+        so only the individual steps are ever held in memory.
+        """
+        yield from self._format_protocol().iter_lines(width, **kwargs)
+
+    def _format_protocol(self):
+        return _uncached(paragraph_list(
                 self._format_date(),
                 self._format_commands(),
                 self._format_steps(),
                 self._format_footnotes(),
+        ))
+
+    def _cache_key(self):
+        return (
+                self.date,
+                tuple(self.commands),
+                tuple(_get_cache_key(x) for x in self.steps),
+                tuple((k, _get_cache_key(v)) for k, v in self.footnotes.items()),
         )
-        return pl.format_text(width, **kwargs)
 
     def _format_date(self):
         if self.date:
             return self.date.format(self.DATE_FORMAT)
 
     def _format_commands(self):
-        return unordered_list(*map(preformatted, self.commands), prefix='$ ')
+        return _uncached(
+                unordered_list(*map(preformatted, self.commands), prefix='$ ')
+        )
 
     def _format_steps(self):
-        return ordered_list(*self.steps)
+        return _uncached(ordered_list(*self.steps))
 
     def _format_footnotes(self):
-        pl = paragraph_list(br='\n')
+        pl = _uncached(paragraph_list(br='\n'))
 
         if self.footnotes:
             pl += f'{plural(self.footnotes):Note/s}:'
-            pl += ordered_list(
+            pl += _uncached(ordered_list(
                     *self.footnotes.values(),
                     indices=self.footnotes.keys(),
                     prefix='[{}] ',
-            )
+            ))
 
         return pl
 
@@ -265,7 +301,6 @@ class Protocol:
         from collections.abc import Iterable
         from math import inf
         from .library import ProtocolIO
-        from .format import format_text
 
         if target is None:
             target = cls()
@@ -316,14 +351,16 @@ class Protocol:
 
         for protocol in protocols:
             p = copy(protocol)
-            f = lambda x: format_text(x, inf)
 
             footnote_map = {}
-            footnote_keys = {f(v): k for k, v in target.footnotes.items()}
+            footnote_keys = {
+                    canonical_text(v): k
+                    for k, v in target.footnotes.items()
+            }
             
             # Avoid duplicate footnotes.
             for i, note in p.footnotes.items():
-                note = f(note)
+                note = canonical_text(note)
                 if note in footnote_keys:
                     footnote_map[i] = footnote_keys[note]
                 else:
@@ -373,16 +410,7 @@ class Protocol:
             sep = '' if m.string[m.end() - 1] == ' ' else ' '
             return m.group() + sep + ref_str
 
-        for i, step in reversed(list(enumerate(self.steps))):
-            state = {}
-            self.steps[i] = replace_text(
-                    step, pattern, sub,
-                    state=state,
-                    count=1,
-            )
-            if state.get('n'):
-                break
-        else:
+        if not self._subn_steps(pattern, sub, count=1, reverse=True):
             raise ValueError(f"pattern {pattern!r} not found in protocol.")
 
         for ref, footnote in zip(refs, footnotes):
@@ -419,10 +447,7 @@ class Protocol:
             jj = [new_ids[i] for i in ii]
             return f'[{format_range(jj)}]'
 
-        self.steps = [
-                replace_text(x, self.FOOTNOTE_REGEX, renumber_footnote)
-                for x in self.steps
-        ]
+        self._subn_steps(self.FOOTNOTE_REGEX, renumber_footnote)
         self.footnotes = {
                 new_ids[k]: v
                 for k,v in self.footnotes.items()
@@ -432,7 +457,7 @@ class Protocol:
         duplicate_ids = {}
 
         for k, v in self.footnotes.items():
-            note = format_text(v, inf)
+            note = canonical_text(v)
             duplicate_ids.setdefault(note, []).append(k)
 
         new_ids = {}
@@ -457,13 +482,10 @@ class Protocol:
                 ref_ids |= parse_range(ref_str)
             return f'[{format_range(ref_ids)}]'
 
-        self.steps = [
-                replace_text(
-                    x, rf'{self.FOOTNOTE_REGEX}(\s*{self.FOOTNOTE_REGEX})+',
-                    merge_footnotes,
-                )
-                for x in self.steps
-        ]
+        self._subn_steps(
+                rf'{self.FOOTNOTE_REGEX}(\s*{self.FOOTNOTE_REGEX})+',
+                merge_footnotes,
+        )
 
     def prune_footnotes(self):
         """
@@ -476,10 +498,13 @@ class Protocol:
         def union(it):
             return set.union(set(), *it)
 
-        formatted_steps = self._format_steps().format_text(inf)
+        # Footnote references can't span multiple lines, so it's safe to 
+        # search each step separately.  This avoids rendering the whole list 
+        # of steps just to find the references.
         referenced_ids = union(
                 parse_range(m.group(1))
-                for m in re.finditer(self.FOOTNOTE_REGEX, formatted_steps)
+                for step in self.steps if step
+                for m in re.finditer(self.FOOTNOTE_REGEX, canonical_text(step))
         )
         self.footnotes = {
                 k: v
@@ -489,12 +514,21 @@ class Protocol:
         self.renumber_footnotes()
 
     def clear_footnotes(self):
-        self.steps = [
-                replace_text(x, rf'\s*{self.FOOTNOTE_REGEX}', '')
-                for x in self.steps
-        ]
+        self._subn_steps(rf'\s*{self.FOOTNOTE_REGEX}', '')
         self.footnotes = {}
 
+    def _subn_steps(self, pattern, repl, **kwargs):
+        """
+        Substitute the given pattern into every step, and return the number 
+        of substitutions made.
+
+        The keyword arguments are passed on to `TextSpans.subn()`.
+        """
+        spans = TextSpans(*self.steps)
+        n = spans.subn(pattern, repl, **kwargs)
+        self.steps = spans.objs
+        return n
+
     def pick_slug(self):
         """
         Return a identifier for this protocol, e.g. that could be used as a 
@@ -543,3 +577,11 @@ class Protocol:
         command = shlex.join(argv).translate(nonprintable)
         self.commands = [command]
 
+
+def _uncached(formatter):
+    """
+    Mark a list formatter that is only made to render the protocol once, so 
+    that it doesn't keep a copy of the whole rendered protocol.
+    """
+    formatter._cacheable = False
+    return formatter
@@ -2,7 +2,7 @@ import autoprop
 import networkx as nx
 
 from .reaction import Reaction, after
-from ..utils import get_memo, repr_join
+from ..utils import CountingMemo, get_memo, repr_join
 from ..errors import UsageError
 
 from itertools import product, combinations
@@ -116,6 +116,246 @@ class PartialMix(frozenset):
 
         return super().__new__(cls, merge_partial_mixes(components))
 
+class ComboMatrix:
+    """
+    The given combos, encoded as a matrix of integers with one row for each 
+    reagent and one column for each combo.
+
+    The purpose of this encoding is to quickly count the number of distinct 
+    combinations of any subset of the reagents, which the mix planner needs to 
+    do for every subset that it considers.  Functions that accept combos will 
+    also accept a `ComboMatrix` in their place, so that the combos only need 
+    to be encoded once.
+    """
+
+    def __init__(self, combos):
+        import numpy as np
+
+        combos = list(combos)
+        reagents = list(unique(flatten(combos)))
+
+        self.num_combos = len(combos)
+        self.rows = {k: i for i, k in enumerate(reagents)}
+        self.codes = np.zeros((len(reagents), len(combos)), dtype=np.int64)
+        self.radices = []
+
+        for i, k in enumerate(reagents):
+            codes = {}
+            for j, combo in enumerate(combos):
+                value = combo.get(k)
+                self.codes[i, j] = codes.setdefault(value, len(codes))
+            self.radices.append(len(codes))
+
+    def count_distinct(self, reagents):
+        rows = [self.rows[k] for k in reagents if k in self.rows]
+        return self.count_distinct_rows(rows)
+
+    def count_distinct_rows(self, rows):
+        import numpy as np
+
+        # Reagents that have the same value in every combo can't distinguish 
+        # any combos.
+        rows = [i for i in rows if self.radices[i] > 1]
+        if not rows:
+            return min(self.num_combos, 1)
+
+        # Pack the codes for each combo into a single integer, so that counting 
+        # the distinct combinations is a single call to `np.unique()`.  If 
+        # there are too many reagents to pack without overflowing, renumber the 
+        # keys packed so far.  There can't be more distinct keys than combos, 
+        # so this always makes room for at least one more reagent.
+        keys = np.zeros(self.num_combos, dtype=np.int64)
+        radix = 1
+
+        for i in rows:
+            if radix * self.radices[i] > 2**62:
+                keys = np.unique(keys, return_inverse=True)[1].ravel()
+                radix = int(keys.max()) + 1
+
+            keys = keys * self.radices[i] + self.codes[i]
+            radix *= self.radices[i]
+
+        return len(np.unique(keys))
+
+class ReagentBits:
+    """
+    Encode sets of reagents as integers, with one bit for each reagent.
+
+    The mix planner spends most of its time taking unions of reagent sets and 
+    looking up the number of combos for each one.  With this encoding, those 
+    are single integer operations, rather than walks through trees of `Mix` 
+    objects.  Components are encoded as follows:
+
+    - Reagents are encoded as an integer with one bit set.
+    - Mixes are encoded as `BitMix` objects.
+    - Partial mixes are encoded as `BitPartialMix` objects.
+
+    Note that adjacencies (see `count_adjacencies()`) are counted between 
+    reagents with consecutive bits, so the reagents should be given in the 
+    order they appear in the reaction.
+    """
+
+    def __init__(self, reagents, combos, careful_reagents=(), memo=None):
+        self.reagents = list(reagents)
+        self.bits = {k: 1 << i for i, k in enumerate(self.reagents)}
+        self.careful = self.encode(careful_reagents)
+
+        # Always memoize the combo counts; the search would be hopelessly slow 
+        # otherwise.  The same memo could be shared between encodings that 
+        # order the reagents differently, so each ordering gets its own counts.
+        if memo is None:
+            memo = {}
+
+        self.matrix = encode_combos(combos)
+        self.rows = [self.matrix.rows.get(k) for k in self.reagents]
+        self.memo = get_memo(memo, (ReagentBits, tuple(self.reagents)))
+
+        # Counting combos is by far the most common memo lookup, and checking 
+        # the memo with `in` would be too slow if the memo is a `CountingMemo`, 
+        # so keep track of hits and misses here instead.
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, reagents):
+        mask = 0
+        for k in reagents:
+            mask |= self.bits.get(k, 0)
+        return mask
+
+    def decode(self, mask):
+        return [k for k, bit in self.bits.items() if mask & bit]
+
+    def encode_component(self, component, filters=()):
+        """
+        Encode the given reagent, mix, or partial mix.
+
+        Mixes that fail any of the given filters are marked as such, so that 
+        `iter_complete_bit_mixes()` won't add them to any other mixes.
+        """
+        if isinstance(component, str):
+            return self.bits[component]
+
+        components = tuple(self.encode_component(x) for x in component)
+
+        if isinstance(component, PartialMix):
+            return BitPartialMix(components)
+        else:
+            ok = all(f([component]) for f in filters)
+            return BitMix(components, self, mix=component, ok=ok)
+
+    def decode_component(self, component):
+        """
+        Convert the given encoded component back to a reagent, `Mix`, or 
+        `PartialMix`.  Encoded mixes that were originally made from `Mix` 
+        objects are decoded to those same objects.
+        """
+        if isinstance(component, int):
+            return first(self.decode(component))
+
+        if isinstance(component, BitMix) and component.mix is not None:
+            return component.mix
+
+        components = {self.decode_component(x) for x in component.components}
+
+        if isinstance(component, BitPartialMix):
+            return PartialMix(components)
+        else:
+            return Mix(components)
+
+    def count_combos(self, mask):
+        try:
+            n_combos = self.memo[mask]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            return n_combos
+
+        rows = [
+                row for i, row in enumerate(self.rows)
+                if mask >> i & 1 and row is not None
+        ]
+        n_combos = self.matrix.count_distinct_rows(rows)
+
+        self.memo[mask] = n_combos
+        return n_combos
+
+class BitMix:
+    """
+    A mix encoded by `ReagentBits`.
+
+    The parts of the score (see `score_mix()`) that come from this mix and the 
+    mixes within it are calculated when the mix is created, so scoring a 
+    complete mix doesn't require walking the tree.
+    """
+    __slots__ = (
+            'components', 'mask', 'reagents', 'mix', 'ok',
+            'num_pipetting_steps', 'num_mixes', 'num_careful_reactions',
+            'num_adjacencies', 'depth',
+    )
+
+    def __init__(self, components, bits, *, mix=None, ok=True):
+        self.components = components
+        self.mix = mix
+        self.ok = ok
+
+        mask = reagents = child_reagents = 0
+        children = []
+
+        for x in components:
+            if isinstance(x, int):
+                mask |= x
+                reagents |= x
+            else:
+                mask |= x.mask
+                child_reagents |= x.reagents
+                children.append(x)
+
+        self.mask = mask
+        self.reagents = reagents
+
+        n_combos = bits.count_combos(mask)
+
+        self.num_pipetting_steps = n_combos * len(components) + sum(
+                x.num_pipetting_steps for x in children)
+        self.num_mixes = 1 + sum(x.num_mixes for x in children)
+
+        # Careful reagents count the combos of the mix they're added to:
+        n_care = count_bits(reagents & bits.careful) * n_combos
+        self.num_careful_reactions = n_care + sum(
+                x.num_careful_reactions for x in children)
+
+        # Count reagents in this mix that are adjacent to each other, and 
+        # reagents that come right after a reagent in a child mix:
+        n_adj = count_bits(reagents & (reagents >> 1))
+        n_adj += count_bits(reagents & (child_reagents << 1))
+        self.num_adjacencies = n_adj + sum(
+                x.num_adjacencies for x in children)
+
+        self.depth = 1 + max(x.depth for x in children) if children else 0
+
+class BitPartialMix:
+    """
+    A partial mix encoded by `ReagentBits`.
+    """
+    __slots__ = ('components', 'mask', 'bit_mix')
+
+    def __init__(self, components):
+        self.components = components
+        self.mask = 0
+        self.bit_mix = None
+
+        for x in components:
+            self.mask |= get_mask(x)
+
+    def __len__(self):
+        return len(self.components)
+
+    def to_mix(self, bits):
+        if self.bit_mix is None:
+            self.bit_mix = BitMix(self.components, bits)
+        return self.bit_mix
+
 @dataclass
 class Score:
     num_pipetting_steps: int
@@ -161,71 +401,158 @@ class Score:
 
         return self.depth < other.depth
 
-def plan_mixes(reaction, combos, *, mixes=None, subset=None, bias=0):
+@autoprop
+class MixPlanner:
+    """
+    Find the best master mixes for the given combos.
+
+    Every search made by the same planner shares one memo, so combos and 
+    pipetting steps only need to be counted once.  This matters when planning 
+    a reaction that has automixes (each of which is a separate search), and 
+    when replanning a reaction after it changes, e.g. by `Reactions.refresh()`.  
+    Everything in the memo depends only on the combos, so a planner can be 
+    reused as long as its combos don't change.
     """
-    Find the best set of master mixes to use when preparing the given 
-    combinations of the given reagents.
 
-    Arguments:
-        reaction:
-            ...
+    def __init__(self, combos):
+        self.combos = combos
+        self.matrix = ComboMatrix(combos)
+        self.memo = CountingMemo()
 
-        combos:
-            ...
+    def plan_mixes(self, reaction, *, mixes=None, subset=None, bias=0):
+        """
+        Find the best set of master mixes to use when preparing the given 
+        combinations of the given reagents.
+
+        Arguments:
+            reaction:
+                ...
+
+            mixes:
+                A collections of `Mix` or `AutoMix` instances that must be 
+                included in the ultimate reaction setup.
+
+            subset:
+                Only consider the given reagents.
+
+        The following criteria are used to decide if one way of mixing the 
+        given reagents is better or worse than another:
+
+        - Smallest number of pipetting steps.
+        - Largest number of master mixes.
+        - Most compatible with *ideal_order*.
+
+        The search is a branch-and-bound search: any partial setup that can't 
+        possibly take fewer pipetting steps than the best complete setup found 
+        so far is abandoned without being explored further.  Because the bound 
+        is admissible (see `bound_pipetting_steps()`) and only setups that are 
+        strictly worse are abandoned, the result is the same as it would be for 
+        an exhaustive search.
+
+        If several setups are equally good by all of the above criteria, the 
+        first one found is returned.  Which one that is depends on the order 
+        in which the search merges components, which is arbitrary (it follows 
+        set iteration order), so ties shouldn't be relied on.
+        """
+        combos, memo = self.matrix, self.memo
 
-        mixes:
-            A collections of `Mix` or `AutoMix` instances that must be included 
-            in the ultimate reaction setup.
+        mixes = self.plan_automixes(mixes or [], reaction, bias=bias)
+        components = init_components(reaction, mixes, subset)
+        components = mix_matching_components(components, combos, memo)
 
-        subset:
-            Only consider the given reagents.
+        # Filters depend on the volumes of the mixes, which can change without 
+        # the combos changing, so these results aren't memoized.  They're only 
+        # calculated once per search anyways.
+        filters = [
+                lambda mix: require_solvent_with_volume(mix, reaction.solvent),
+        ]
 
-    The following criteria are used to decide if one way of mixing the given 
-    reagents is better or worse than another:
+        # Search for the best mix using the bit encoding, and only convert the 
+        # winner back to `Mix` objects.
+        bits = self.get_bits(reaction)
+        components = [bits.encode_component(x, filters) for x in components]
 
-    - Smallest number of pipetting steps.
-    - Largest number of master mixes.
-    - Most compatible with *ideal_order*.
-    """
-    memo = {}
+        best_mix = None
+        best_score = None
 
-    mixes = plan_automixes(mixes or [], reaction, combos, bias=bias)
-    components = init_components(reaction, mixes, subset)
-    components = mix_matching_components(components, combos, memo)
-    filters = [
-            lambda mix: require_solvent_with_volume(mix, reaction.solvent),
-    ]
+        def is_hopeless(components):
+            if best_score is None:
+                return False
 
-    best_mix = None
-    best_score = None
+            n_pipet = bound_pipetting_steps(components, bits, bias)
+            return n_pipet > best_score.num_pipetting_steps
 
-    careful_reagents = find_careful_reagents(reaction)
-    order_map = make_order_map(reaction.keys())
+        # There's no need to skip duplicate mixes: a duplicate can never have 
+        # a strictly better score than the mix it duplicates.
+        mixes = iter_complete_bit_mixes(components, bits, prune=is_hopeless)
 
-    for mix in unique(iter_complete_mixes(components, combos, filters)):
-        score = score_mix(mix, combos, bias, careful_reagents, order_map, memo)
-        if score < best_score:
-            best_mix = mix
-            best_score = score
+        for mix in mixes:
+            score = score_bit_mix(mix, bias)
+            if score < best_score:
+                best_mix = mix
+                best_score = score
 
-    assert best_mix or not reaction
-    return best_mix
+        assert best_mix or not reaction
+        return bits.decode_component(best_mix) if best_mix else None
 
-def plan_automixes(mixes, *args, **kwargs):
-    processed = []
+    def plan_automixes(self, mixes, reaction, **kwargs):
+        processed = []
 
-    for mix in mixes:
-        if isinstance(mix, AutoMix):
-            automix, mix = mix, plan_mixes(
-                    *args,
-                    **kwargs,
-                    subset=iter_all_reagents(mix),
-            )
-            automix.init(mix)
+        for mix in mixes:
+            if isinstance(mix, AutoMix):
+                automix, mix = mix, self.plan_mixes(
+                        reaction,
+                        **kwargs,
+                        subset=iter_all_reagents(mix),
+                )
+                automix.init(mix)
+
+            processed.append(mix)
+
+        return processed
+
+    def get_bits(self, reaction):
+        """
+        Return the `ReagentBits` used to encode the given reaction.
+
+        The reagents are encoded in the same order as in the reaction, which 
+        is necessary for adjacencies to be counted correctly.
+        """
+        keys = tuple(reaction.keys())
+        careful_reagents = tuple(find_careful_reagents(reaction))
+
+        memo = get_memo(self.memo, MixPlanner.get_bits)
+        memo_key = keys, careful_reagents
 
-        processed.append(mix)
+        if memo_key in memo:
+            return memo[memo_key]
+
+        bits = ReagentBits(keys, self.matrix, careful_reagents, self.memo)
+        memo[memo_key] = bits
+        return bits
+
+    def get_hits(self):
+        return sum(x.hits for x in self._iter_counters())
+
+    def get_misses(self):
+        return sum(x.misses for x in self._iter_counters())
+
+    def _iter_counters(self):
+        yield from self.memo.values()
+        yield from get_memo(self.memo, MixPlanner.get_bits).values()
+
+def plan_mixes(reaction, combos, *, mixes=None, subset=None, bias=0):
+    """
+    Find the best set of master mixes to use when preparing the given 
+    combinations of the given reagents.  See `MixPlanner.plan_mixes()` for 
+    details.
+    """
+    planner = MixPlanner(combos)
+    return planner.plan_mixes(reaction, mixes=mixes, subset=subset, bias=bias)
 
-    return processed
+def plan_automixes(mixes, reaction, combos, **kwargs):
+    planner = MixPlanner(combos)
+    return planner.plan_automixes(mixes, reaction, **kwargs)
 
 def set_mix_names(mix, reaction, notable_reagents, format_name=lambda x: None):
     """
@@ -518,18 +845,37 @@ def iter_complete_mixes(components, combos, filters, memo=None):
     - Reagents that vary together will always be added together.
     - If the same reagents can be mixed in multiple different ways, only keep 
       those that take the fewest pipetting steps.
-    - Custom filters can be provided to perform more targeted pruning.
+    - Custom filters can be provided to perform more targeted pruning.  Each 
+      filter is called with a list containing one of the given mixes, and 
+      should return False if that mix can't be added to another mix.
 
     This function may yield the same mix multiple times, so the caller should 
     account for this.
     """
+    reagents = sorted(set(iter_all_reagents(components)))
+    bits = ReagentBits(reagents, combos, memo=memo)
+    components = [bits.encode_component(x, filters) for x in components]
+
+    for mix in iter_complete_bit_mixes(components, bits):
+        yield bits.decode_component(mix)
+
+def iter_complete_bit_mixes(components, bits, prune=None):
+    """
+    Same as `iter_complete_mixes()`, but for components that have been encoded 
+    by `ReagentBits`.
+
+    If given, *prune* is called with the components remaining after each 
+    merge, and should return True if no complete mix that can be made from 
+    those components is worth considering.
+    """
 
     def find_best_pairs(components):
         best_pairs = []
         best_num_combos = inf
 
         for pair in combinations(components, 2):
-            n = count_combos(pair, combos, memo)
+            a, b = pair
+            n = bits.count_combos(get_mask(a) | get_mask(b))
             if n == best_num_combos:
                 best_pairs.append(pair)
             elif n < best_num_combos:
@@ -543,7 +889,7 @@ def iter_complete_mixes(components, combos, filters, memo=None):
             a2 = iter_possible_components(a1)
             b2 = iter_possible_components(b1)
             for a3, b3 in product(a2, b2):
-                yield {a1, b1}, PartialMix({*a3, *b3})
+                yield (a1, b1), BitPartialMix(a3 + b3)
 
     def iter_possible_components(x):
         """
@@ -552,19 +898,22 @@ def iter_complete_mixes(components, combos, filters, memo=None):
         Reagents and mixes are yielded directly.  Partial mixes are yielded as 
         both a mix and a collection of reagents.
         """
-        if isinstance(x, PartialMix):
-            yield [Mix(x)]
-            yield x
+        if isinstance(x, BitPartialMix):
+            yield (x.to_mix(bits),)
+            yield x.components
         else:
-            yield [x]
+            yield (x,)
 
     def mix_from_component(component):
-        if isinstance(component, Mix):
+        if isinstance(component, BitMix):
             return component
-        if isinstance(component, PartialMix):
-            return Mix(component)
+        if isinstance(component, BitPartialMix):
+            return component.to_mix(bits)
         else:
-            return Mix({component})
+            return BitMix((component,), bits)
+
+    def passes_filters(components):
+        return all(x.ok for x in components if isinstance(x, BitMix))
 
     if len(components) == 1:
         yield mix_from_component(first(components))
@@ -577,10 +926,13 @@ def iter_complete_mixes(components, combos, filters, memo=None):
 
     pairs = find_best_pairs(components)
 
-    for components_to_remove, mix_to_add in mix_pairs(pairs):
-        if all(f(mix_to_add) for f in filters):
-            merged = components - components_to_remove | {mix_to_add}
-            yield from iter_complete_mixes(merged, combos, filters)
+    for (a, b), mix_to_add in mix_pairs(pairs):
+        if passes_filters(mix_to_add.components):
+            merged = [x for x in components if x is not a and x is not b]
+            merged.append(mix_to_add)
+            if prune and prune(merged):
+                continue
+            yield from iter_complete_bit_mixes(merged, bits, prune=prune)
 
 def mix_matching_components(components, combos, memo=None):
     levels = {}
@@ -676,6 +1028,20 @@ def score_mix(mix, combos, bias, careful_reagents, order_map, memo):
 
     return Score(n_pipet, n_mix, sum(n_care.values()), n_adj, depth)
 
+def score_bit_mix(mix, bias):
+    # Same as `score_mix()`, but for mixes encoded by `ReagentBits`.  Like 
+    # `iter_all_mixes()`, don't count the top-level mix itself.
+    n_mix = mix.num_mixes - 1
+    n_pipet = mix.num_pipetting_steps + n_mix * bias
+
+    return Score(
+            n_pipet,
+            n_mix,
+            mix.num_careful_reactions,
+            mix.num_adjacencies,
+            mix.depth,
+    )
+
 def count_pipetting_steps(components, combos, memo=None):
     """
     Return the number of pipetting steps it would take to prepare each 
@@ -723,23 +1089,91 @@ def count_pipetting_steps(components, combos, memo=None):
     memo[components] = n_steps
     return n_steps
 
-def count_combos(component_or_components, combos, memo=None):
-    memo = get_memo(memo, count_combos)
+def bound_pipetting_steps(components, bits, bias=0):
+    """
+    Return a lower bound on the number of pipetting steps (as calculated by 
+    `score_mix()`) needed for any complete mix that `iter_complete_mixes()` 
+    could make from the given components, which must be encoded by the given 
+    `ReagentBits`.
+
+    Mixes are never changed once they're made, so the steps needed to make the 
+    mixes that already exist are fixed.  Beyond that, every component will 
+    eventually be added to a mix that also contains (at least) one of the 
+    other components, and every member of a partial mix will eventually be 
+    added to a mix that contains (at least) the whole partial mix.  A mix 
+    can't have fewer combos than any subset of its reagents, so this gives a 
+    minimum number of steps for adding each component.
+
+    Each mix that already exists adds *bias* steps, if *bias* is positive.  
+    Adding more mixes could decrease the number of steps if *bias* is 
+    negative, so in that case no bound is given at all.
+    """
+    if bias < 0:
+        return -inf
+
+    n_steps = 0
+    n_mixes = 0
+    masks = [get_mask(x) for x in components]
+
+    # Find the fewest combos that the mix each component ends up being added 
+    # to could have.
+    n_parents = [inf if len(masks) > 1 else 0] * len(masks)
+
+    for i, j in combinations(range(len(masks)), 2):
+        n = bits.count_combos(masks[i] | masks[j])
+        n_parents[i] = min(n_parents[i], n)
+        n_parents[j] = min(n_parents[j], n)
+
+    for i, x in enumerate(components):
+        n_x = bits.count_combos(masks[i])
+        n_parent = n_parents[i]
+
+        if isinstance(x, BitPartialMix):
+            # The members of a partial mix are either added to a mix of their 
+            # own (which is then added to a parent), or directly to a parent.
+            n_steps += min(
+                    len(x) * n_x + n_parent + bias,
+                    len(x) * max(n_x, n_parent),
+            )
+            members = x.components
+        else:
+            n_steps += n_parent
+            members = [x]
+
+        for mix in members:
+            if isinstance(mix, BitMix):
+                n_steps += mix.num_pipetting_steps
+                n_mixes += mix.num_mixes
+
+    return n_steps + n_mixes * bias
 
+def count_combos(component_or_components, combos, memo=None):
     components = always_iterable(component_or_components)
     reagents = frozenset(iter_all_reagents(components))
 
+    memo = get_memo(memo, count_combos)
+
     if reagents in memo:
         return memo[reagents]
-    
-    n_combos = len({
-            tuple(combo.get(k) for k in reagents)
-            for combo in combos
-    })
+
+    # Encoding the combos only pays off if the matrix is reused, so leave that 
+    # to the caller (e.g. `MixPlanner`).
+    if isinstance(combos, ComboMatrix):
+        n_combos = combos.count_distinct(reagents)
+    else:
+        n_combos = len({
+                tuple(combo.get(k) for k in reagents)
+                for combo in combos
+        })
 
     memo[reagents] = n_combos
     return n_combos
 
+def encode_combos(combos):
+    if isinstance(combos, ComboMatrix):
+        return combos
+    return ComboMatrix(combos)
+
 def count_combos_by_reagent(mix, reagents, combos, memo=None):
     mixes = {}
 
@@ -752,7 +1186,7 @@ def count_combos_by_reagent(mix, reagents, combos, memo=None):
     for reagent in reagents:
         child = mixes[reagent]
         reagents_it = iter_all_reagents(child)
-        n_combos[reagent] = count_combos(reagents_it, combos, memo=None)
+        n_combos[reagent] = count_combos(reagents_it, combos, memo)
 
     return n_combos
 
@@ -792,6 +1226,13 @@ def iter_mixes(components):
         if isinstance(component, Mix):
             yield component
 
+def get_mask(component):
+    # Reagents encoded by `ReagentBits` are their own masks.
+    return component if isinstance(component, int) else component.mask
+
+def count_bits(mask):
+    return bin(mask).count('1')
+
 def iter_all_reagents(components):
     for component in components:
         if isinstance(component, str):
@@ -21,7 +21,7 @@ from fractions import Fraction
 
 from .reaction import Reaction, format_reaction, after
 from .mix import (
-        Mix, plan_mixes, set_mix_names, set_mix_reactions, set_mix_scales,
+        Mix, MixPlanner, set_mix_names, set_mix_reactions, set_mix_scales,
         iter_mixes, iter_all_mixes_in_protocol_order, format_stock_conc_as_int,
 )
 from ..format import pl, ul, dl, table
@@ -256,6 +256,11 @@ class Reactions(byoc.App):
         except AttributeError:
             pass
 
+        try:
+            del self.planner
+        except AttributeError:
+            pass
+
         try:
             del self.mix
         except AttributeError:
@@ -281,10 +286,15 @@ class Reactions(byoc.App):
                 self.combos.format_as_table(self.base_reaction),
         )
 
+    def get_planner(self):
+        # This is cached separately from the mix, so that `refresh()` can reuse 
+        # the memo from the last time the mixes were planned.  The memo only 
+        # depends on the combos, so `set_combos()` clears it.
+        return MixPlanner(self.combos)
+
     def get_mix(self):
-        mix = plan_mixes(
+        mix = self.planner.plan_mixes(
                 self.base_reaction,
-                self.combos,
                 mixes=self.required_mixes,
                 bias=self.master_mix_bias,
         )
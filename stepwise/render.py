@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+"""
+Render pages of monospace text as PostScript or PDF.
+
+Printed protocols are just lines of text, so there's no need for a general
+purpose typesetting engine.  This module lays the text out on a fixed grid
+using the Courier font, which every PostScript interpreter and PDF viewer is
+required to provide, so nothing needs to be embedded in the document.
+
+Courier only covers the Latin-1 character set, but protocols commonly use a
+handful of other characters.  These are handled as follows:
+
+- Box-drawing characters (e.g. the rules in tables and the vertical line in the
+  margin) are drawn as line segments that connect with their neighbors.
+
+- Superscript digits and signs (e.g. in units like ``s⁻¹``) are drawn as
+  smaller, raised characters.
+
+- The ellipsis (used to indicate truncated text) is drawn as three dots
+  within a single cell.
+
+- A few other characters are replaced by their closest Latin-1 equivalent
+  (e.g. 'μ' by 'µ').  Anything else is replaced by '?'.
+"""
+
+import re
+import zlib
+
+from .errors import UsageError
+
+PAPER_SIZES = {
+        'letter': (612, 792),
+        'legal': (612, 1008),
+        'a4': (595, 842),
+        'a5': (420, 595),
+}
+
+# Courier is a monospace font, and each glyph is 600/1000 em wide.
+_CHAR_WIDTH = 0.6
+
+_SUBSTITUTES = {
+        'μ': 'µ',
+        '−': '-',
+        '–': '-',
+        '—': '-',
+        '≈': '~',
+        '‘': "'",
+        '’': "'",
+        '“': '"',
+        '”': '"',
+        '•': '·',
+}
+
+_SUPERSCRIPTS = {
+        '⁰': '0',
+        '⁴': '4',
+        '⁵': '5',
+        '⁶': '6',
+        '⁷': '7',
+        '⁸': '8',
+        '⁹': '9',
+        '⁺': '+',
+        '⁻': '-',
+        '⁼': '=',
+        '⁽': '(',
+        '⁾': ')',
+}
+
+# Each box-drawing character is described by the "arms" that extend from the
+# center of its cell: left, right, up, and down.
+_BOX_DRAWING = {
+        '─': 'lr',
+        '━': 'lr',
+        '│': 'ud',
+        '┃': 'ud',
+        '┌': 'rd',
+        '┐': 'ld',
+        '└': 'ur',
+        '┘': 'ul',
+        '├': 'udr',
+        '┤': 'udl',
+        '┬': 'lrd',
+        '┴': 'lru',
+        '┼': 'lrud',
+}
+
+_ELLIPSIS = '…'
+
+# Match either a run of characters that can be drawn directly with the 
+# Latin-1 encoded font, a run of horizontal rules (which can be drawn as a 
+# single line), or a single character that needs special handling.
+_RUN_PATTERN = re.compile(r'(?P<text>[\x20-\x7e\xa0-\xff]+)|(?P<rule>[─━]+)|(?P<other>.)')
+
+def render_postscript(pages, **kwargs):
+    """
+    Render the given pages as a PostScript document.
+
+    Arguments:
+        pages (list): A list of pages, where each page is a list of lines
+            (without trailing newlines), i.e. the output of
+            `Printer.make_pages()` or `Printer.add_margin()`.
+        kwargs: See `layout_pages()`.
+
+    Returns:
+        bytes: The PostScript document.
+    """
+    layout = layout_pages(pages, **kwargs)
+    width, height = layout.paper_size
+    out = []
+    w = out.append
+
+    w('%!PS-Adobe-3.0')
+    w('%%Creator: stepwise')
+    w(f'%%Pages: {len(layout.pages)}')
+    w(f'%%BoundingBox: 0 0 {_num(width)} {_num(height)}')
+    w('%%DocumentNeededResources: font Courier')
+    w('%%EndComments')
+
+    w('%%BeginProlog')
+    w('/Courier findfont dup length dict begin')
+    w('  { 1 index /FID ne { def } { pop pop } ifelse } forall')
+    w('  /Encoding ISOLatin1Encoding def')
+    w('  currentdict')
+    w('end /Courier-Latin1 exch definefont pop')
+    w('/T { /Courier-Latin1 findfont exch scalefont setfont moveto show } bind def')
+    w('/L { newpath 4 2 roll moveto lineto stroke } bind def')
+    w('/D { rectfill } bind def')
+    w('%%EndProlog')
+
+    w('%%BeginSetup')
+    w(f'<< /PageSize [{_num(width)} {_num(height)}] >> setpagedevice')
+    w('%%EndSetup')
+
+    for i, ops in enumerate(layout.pages, 1):
+        w(f'%%Page: {i} {i}')
+        w(f'{_num(layout.line_width)} setlinewidth')
+
+        for op, *args in ops:
+            if op == 'text':
+                x, y, size, text = args
+                w(f'{_str(text)} {_num(x)} {_num(y)} {_num(size)} T')
+            elif op == 'line':
+                w(' '.join(map(_num, args)) + ' L')
+            elif op == 'dot':
+                w(' '.join(map(_num, args)) + ' D')
+
+        w('showpage')
+
+    w('%%Trailer')
+    w('%%EOF')
+
+    return ('\n'.join(out) + '\n').encode('ascii')
+
+def render_pdf(pages, **kwargs):
+    """
+    Render the given pages as a PDF document.
+
+    Arguments:
+        pages (list): A list of pages, where each page is a list of lines
+            (without trailing newlines), i.e. the output of
+            `Printer.make_pages()` or `Printer.add_margin()`.
+        kwargs: See `layout_pages()`.
+
+    Returns:
+        bytes: The PDF document.
+    """
+    layout = layout_pages(pages, **kwargs)
+    width, height = layout.paper_size
+    n = len(layout.pages)
+
+    # Object numbers: 1 is the catalog, 2 is the page tree, 3 is the font, and
+    # then each page is followed by its content stream.
+    page_ids = [4 + 2 * i for i in range(n)]
+    objects = [
+            b'<< /Type /Catalog /Pages 2 0 R >>',
+            b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+                ' '.join(f'{i} 0 R' for i in page_ids).encode(), n,
+            ),
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>',
+    ]
+
+    for page_id, ops in zip(page_ids, layout.pages):
+        content = []
+        c = content.append
+
+        c(f'{_num(layout.line_width)} w')
+
+        for op, *args in ops:
+            if op == 'text':
+                x, y, size, text = args
+                c(f'BT /F1 {_num(size)} Tf {_num(x)} {_num(y)} Td {_str(text)} Tj ET')
+            elif op == 'line':
+                x1, y1, x2, y2 = map(_num, args)
+                c(f'{x1} {y1} m {x2} {y2} l S')
+            elif op == 'dot':
+                c(' '.join(map(_num, args)) + ' re f')
+
+        stream = zlib.compress('\n'.join(content).encode('ascii'))
+
+        objects.append(
+                b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] '
+                b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % (
+                    _num(width).encode(), _num(height).encode(), page_id + 1,
+                )
+        )
+        objects.append(
+                b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' % (
+                    len(stream), stream,
+                )
+        )
+
+    out = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (i, obj)
+
+    xref = len(out)
+    out += b'xref\n0 %d\n' % (len(objects) + 1)
+    out += b'0000000000 65535 f \n'
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\n' % (len(objects) + 1)
+    out += b'startxref\n%d\n%%%%EOF\n' % xref
+
+    return bytes(out)
+
+def layout_pages(
+        pages,
+        *,
+        font_size=12,
+        paper='letter',
+        lines_per_page=None,
+        top_margin=12,
+        bottom_margin=12,
+        left_margin=0,
+):
+    """
+    Work out where each character of the given pages should be drawn.
+
+    Arguments:
+        pages (list): A list of pages, where each page is a list of lines.
+        font_size (float): The font size, in points.
+        paper (str or tuple): Either the name of a standard paper size (see
+            `PAPER_SIZES`) or a (width, height) tuple, in points.
+        lines_per_page (int): The number of lines that should fit on each
+            page.  If necessary, the lines are packed more tightly than usual
+            to make this many fit.  Any page with more lines than this is
+            continued on a new sheet.  By default, the spacing is determined
+            by the font size alone.
+        top_margin (float): The blank space above the first line, in points.
+        bottom_margin (float): The blank space below the last line, in points.
+        left_margin (float): The blank space to the left of each line, in
+            points.
+
+    Returns:
+        Layout: An object with the following attributes: `paper_size`,
+        `line_width` (for drawn lines), and `pages` (a list of drawing
+        operations for each sheet of paper).
+    """
+    paper_size = _get_paper_size(paper)
+    usable_height = paper_size[1] - top_margin - bottom_margin
+    line_height = font_size * 1.2
+
+    if lines_per_page:
+        line_height = min(line_height, usable_height / lines_per_page)
+
+    sheet_height = int(usable_height // line_height) or 1
+    grid = _Grid(
+            font_size=font_size,
+            line_height=line_height,
+            left=left_margin,
+            top=paper_size[1] - top_margin,
+    )
+
+    layout = Layout()
+    layout.paper_size = paper_size
+    layout.line_width = font_size / 24
+
+    for page in pages:
+        for i in range(0, max(len(page), 1), sheet_height):
+            sheet = page[i:i + sheet_height]
+            layout.pages.append([
+                op
+                for row, line in enumerate(sheet)
+                for op in grid.draw_line(row, line)
+            ])
+
+    return layout
+
+class Layout:
+
+    def __init__(self):
+        self.paper_size = None
+        self.line_width = None
+        self.pages = []
+
+class _Grid:
+    """
+    Convert lines of text into drawing operations, given the dimensions of
+    each character cell.
+    """
+
+    def __init__(self, *, font_size, line_height, left, top):
+        self.font_size = font_size
+        self.cell_width = _CHAR_WIDTH * font_size
+        self.line_height = line_height
+        self.left = left
+        self.top = top
+
+    def draw_line(self, row, line):
+        cw = self.cell_width
+        size = self.font_size
+
+        cell_top = self.top - row * self.line_height
+        cell_bottom = cell_top - self.line_height
+        cell_middle = (cell_top + cell_bottom) / 2
+        baseline = cell_middle - 0.3 * size
+
+        # Group consecutive printable characters, so each group can be drawn
+        # with a single text operation.
+        for m in _RUN_PATTERN.finditer(line.rstrip()):
+            col = m.start()
+            x = self.left + col * cw
+
+            if text := m.group('text'):
+                stripped = text.strip(' ')
+                if stripped:
+                    x += (len(text) - len(text.lstrip(' '))) * cw
+                    yield 'text', x, baseline, size, stripped
+                continue
+
+            if rule := m.group('rule'):
+                yield 'line', x, cell_middle, x + len(rule) * cw, cell_middle
+                continue
+
+            char = m.group('other')
+
+            if arms := _BOX_DRAWING.get(char):
+                xc = x + cw / 2
+                if 'l' in arms or 'r' in arms:
+                    x1 = x if 'l' in arms else xc
+                    x2 = x + cw if 'r' in arms else xc
+                    yield 'line', x1, cell_middle, x2, cell_middle
+                if 'u' in arms or 'd' in arms:
+                    y1 = cell_top if 'u' in arms else cell_middle
+                    y2 = cell_bottom if 'd' in arms else cell_middle
+                    yield 'line', xc, y1, xc, y2
+
+            elif char in _SUPERSCRIPTS:
+                small = 0.6 * size
+                yield (
+                        'text',
+                        x + (cw - _CHAR_WIDTH * small) / 2,
+                        baseline + 0.4 * size,
+                        small,
+                        _SUPERSCRIPTS[char],
+                )
+
+            elif char == _ELLIPSIS:
+                r = size / 12
+                for k in range(3):
+                    xk = x + (2 * k + 1) * cw / 6
+                    yield 'dot', xk - r / 2, baseline, r, r
+
+            else:
+                yield 'text', x, baseline, size, _SUBSTITUTES.get(char, '?')
+
+def _get_paper_size(paper):
+    if isinstance(paper, str):
+        try:
+            return PAPER_SIZES[paper.lower()]
+        except KeyError:
+            raise UsageError(
+                    f"unknown paper size: {paper!r}",
+                    codicil=f"expected one of: {', '.join(PAPER_SIZES)}",
+            ) from None
+    return tuple(paper)
+
+def _num(x):
+    """
+    Format a number compactly, with at most two decimal places.
+    """
+    return f'{x:.2f}'.rstrip('0').rstrip('.')
+
+def _str(text):
+    """
+    Format a string literal, as understood by both PostScript and PDF.
+    """
+    out = ['(']
+    for char in text:
+        i = ord(char)
+        if char in '\\()':
+            out.append('\\' + char)
+        elif 0x20 <= i <= 0x7e:
+            out.append(char)
+        else:
+            out.append(f'\\{i:03o}')
+    out.append(')')
+    return ''.join(out)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+"""
+Collect print jobs so that they can be sent to the printer together.
+
+Normally, `sw go` sends each protocol to the printer as soon as it's made.
+When lots of protocols are made at once (e.g. by a script), it's more
+efficient to add each protocol to a queue, then to print everything in the
+queue at the end.  All the protocols (and attachments) queued for the same
+printer are then submitted as a single job.
+
+The queue is just a directory.  Each job is a subdirectory containing the
+pages of the protocol (already formatted for the printer), copies of any
+attachments, and a JSON file describing the job.
+"""
+
+import json, shlex, shutil, time
+
+from pathlib import Path
+from datetime import datetime
+from itertools import groupby
+from contextlib import contextmanager
+from uuid import uuid4
+from .errors import UsageError
+
+class PrintQueue:
+
+    def __init__(self, root=None):
+        if root is None:
+            from .config import config_dirs
+            root = Path(config_dirs.user_data_dir) / 'print_queue'
+
+        self.root = Path(root)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({str(self.root)!r})'
+
+    def add_protocol(self, protocol, printer):
+        """
+        Add the given protocol to the queue, formatted for the given printer.
+        """
+        from .printer import make_protocol_pages
+
+        return self.add_pages(
+                make_protocol_pages(protocol, printer),
+                printer,
+                attachments=protocol.attachments,
+                name=protocol.pick_slug(),
+        )
+
+    def add_pages(self, pages, printer, *, attachments=(), name=None):
+        """
+        Add the given pages (and attachments) to the queue.
+
+        The job is written to a temporary directory and then moved into place,
+        so a concurrent flush will never see a partially written job.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        # Start the id with the time, so jobs sort in the order they were 
+        # added.  The random suffix keeps jobs added at the same moment (e.g. 
+        # by different processes) from colliding.  It's kept short so the ids 
+        # still fit in the `sw print-queue` listing.
+        now = datetime.now()
+        id = f'{now:%Y%m%d-%H%M%S-%f}-{uuid4().hex[:8]}'
+        tmp_dir = self.root / f'.{id}'
+        tmp_dir.mkdir()
+
+        attachment_names = []
+        for i, path in enumerate(attachments):
+            path = Path(path)
+            copy_name = f'{i}-{path.name}'
+            shutil.copyfile(path, tmp_dir / copy_name)
+            attachment_names.append(copy_name)
+
+        (tmp_dir / 'pages.json').write_text(json.dumps(pages))
+
+        job = PrintJob(self.root / id)
+        job.name = name
+        job.created = now.isoformat()
+        job.printer = printer.name
+        job.lpr_flags = printer.lpr_flags
+        job.font_size = printer.font_size
+        job.paper = printer.paper
+        job.page_height = printer.page_height
+        job.attachments = attachment_names
+        job._save(tmp_dir)
+
+        tmp_dir.rename(job.dir)
+        return job
+
+    def find_jobs(self):
+        """
+        Return all of the jobs in the queue, oldest first.
+        """
+        if not self.root.exists():
+            return []
+
+        return [
+                PrintJob.from_dir(p)
+                for p in sorted(self.root.iterdir())
+                if p.is_dir() and not p.name.startswith('.')
+        ]
+
+    def flush(self, *, retries=2, retry_delay=1, max_workers=4):
+        """
+        Print every job in the queue.
+
+        Jobs that are queued for the same printer (with the same settings) are
+        combined into a single PostScript document and submitted to `lpr`
+        together with their attachments, so each printer receives just one
+        print job.  The submissions to different printers run concurrently.
+        If `lpr` fails, it is retried after an exponentially increasing delay.
+
+        Jobs that print successfully are removed from the queue.  Jobs that
+        fail remain in the queue (with their status set to 'failed') so that
+        they can be retried later.  Either way, every job is returned with its
+        `status`, `attempts`, and `error` attributes updated.
+
+        Only one flush can run at a time.  If another process is already
+        flushing the queue, wait for it to finish and then print whatever
+        jobs it left behind, so that no job is ever printed twice.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if retries < 0:
+            raise UsageError(f"the number of retries must be non-negative, not {retries}")
+
+        with self._lock():
+            jobs = self.find_jobs()
+            batches = [
+                    list(group)
+                    for _, group in groupby(
+                        sorted(jobs, key=_batch_key),
+                        key=_batch_key,
+                    )
+            ]
+
+            def submit(batch):
+                return _submit_batch(self.root, batch, retries, retry_delay)
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(submit, batches))
+
+        return jobs
+
+    def clear(self):
+        """
+        Remove every job from the queue, without printing anything.
+        """
+        with self._lock():
+            jobs = self.find_jobs()
+            for job in jobs:
+                job.remove()
+
+        return jobs
+
+    @contextmanager
+    def _lock(self):
+        """
+        Hold an exclusive lock on the queue, so that concurrent flushes (or
+        clears) can't claim the same jobs.
+
+        The lock is released automatically if the process dies, so a crashed
+        flush can't leave the queue stuck.  Adding jobs doesn't require the
+        lock, because new jobs are moved into place atomically.
+        """
+        import fcntl
+
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        # The lock file starts with a dot, so `find_jobs()` ignores it.
+        with open(self.root / '.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+class PrintJob:
+    _attrs = [
+            'name',
+            'created',
+            'printer',
+            'lpr_flags',
+            'font_size',
+            'paper',
+            'page_height',
+            'attachments',
+            'status',
+            'attempts',
+            'error',
+    ]
+
+    def __init__(self, dir):
+        self.dir = Path(dir)
+        self.name = None
+        self.created = None
+        self.printer = None
+        self.lpr_flags = ''
+        self.font_size = 12
+        self.paper = 'letter'
+        self.page_height = None
+        self.attachments = []
+        self.status = 'pending'
+        self.attempts = 0
+        self.error = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({str(self.dir)!r})'
+
+    @classmethod
+    def from_dir(cls, dir):
+        job = cls(dir)
+        info = json.loads((job.dir / 'job.json').read_text())
+        for attr in cls._attrs:
+            if attr in info:
+                setattr(job, attr, info[attr])
+        return job
+
+    @property
+    def id(self):
+        return self.dir.name
+
+    @property
+    def pages(self):
+        return json.loads((self.dir / 'pages.json').read_text())
+
+    @property
+    def attachment_paths(self):
+        return [self.dir / x for x in self.attachments]
+
+    def remove(self):
+        shutil.rmtree(self.dir)
+
+    def _save(self, dir=None):
+        info = {attr: getattr(self, attr) for attr in self._attrs}
+        (Path(dir or self.dir) / 'job.json').write_text(json.dumps(info, indent=2))
+
+def _batch_key(job):
+    return (
+            job.printer or '',
+            job.lpr_flags or '',
+            job.font_size,
+            job.paper,
+            job.page_height or 0,
+    )
+
+def _submit_batch(root, batch, retries, retry_delay):
+    from subprocess import run
+    from tempfile import NamedTemporaryFile
+    from .render import render_postscript
+
+    first = batch[0]
+    pages = [page for job in batch for page in job.pages]
+    document = render_postscript(
+            pages,
+            font_size=first.font_size,
+            paper=first.paper,
+            lines_per_page=first.page_height,
+    )
+
+    with NamedTemporaryFile(dir=root, prefix='.batch-', suffix='.ps') as f:
+        f.write(document)
+        f.flush()
+
+        lpr = [
+                'lpr',
+                *(['-P', first.printer] if first.printer else []),
+                *shlex.split(first.lpr_flags or ''),
+                f.name,
+                *(str(p) for job in batch for p in job.attachment_paths),
+        ]
+
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(retry_delay * 2**(attempt - 1))
+
+            try:
+                p = run(lpr, capture_output=True, text=True)
+            except FileNotFoundError:
+                error = "'lpr' not found"
+                break
+
+            if p.returncode == 0:
+                error = None
+                break
+
+            error = p.stderr.strip() or f"'lpr' exited with status {p.returncode}"
+
+    for job in batch:
+        job.attempts += attempt + 1
+        job.error = error
+
+        if error is None:
+            job.status = 'printed'
+            job.remove()
+        else:
+            job.status = 'failed'
+            job._save()
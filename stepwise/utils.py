@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+from contextlib import contextmanager
+
 NO_DEFAULT = object()
 
 def unanimous(
@@ -59,8 +61,70 @@ class EmptyMemo:
 
 EMPTY_MEMO = EmptyMemo()
 
+class CountingMemo(dict):
+    """
+    A memo that counts how many of the values looked up in it were found.
+
+    When a `CountingMemo` is passed to `get_memo()`, each function gets its 
+    own `CountingMemo`, so the counts can be broken down by function.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        found = super().__contains__(key)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
 def get_memo(memo, func):
     if memo is None: return EMPTY_MEMO
     if memo is EMPTY_MEMO: return EMPTY_MEMO
-    return memo.setdefault(func, {})
 
+    try:
+        return memo[func]
+    except KeyError:
+        memo[func] = func_memo = type(memo)()
+        return func_memo
+
+
+@contextmanager
+def open_pager():
+    """
+    Yield a stream that displays text in a pager as it is written.
+
+    Unlike `pydoc.pager()`, which requires all of the text up front, this 
+    allows the user to start reading long output before it has been fully 
+    generated.  The pager is chosen using the same environment variables as 
+    `pydoc` (i.e. ``$MANPAGER`` and ``$PAGER``).  If stdout is not a TTY, or if 
+    the terminal can't support a pager, stdout itself is yielded.
+    """
+    import os, sys
+    from subprocess import Popen, PIPE
+
+    if not sys.stdout.isatty() or os.environ.get('TERM') in ('dumb', 'emacs'):
+        yield sys.stdout
+        return
+
+    cmd = os.environ.get('MANPAGER') or os.environ.get('PAGER') or 'less -FRX'
+    sys.stdout.flush()
+    proc = Popen(cmd, shell=True, stdin=PIPE, text=True, errors='backslashreplace')
+
+    try:
+        yield proc.stdin
+
+    # The user quit the pager before all the output was written.
+    except BrokenPipeError:
+        pass
+
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        proc.wait()
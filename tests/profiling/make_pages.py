@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+"""\
+Time how long it takes to break a very long protocol into pages.
+
+Usage:
+    make_pages.py [<num_pages>] [-n <repeats>]
+
+Options:
+    -n --repeats <int>  [default: 5]
+        The number of times to repeat the measurement.
+"""
+
+import docopt, random
+from timeit import repeat
+from stepwise import Printer
+
+args = docopt.docopt(__doc__)
+num_pages = int(args['<num_pages>'] or 500)
+num_repeats = int(args['--repeats'])
+
+printer = Printer.__new__(Printer)
+printer.page_height = 70
+
+# Make paragraphs between 1 and 12 lines long, with the occasional forced page
+# break, until there's enough content to fill the requested number of pages.
+rng = random.Random(0)
+lines = []
+
+while len(lines) < num_pages * printer.page_height:
+    lines += ['x' * 50] * rng.randint(1, 12)
+    lines += [''] * (2 if rng.random() < 0.02 else 1)
+
+times = repeat(lambda: printer.make_pages(lines), number=1, repeat=num_repeats)
+pages = printer.make_pages(lines)
+slack = [printer.page_height - len(x) for x in pages]
+
+print(f"lines:        {len(lines)}")
+print(f"pages:        {len(pages)}")
+print(f"mean slack:   {sum(slack) / len(slack):.1f} lines")
+print(f"max slack:    {max(slack)} lines")
+print(f"best time:    {min(times) * 1000:.1f} ms")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""\
+Time how long it takes to plan the master mixes for a plate of reactions, with
+and without pruning the search.
+
+Usage:
+    plan_mixes.py [<num_reagents>...] [-w <num_wells>]
+
+Each reagent has two variants, which are laid out across a 96-well plate in a
+different pattern for each reagent.  This means that many different ways of
+pairing up the reagents are equally good, which is the worst case for the
+planner.
+
+Options:
+    -w --wells <int>  [default: 96]
+        The number of reactions to plan for.  Use a large number to see how
+        the time spent counting combos scales.
+"""
+
+import docopt
+from time import perf_counter
+from stepwise import Reaction
+from stepwise.reaction.mix import *
+
+args = docopt.docopt(__doc__)
+sizes = [int(x) for x in args['<num_reagents>']] or [8, 9, 10]
+num_wells = int(args['--wells'])
+
+def make_reaction(num_reagents, num_wells=96):
+    rxn = Reaction()
+    keys = [f'r{i}' for i in range(num_reagents)]
+    for key in keys:
+        rxn.append_reagent(key)
+
+    combos = [
+            {k: str((w * (i + 3) // 7 + i) % 2) for i, k in enumerate(keys)}
+            for w in range(num_wells)
+    ]
+    return rxn, combos
+
+def plan_mixes_exhaustively(reaction, combos):
+    # Same as `plan_mixes()`, but score every mix, and return the best score.
+    memo = {}
+    components = init_components(reaction, [])
+    components = mix_matching_components(components, combos, memo)
+    filters = [
+            lambda mix: require_solvent_with_volume(mix, reaction.solvent),
+    ]
+    careful_reagents = find_careful_reagents(reaction)
+    order_map = make_order_map(reaction.keys())
+
+    best_score = None
+
+    for mix in iter_complete_mixes(components, combos, filters, memo):
+        score = score_mix(mix, combos, 0, careful_reagents, order_map, memo)
+        if score < best_score:
+            best_score = score
+
+    return best_score
+
+def time(f, *args):
+    t0 = perf_counter()
+    result = f(*args)
+    return result, perf_counter() - t0
+
+print("reagents  pruned  exhaustive  speedup")
+
+for n in sizes:
+    rxn, combos = make_reaction(n, num_wells)
+    mix, t_1 = time(plan_mixes, rxn, combos)
+    best_score, t_2 = time(plan_mixes_exhaustively, rxn, combos)
+
+    # The two searches don't consider the mixes in the same order, so they may
+    # break exact ties differently.  The scores should be the same, though.
+    careful_reagents = find_careful_reagents(rxn)
+    order_map = make_order_map(rxn.keys())
+    score = score_mix(mix, combos, 0, careful_reagents, order_map, {})
+    assert score == best_score
+
+    print(f"{n:>8}  {t_1:>5.2f}s  {t_2:>9.2f}s  {t_2 / t_1:>6.1f}x")
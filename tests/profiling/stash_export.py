@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""\
+Time how long it takes to export and import a large stash.
+
+Usage:
+    stash_export.py [<num_rows>]
+"""
+
+import docopt, io, json
+from time import perf_counter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from stepwise import Protocol
+from stepwise.cli.stash.model import *
+
+args = docopt.docopt(__doc__)
+num_rows = int(args['<num_rows>'] or 10_000)
+
+def make_db():
+    engine = create_engine('sqlite:///:memory:')
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+# Make the source stash by importing generated records, since going through
+# `add_protocol()` for every row would take a while.  Half of the protocols are
+# identical, like those made by a script.
+records = io.StringIO()
+for i in range(1, num_rows + 1):
+    p = Protocol(steps=[f"Step {i % 2 or i}", "Incubate at 37°C for 1h."])
+    p.commands = [f"sw step 'Step {i}'"]
+    record = {
+            'id': i,
+            'message': f'M{i}',
+            'categories': [f'C{i % 5}'],
+            'dependencies': [i - 1] if i % 10 == 0 else [],
+            'protocol': p.format_text(),
+    }
+    records.write(json.dumps(record) + '\n')
+
+src = make_db()
+import_protocols(src, io.BytesIO(records.getvalue().encode()))
+src.commit()
+
+for format in ['json', 'pickle']:
+    buffer = io.StringIO() if format == 'json' else io.BytesIO()
+
+    t0 = perf_counter()
+    export_protocols(src, buffer, format=format)
+    t1 = perf_counter()
+
+    data = buffer.getvalue()
+    if format == 'json':
+        data = data.encode()
+
+    dest = make_db()
+    t2 = perf_counter()
+    import_protocols(dest, io.BytesIO(data))
+    dest.commit()
+    t3 = perf_counter()
+
+    print(f"{format}:")
+    print(f"  size:    {len(data) / 1e6:.1f} MB")
+    print(f"  export:  {num_rows / (t1 - t0):.0f} rows/s")
+    print(f"  import:  {num_rows / (t3 - t2):.0f} rows/s")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""\
+Time how long it takes to list, search, look up, and clean up the protocols in 
+a large stash.
+
+Usage:
+    stash_ls.py [<num_rows>] [-n <repeats>]
+
+Options:
+    -n --repeats <int>  [default: 3]
+        The number of times to repeat each measurement.
+"""
+
+import docopt, io, pickle, random
+from datetime import timedelta
+from timeit import repeat
+from contextlib import redirect_stdout
+from sqlalchemy import create_engine, insert, update
+from sqlalchemy.orm import sessionmaker
+from stepwise import Protocol
+from stepwise.cli.stash.model import *
+from stepwise.cli.stash.model import _summarize_pickle, stash_fts
+
+args = docopt.docopt(__doc__)
+num_rows = int(args['<num_rows>'] or 50_000)
+num_repeats = int(args['--repeats'])
+
+engine = create_engine('sqlite:///:memory:')
+Base.metadata.create_all(engine)
+db = sessionmaker(bind=engine)()
+
+# Insert the rows directly, because going through `add_protocol()` would make
+# setting up the benchmark take much longer than the benchmark itself.  Every
+# tenth protocol depends on the one before it, every protocol belongs to one of
+# a handful of categories, and the search index is filled with random words.
+rng = random.Random(0)
+data = pickle.dumps(Protocol(steps=["A", "B", "C"]))
+summary = _summarize_pickle(data)
+words = ['golden', 'gate', 'gibson', 'pcr', 'digest', 'ligate', 'transform']
+
+db.add(Blob.from_pickle(data))
+db.execute(insert(Category), [{'pk': i, 'name': f'C{i}'} for i in range(1, 6)])
+db.execute(insert(Stash), [
+    {'pk': i, 'id': i, 'is_complete': False, **summary}
+    for i in range(1, num_rows + 1)
+])
+db.execute(insert(stash_categories), [
+    {'stash_pk': i, 'category_pk': rng.randint(1, 5)}
+    for i in range(1, num_rows + 1)
+])
+db.execute(insert(stash_dependencies), [
+    {'upstream_pk': i - 1, 'downstream_pk': i}
+    for i in range(11, num_rows + 1, 10)
+])
+db.execute(insert(stash_fts), [
+    {'rowid': i, 'text': ' '.join(rng.choices(words, k=50)), 'message': f'M{i}'}
+    for i in range(1, num_rows + 1)
+])
+db.commit()
+
+def time(f):
+    def quiet():
+        with redirect_stdout(io.StringIO()):
+            f()
+        db.expire_all()
+
+    return min(repeat(quiet, number=1, repeat=num_repeats))
+
+ids = rng.sample(range(1, num_rows + 1), num_rows // 10)
+
+print(f"rows:             {num_rows}")
+print(f"ls (table):       {time(lambda: list_protocols(db, include_dependents=True)):.2f} s")
+print(f"ls (tsv):         {time(lambda: list_protocols(db, include_dependents=True, format='tsv')):.2f} s")
+print(f"grep:             {time(lambda: grep_protocols(db, f'M{num_rows // 2}')):.3f} s")
+print(f"grep (limit 20):  {time(lambda: grep_protocols(db, 'golden gate', limit=20)):.3f} s")
+print(f"get {len(ids)} ids:".ljust(18) + f"{time(lambda: get_protocols(db, ids)):.2f} s")
+
+# Resetting modifies the stash, so it can only be timed once.  Complete every
+# other protocol, so that there's something to delete.
+db.execute(update(Stash).where(Stash.id % 2 == 0).values(is_complete=True))
+db.commit()
+
+# Compare listing the incomplete protocols before and after the completed ones
+# are moved into the archive.
+print(f"ls (1/2 complete): {time(lambda: list_protocols(db)):.2f} s")
+archive_protocols(db, timedelta(0))
+db.commit()
+print(f"ls (1/2 archived): {time(lambda: list_protocols(db)):.2f} s")
+print(f"ls -a (archived):  {time(lambda: list_protocols(db, include_complete=True)):.2f} s")
+num_repeats = 1
+
+print(f"clear:            {time(lambda: clear_protocols(db)):.2f} s")
+db.rollback()
+print(f"reset:            {time(lambda: reset_protocols(db)):.2f} s")
@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 
-import pytest
+import pytest, json, sys
+from sqlalchemy import text
 
 from stepwise import Protocol, UsageError
 from stepwise.cli.stash.model import *
 
 @pytest.fixture
 def empty_db():
+    return make_empty_db()
+
+@pytest.fixture
+def other_empty_db():
+    return make_empty_db()
+
+def make_empty_db():
     from sqlalchemy import create_engine
     from sqlalchemy.orm import sessionmaker
 
@@ -580,7 +588,12 @@ def test_api_clear(full_db):
             dict(pk=3, id=13, is_complete=True),
     ])
 
-def test_api_reset(full_db):
+@pytest.mark.parametrize('update_from', [True, False])
+def test_api_reset(full_db, update_from, monkeypatch):
+    import stepwise.cli.stash.model as model
+
+    # Older versions of SQLite don't support `UPDATE ... FROM`.
+    monkeypatch.setattr(model, '_supports_update_from', lambda db: update_from)
     db = full_db
 
     assert stash_rows(db) == ul([
@@ -605,6 +618,152 @@ def test_api_reset(full_db):
             dict(pk=3, id=2, is_complete=False),
     ])
 
+@pytest.mark.parametrize('update_from', [True, False])
+def test_api_reset_renumber(empty_db, update_from, monkeypatch):
+    import stepwise.cli.stash.model as model
+
+    monkeypatch.setattr(model, '_supports_update_from', lambda db: update_from)
+    db = empty_db
+
+    for i in range(50):
+        add_protocol(db, Protocol(steps=[str(i)]))
+
+    drop_protocols(db, range(1, 51, 3))
+    reset_protocols(db)
+
+    kept = [i for i in range(50) if i % 3]
+    rows = db.query(Stash).order_by(Stash.id).all()
+    assert [x.id for x in rows] == list(range(1, len(kept) + 1))
+    assert [x.protocol.steps for x in rows] == [[str(i)] for i in kept]
+
+def test_api_archive(full_db):
+    from datetime import timedelta
+
+    db = full_db
+    archive_rows = query_helper(stash_archive.c.pk, stash_archive.c.id)
+
+    # Recently completed protocols aren't archived.
+    drop_protocols(db, [11], archive_after=timedelta(days=1))
+    assert stash_rows(db) == ul([
+            dict(pk=1, id=11, is_complete=True),
+            dict(pk=2, id=12, is_complete=False),
+            dict(pk=3, id=13, is_complete=False),
+    ])
+    assert archive_rows(db) == ul([])
+
+    # Neither are incomplete protocols, no matter how old.
+    pop_protocol(db, 12, archive_after=timedelta(0))
+    assert stash_rows(db) == ul([
+            dict(pk=3, id=13, is_complete=False),
+    ])
+    assert archive_rows(db) == ul([
+            dict(pk=1, id=11),
+            dict(pk=2, id=12),
+    ])
+
+    # Archived protocols are only included when asking for completed 
+    # protocols, and keep their categories.
+    assert [x.id for x in find_protocols(db)] == [13]
+    assert [x.id for x in find_protocols(db, include_complete=True)] == [11, 12, 13]
+    assert [x.id for x in find_protocols(db, categories=['A'], include_complete=True)] == [12]
+    assert [x.id for x in find_protocols(db, dependencies=[11])] == [13]
+    assert [x.id for x, _ in search_protocols(db, 'Y')] == []
+    assert [x.id for x, _ in search_protocols(db, 'Y', include_complete=True)] == [12]
+
+    # Ids and primary keys aren't reused.
+    p4 = add_protocol(db, Protocol(steps=["W"]), dependencies=[13])
+    assert (p4.pk, p4.id) == (4, 14)
+
+    # Archived protocols can be looked up (and depended on) without moving 
+    # them back into the stash.
+    assert get_protocol(db, 11).protocol.steps == ["X"]
+    assert [x.id for x in get_protocols(db, [13, 11])] == [13, 11]
+
+    p5 = add_protocol(db, Protocol(steps=["V"]), dependencies=[11])
+    assert (p5.pk, p5.id) == (5, 15)
+    assert stash_dependency_rows(db) == ul([
+            dict(upstream_pk=1, downstream_pk=3),
+            dict(upstream_pk=3, downstream_pk=4),
+            dict(upstream_pk=1, downstream_pk=5),
+    ])
+    assert archive_rows(db) == ul([
+            dict(pk=1, id=11),
+            dict(pk=2, id=12),
+    ])
+
+    # Restoring or editing an archived protocol moves it back into the stash.
+    restore_protocols(db, [12])
+    edit_protocol(db, 11, message="Z")
+    assert stash_rows(db) == ul([
+            dict(pk=1, id=11, is_complete=True),
+            dict(pk=2, id=12, is_complete=False),
+            dict(pk=3, id=13, is_complete=False),
+            dict(pk=4, id=14, is_complete=False),
+            dict(pk=5, id=15, is_complete=False),
+    ])
+    assert archive_rows(db) == ul([])
+
+    # Resetting deletes archived protocols, too.
+    clear_protocols(db, archive_after=timedelta(0))
+    assert stash_rows(db) == ul([])
+    assert archive_rows(db) == ul([
+            dict(pk=1, id=11),
+            dict(pk=2, id=12),
+            dict(pk=3, id=13),
+            dict(pk=4, id=14),
+            dict(pk=5, id=15),
+    ])
+
+    reset_protocols(db)
+    assert stash_rows(db) == ul([])
+    assert archive_rows(db) == ul([])
+    assert stash_category_rows(db) == ul([])
+    assert stash_dependency_rows(db) == ul([])
+    assert db.query(Blob).count() == 0
+
+@pytest.mark.parametrize(
+        'modify, expected', [
+            (
+                lambda db: drop_protocols(db, [11, 12]),
+                [(11, True), (12, True), (13, False)],
+            ), (
+                lambda db: pop_protocol(db, 11),
+                [(11, True), (12, False), (13, False)],
+            ), (
+                lambda db: restore_protocols(db, [11]),
+                [(11, False), (12, False), (13, False)],
+            ), (
+                lambda db: edit_protocol(db, 11, message="Z"),
+                [(11, True), (12, False), (13, False)],
+            ), (
+                lambda db: edit_protocol(db, 12, dependencies=[11]),
+                [(11, True), (12, False), (13, False)],
+            ), (
+                lambda db: add_protocol(db, Protocol(), dependencies=[11]),
+                [(11, True), (12, False), (13, False), (14, False)],
+            ), (
+                lambda db: reset_protocols(db),
+                [(1, False), (2, False)],
+            ),
+        ],
+)
+def test_api_archive_modify(full_db, modify, expected):
+    from datetime import timedelta
+
+    db = full_db
+    drop_protocols(db, [11], archive_after=timedelta(0))
+    db.commit()
+
+    # Read the archived protocol first, so that the session already has a row 
+    # for it that came from the archive.
+    assert get_protocol(db, 11).is_complete
+
+    modify(db)
+    db.commit()
+
+    rows = find_protocols(db, include_complete=True)
+    assert [(x.id, x.is_complete) for x in rows] == expected
+
 def test_api_reset_categories_1(empty_db):
     db = empty_db
     add_protocol(db, Protocol(), categories=['A'])
@@ -908,6 +1067,298 @@ def test_api_find_protocols_dependencies(empty_db):
     hits = find_protocols(db)
     assert {x.id for x in hits} == {p3.id}
 
+@pytest.fixture
+def graph_db(empty_db):
+    """
+    Initialize a database with a diamond of dependencies:
+
+        1 → 2 → 4
+          ↘ 3 ↗
+
+    plus one protocol (5) with no dependencies.
+    """
+    db = empty_db
+    add_protocol(db, Protocol(), message='1')
+    add_protocol(db, Protocol(), message='2', dependencies=[1])
+    add_protocol(db, Protocol(), message='3', dependencies=[1])
+    add_protocol(db, Protocol(), message='4', dependencies=[2, 3])
+    add_protocol(db, Protocol(), message='5')
+    db.commit()
+    return db
+
+def test_api_query_blocked_by(graph_db):
+    db = graph_db
+
+    def blocked_by(id, **kwargs):
+        return [x.id for x in query_blocked_by(db, id, **kwargs)]
+
+    assert blocked_by(1) == [2, 3, 4]
+    assert blocked_by(2) == [4]
+    assert blocked_by(4) == []
+    assert blocked_by(5) == []
+
+    drop_protocols(db, [2])
+    assert blocked_by(1) == [3, 4]
+    assert blocked_by(1, include_complete=True) == [2, 3, 4]
+
+    with pytest.raises(UsageError, match="No stashed protocol with id '6'"):
+        blocked_by(6)
+
+def test_api_query_blocking(graph_db):
+    db = graph_db
+
+    def blocking(id, **kwargs):
+        return [x.id for x in query_blocking(db, id, **kwargs)]
+
+    assert blocking(1) == []
+    assert blocking(2) == [1]
+    assert blocking(4) == [1, 2, 3]
+    assert blocking(5) == []
+
+    drop_protocols(db, [1])
+    assert blocking(4) == [2, 3]
+    assert blocking(4, include_complete=True) == [1, 2, 3]
+
+def test_api_query_ready(graph_db):
+    db = graph_db
+
+    def ready():
+        return [x.id for x in query_ready(db)]
+
+    assert ready() == [1, 5, 2, 3, 4]
+
+    drop_protocols(db, [1])
+    assert ready() == [2, 3, 5, 4]
+
+    edit_protocol(db, 5, dependencies=[4])
+    assert ready() == [2, 3, 4, 5]
+
+def test_api_query_tree(graph_db):
+    db = graph_db
+
+    def tree():
+        return [(x.id, depth) for x, depth, path in query_tree(db)]
+
+    assert tree() == [(1, 0), (2, 1), (4, 2), (3, 1), (4, 2), (5, 0)]
+
+    drop_protocols(db, [2])
+    assert tree() == [(1, 0), (3, 1), (4, 2), (5, 0)]
+
+def test_api_list_protocols_tree(graph_db, capsys):
+    list_protocols(graph_db, tree=True)
+    assert capsys.readouterr().out == """\
+#  Dep  Name          Message
+─────────────────────────────
+1       protocol      1
+2    1    protocol    2
+4  2,3      protocol  4
+3    1    protocol    3
+4  2,3      protocol  4
+5       protocol      5
+"""
+
+def test_api_list_protocols_blocked_by(graph_db, capsys):
+    list_protocols(graph_db, blocked_by=5)
+    assert capsys.readouterr().out == "No matching protocols found.\n"
+
+def test_api_edit_cycle(graph_db):
+    db = graph_db
+
+    with pytest.raises(UsageError, match="Cannot add '4' as a dependency of '1', because '4' already depends on '1'"):
+        edit_protocol(db, 1, dependencies=[4])
+    with pytest.raises(UsageError, match="Cannot add '2' as a dependency of '1', because '2' already depends on '1'"):
+        edit_protocol(db, 1, dependencies=[5, 2])
+
+    # Dependencies that don't create a cycle are fine.
+    edit_protocol(db, 5, dependencies=[4])
+    edit_protocol(db, 3, dependencies=[1, 2])
+    assert [x.id for x in query_blocking(db, 5)] == [1, 2, 3, 4]
+
+@pytest.fixture
+def search_db(empty_db):
+    db = empty_db
+
+    p1 = Protocol(steps=["Assemble the Golden Gate reaction", "Transform"])
+    p1.commands = ["sw golden_gate pKBK1 insert"]
+    add_protocol(db, p1, message="cloning")
+
+    p2 = Protocol(steps=["Run a PCR reaction"])
+    add_protocol(db, p2, message="amplify insert")
+
+    p3 = Protocol(steps=["Digest with BsaI"])
+    add_protocol(db, p3)
+
+    db.commit()
+    return db
+
+@pytest.mark.parametrize(
+        'query, expected', [
+            ('golden', [1]),
+            ('golden gate', [1]),
+            ('"gate golden"', []),
+            ('reaction', [2, 1]),
+            ('react*', [2, 1]),
+            ('insert', [2, 1]),
+            ('message: insert', [2]),
+            ('commands: pkbk1', [1]),
+            ('bsai OR pcr', [3, 2]),
+            ('amplifying', [2]),
+            ('nothing', []),
+
+            # Invalid FTS5 syntax is searched for literally.
+            ('golden-gate', [1]),
+            ('slug:', []),
+        ]
+)
+def test_api_search_protocols(search_db, query, expected):
+    hits = search_protocols(search_db, query)
+    assert [row.id for row, snippet in hits] == expected
+
+def test_api_search_protocols_snippet(search_db):
+    hits = search_protocols(search_db, 'golden', highlight=('<', '>'))
+    assert len(hits) == 1
+    assert '<golden>_gate' in hits[0][1]
+
+def test_api_search_protocols_update(search_db):
+    db = search_db
+
+    assert search_protocols(db, 'sequencing') == []
+
+    edit_protocol(db, 3, message="for sequencing")
+    assert [x.id for x, _ in search_protocols(db, 'sequencing')] == [3]
+
+    edit_protocol(db, 3, Protocol(steps=["Digest with EcoRI"]))
+    assert [x.id for x, _ in search_protocols(db, 'ecori')] == [3]
+    assert [x.id for x, _ in search_protocols(db, 'bsai')] == []
+
+    drop_protocols(db, [3])
+    assert search_protocols(db, 'ecori') == []
+    assert [x.id for x, _ in search_protocols(db, 'ecori', include_complete=True)] == [3]
+
+    reset_protocols(db)
+    assert search_protocols(db, 'ecori', include_complete=True) == []
+    assert db.execute(text('SELECT count(*) FROM stash_fts')).scalar() == 2
+
+def test_api_grep_protocols(search_db, capsys):
+    grep_protocols(search_db, 'insert')
+    assert capsys.readouterr().out == """\
+2  protocol     amplify insert
+   amplify [insert]
+1  golden_gate  cloning
+   sw golden_gate pKBK1 [insert]
+"""
+
+    grep_protocols(search_db, 'nothing')
+    assert capsys.readouterr().out == "No matching protocols found.\n"
+
+def test_api_search_without_fts5(monkeypatch, capsys):
+    import io
+    import stepwise.cli.stash.model as model
+    from sqlalchemy import inspect
+
+    monkeypatch.setattr(model, '_has_fts5', lambda conn: False)
+    db = make_empty_db()
+    assert not inspect(db.connection()).has_table('stash_fts')
+
+    p1 = Protocol(steps=["Assemble the Golden Gate reaction"])
+    p1.commands = ["sw golden_gate pKBK1 insert"]
+    add_protocol(db, p1, message="cloning 100%")
+    add_protocol(db, Protocol(steps=["Run a PCR reaction"]), message="amplify insert")
+    edit_protocol(db, 2, message="amplify insert for golden gate")
+
+    # Without the full-text index, only the names and messages are searched.
+    assert [x.id for x, _ in search_protocols(db, 'golden')] == [1, 2]
+    assert [x.id for x, _ in search_protocols(db, 'GOLDEN insert')] == [2]
+    assert [x.id for x, _ in search_protocols(db, 'reaction')] == []
+    assert [x.id for x, _ in search_protocols(db, 'pkbk1')] == []
+    assert [x.id for x, _ in search_protocols(db, '1%')] == []
+    assert [x.id for x, _ in search_protocols(db, '100%')] == [1]
+
+    grep_protocols(db, 'insert')
+    assert capsys.readouterr().out == """\
+2  protocol  amplify insert for golden gate
+"""
+
+    drop_protocols(db, [1])
+    assert [x.id for x, _ in search_protocols(db, 'golden')] == [2]
+    assert [x.id for x, _ in search_protocols(db, 'golden', include_complete=True)] == [1, 2]
+
+    buffer = io.StringIO()
+    export_protocols(db, buffer, format='json')
+    assert import_protocols(db, io.BytesIO(buffer.getvalue().encode())) == 1
+    assert [x.id for x, _ in search_protocols(db, 'golden')] == [2, 4]
+
+    reset_protocols(db)
+    assert [x.id for x, _ in search_protocols(db, 'golden')] == [1, 2]
+
+@pytest.mark.parametrize('format', ['json', 'pickle'])
+def test_api_export_import(full_db, other_empty_db, format):
+    import io
+    from datetime import timedelta
+
+    # Archive one of the protocols, to make sure that its dependencies are 
+    # exported.
+    drop_protocols(full_db, [11], archive_after=timedelta(0))
+    drop_protocols(full_db, [12])
+    full_rows = get_protocols(full_db, [11, 12, 13])
+
+    buffer = io.StringIO() if format == 'json' else io.BytesIO()
+    export_protocols(full_db, buffer, include_complete=True, format=format)
+
+    data = buffer.getvalue()
+    if format == 'json':
+        data = data.encode('utf-8')
+
+    # Import twice, to make sure that the ids don't conflict.
+    db = other_empty_db
+    assert import_protocols(db, io.BytesIO(data)) == 3
+    assert import_protocols(db, io.BytesIO(data)) == 3
+    db.commit()
+
+    rows = db.query(Stash).order_by(Stash.id).all()
+    assert [x.id for x in rows] == [11, 12, 13, 24, 25, 26]
+    assert [x.is_complete for x in rows] == [True, True, False] * 2
+    assert [x.message for x in rows] == ['M', None, None] * 2
+    assert [[c.name for c in x.categories] for x in rows] == [[], ['A'], []] * 2
+    assert [[d.id for d in x.upstream_deps] for x in rows] == [[], [], [11], [], [], [24]]
+    assert [x.protocol.format_text() for x in rows] == ['1. X', '1. Y', '1. Z'] * 2
+    assert [x.slug for x in rows] == ['protocol'] * 6
+    assert [x.date_added for x in rows] == [x.date_added for x in full_rows] * 2
+    assert [x.date_completed for x in rows] == [x.date_completed for x in full_rows] * 2
+    assert rows[0].date_completed is not None
+
+    # Identical protocols should share blobs, and categories shouldn't be 
+    # duplicated.
+    assert db.query(Blob).count() == 3
+    assert db.query(Category).count() == 1
+
+    # The imported protocols should be searchable.
+    assert [x.id for x, _ in search_protocols(db, 'Z')] == [13, 26]
+
+def test_api_export_filter(full_db, other_empty_db):
+    import io
+
+    buffer = io.StringIO()
+    export_protocols(full_db, buffer, categories=['A'])
+
+    records = [json.loads(x) for x in buffer.getvalue().splitlines()]
+    assert [x['id'] for x in records] == [12]
+    assert records[0]['protocol'] == '1. Y'
+
+    # Dependencies on protocols that weren't exported are dropped.
+    buffer = io.StringIO()
+    export_protocols(full_db, buffer)
+    lines = buffer.getvalue().splitlines()
+
+    db = other_empty_db
+    import_protocols(db, io.BytesIO(lines[2].encode('utf-8')))
+    row = get_protocol(db, 13)
+    assert row.upstream_deps == []
+
+def test_api_import_empty(empty_db):
+    import io
+    assert import_protocols(empty_db, io.BytesIO(b'')) == 0
+
 def test_api_get_protocol(empty_db):
     db = empty_db
 
@@ -956,6 +1407,8 @@ def test_api_get_protocols(full_db):
         get_protocols(db, [1])
     with pytest.raises(UsageError, match="No stashed protocol with id '1'"):
         get_protocols(db, [1, 11])
+    with pytest.raises(UsageError, match="No stashed protocols with ids '1', '2'"):
+        get_protocols(db, [1, 11, 2, 1])
 
 def test_api_get_or_create_categories(empty_db):
     db = empty_db
@@ -1049,6 +1502,327 @@ def test_api_unreadable_protocol(empty_db, capsys):
     row = peek_protocol(db, 1)
     assert row.protocol == "failed to unpickle stashed protocol:\nZeroDivisionError: "
 
+def test_api_list_protocols_json(full_db, capsys):
+    list_protocols(full_db, include_dependents=True, format='json')
+    assert capsys.readouterr().out == """\
+{"id": 11, "errors": false, "dependencies": [], "name": "protocol", "categories": [], "message": "M"}
+{"id": 12, "errors": false, "dependencies": [], "name": "protocol", "categories": ["A"], "message": null}
+{"id": 13, "errors": false, "dependencies": [11], "name": "protocol", "categories": [], "message": null}
+"""
+
+def test_api_list_protocols_tsv(full_db, capsys):
+    list_protocols(full_db, include_dependents=True, format='tsv')
+    assert capsys.readouterr().out == """\
+#\tErr\tDep\tName\tCategory\tMessage
+11\t\t\tprotocol\t\tM
+12\t\t\tprotocol\tA\t
+13\t\t11\tprotocol\t\t
+"""
+
+def test_api_list_protocols_stream(full_db, capsys, monkeypatch):
+    import stepwise.cli.stash.model as model
+    from datetime import timedelta
+    monkeypatch.setattr(model, '_LIST_SAMPLE_SIZE', 1)
+
+    list_protocols(full_db, include_dependents=True)
+    assert capsys.readouterr().out == """\
+ #  Dep  Name      Category  Message
+────────────────────────────────────
+11       protocol            M
+12       protocol  A
+13   11  protocol
+"""
+
+    # Only the first row is used to measure the columns, but the columns are 
+    # chosen based on every row (including archived ones).
+    drop_protocols(full_db, [11], archive_after=timedelta(0))
+
+    list_protocols(full_db, include_dependents=True, include_complete=True)
+    assert capsys.readouterr().out == """\
+ #  Name      Category  Message
+───────────────────────────────
+11  protocol            M
+12  protocol  A
+13  protocol
+"""
+
+
+def test_api_summary(empty_db):
+    db = empty_db
+
+    p = add_protocol(db, Protocol(steps=["A", "B"]))
+    assert p.slug == 'protocol'
+    assert p.has_errors == False
+    assert p.num_steps == 2
+    assert p.num_bytes > 0
+    assert len(p.content_hash) == 64
+
+    hash = p.content_hash
+    edit_protocol(db, 1, Protocol(steps=["C"]))
+    assert p.num_steps == 1
+    assert p.content_hash != hash
+
+def test_api_blobs(empty_db):
+    db = empty_db
+
+    # Identical protocols should share the same blob.
+    p1 = add_protocol(db, Protocol(steps=["A"]))
+    p2 = add_protocol(db, Protocol(steps=["A"]))
+    p3 = add_protocol(db, Protocol(steps=["B"]))
+    db.commit()
+
+    assert p1.blob is p2.blob
+    assert p1.blob is not p3.blob
+    assert db.query(Blob).count() == 2
+
+    # Editing a protocol shouldn't affect other rows sharing the same blob.
+    edit_protocol(db, 1, Protocol(steps=["B"]))
+    db.commit()
+
+    assert p1.blob is p3.blob
+    assert p2.protocol.steps == ["A"]
+    assert db.query(Blob).count() == 2
+
+    # Blobs are only deleted once nothing refers to them.
+    drop_protocols(db, [1, 2])
+    reset_protocols(db)
+    assert db.query(Blob).count() == 1
+
+    drop_protocols(db, [1])
+    reset_protocols(db)
+    assert db.query(Blob).count() == 0
+
+@pytest.mark.parametrize(
+        'data, compression', [
+            (b'A' * 1000, 'zlib'),
+            (b'A', None),
+        ]
+)
+def test_api_blob_compression(data, compression):
+    blob = Blob.from_pickle(data)
+    assert blob.compression == compression
+    assert blob.pickle == data
+    assert len(blob.data) <= len(data)
+
+def test_api_list_protocols_deferred(full_db, capsys):
+    from sqlalchemy import inspect
+
+    db = full_db
+    db.expire_all()
+
+    list_protocols(db, include_dependents=True, format='json')
+    assert capsys.readouterr().out.count('"name": "protocol"') == 3
+
+    # Listing the protocols shouldn't require loading any of them.
+    rows = db.query(Stash).all()
+    assert all('blob' in inspect(x).unloaded for x in rows)
+    assert db.query(Blob).count() == 3
+    assert not any(isinstance(x, Blob) for x in db.identity_map.values())
+
+def test_api_migrate_summary(tmp_path):
+    import sqlite3, pickle
+    from hashlib import sha256
+
+    # Make a database with the schema used before the summary columns were 
+    # added.
+    path = tmp_path / 'stash.sqlite'
+    conn = sqlite3.connect(path)
+    conn.execute('''\
+CREATE TABLE stash (
+    pk INTEGER PRIMARY KEY,
+    id INTEGER UNIQUE,
+    date_added DATETIME,
+    is_complete BOOLEAN,
+    message VARCHAR,
+    protocol BLOB
+)''')
+    data = pickle.dumps(Protocol(steps=["A", "B"]))
+    conn.executemany(
+            'INSERT INTO stash (pk, id, is_complete, protocol) VALUES (?, ?, 0, ?)', [
+                (1, 1, data),
+                (2, 2, b'not a pickle'),
+            ],
+    )
+    conn.commit()
+    conn.close()
+
+    with open_db(path) as db:
+        p1, p2 = db.query(Stash).order_by(Stash.id).all()
+
+        assert p1.slug == 'protocol'
+        assert p1.has_errors == False
+        assert p1.num_steps == 2
+        assert p1.num_bytes == len(data)
+        assert p1.content_hash == sha256(data).hexdigest()
+
+        assert p2.slug == None
+        assert p2.has_errors == True
+        assert p2.num_steps == None
+        assert p2.num_bytes == len(b'not a pickle')
+
+        # The protocols should also be added to the search index.
+        assert [x.id for x, _ in search_protocols(db, 'B')] == [1]
+
+        # The pickles should be moved into the blobs table.
+        assert p1.protocol.steps == ["A", "B"]
+        assert p1.blob.pickle == data
+        assert db.query(Blob).count() == 2
+        assert db.execute(text('SELECT protocol FROM stash')).all() == [(None,), (None,)]
+
+    # Opening the database again shouldn't change anything.
+    with open_db(path) as db:
+        assert db.query(Stash.num_steps).order_by(Stash.id).all() == [(2,), (None,)]
+
+
+def test_api_migrate_archive(tmp_path):
+    import sqlite3
+    import stepwise.cli.stash.model as model
+
+    # Make a database with the schema used before protocols could be 
+    # archived.  Unlike older databases, this schema doesn't have a protocol 
+    # column.
+    path = tmp_path / 'stash.sqlite'
+
+    with open_db(path) as db:
+        add_protocol(db, Protocol(steps=["A"]))
+
+    model._engines.pop(str(path.resolve())).dispose()
+
+    conn = sqlite3.connect(path)
+    conn.execute('ALTER TABLE stash DROP COLUMN date_completed')
+    conn.execute('DROP TABLE stash_archive')
+    conn.execute('PRAGMA user_version = 3')
+    conn.commit()
+    conn.close()
+
+    with open_db(path) as db:
+        assert db.query(Stash.id, Stash.date_completed).all() == [(1, None)]
+        assert db.query(stash_archive).all() == []
+        assert get_protocol(db, 1).protocol.steps == ["A"]
+
+def test_api_open_db(tmp_path, monkeypatch):
+    import stepwise.cli.stash.model as model
+    path = tmp_path / 'stash.sqlite'
+
+    with open_db(path) as db:
+        add_protocol(db, Protocol(steps=["A"]))
+
+    with open_db(path, read_only=True) as db:
+        assert db.get_bind() is model._engines[str(path)]
+        assert db.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert db.execute(text('PRAGMA user_version')).scalar() == model._SCHEMA_VERSION
+        assert db.query(Stash.id).all() == [(1,)]
+
+    # A new engine shouldn't recreate the schema, because the database is 
+    # already marked as being up-to-date.
+    def create_all(*args, **kwargs):
+        raise AssertionError("schema recreated")
+
+    monkeypatch.setattr(model, '_engines', {})
+    monkeypatch.setattr(Base.metadata, 'create_all', create_all)
+
+    with open_db(path, read_only=True) as db:
+        assert db.query(Stash.id).all() == [(1,)]
+
+def test_api_open_db_read_only_archive(tmp_path):
+    from datetime import timedelta
+    from sqlalchemy import event
+    import stepwise.cli.stash.model as model
+    path = tmp_path / 'stash.sqlite'
+
+    with open_db(path) as db:
+        add_protocol(db, Protocol(steps=["A"]))
+        add_protocol(db, Protocol(steps=["B"]), dependencies=[1])
+        drop_protocols(db, [1], archive_after=timedelta(0))
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement.split()[0].upper())
+
+    engine = model._engines[str(path)]
+    event.listen(engine, 'before_cursor_execute', record)
+
+    try:
+        # Looking up archived protocols shouldn't write to the database.
+        with open_db(path, read_only=True) as db:
+            assert get_protocol(db, 1).protocol.steps == ["A"]
+            assert [x.id for x in query_blocking(db, 2, include_complete=True)] == [1]
+            assert [x.id for x in query_blocked_by(db, 1)] == [2]
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+    assert statements
+    assert not {'INSERT', 'UPDATE', 'DELETE'} & set(statements)
+
+def test_api_open_db_concurrent(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    path = tmp_path / 'stash.sqlite'
+
+    def add(i):
+        with open_db(path) as db:
+            add_protocol(db, Protocol(steps=[str(i)]))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(add, range(40)))
+
+    with open_db(path, read_only=True) as db:
+        ids = [x for x, in db.query(Stash.id)]
+        assert sorted(ids) == list(range(1, 41))
+
+@pytest.mark.parametrize(
+        'argv, steps, read_only', [
+            ([], [], True),
+            (['ls'], [], True),
+            (['grep', 'A'], [], True),
+            (['peek', '1'], [], True),
+            (['export'], [], True),
+            ([], ["A"], False),
+            (['add'], ["A"], False),
+            (['drop', '1'], [], False),
+            (['edit', '1'], [], False),
+        ],
+)
+def test_cli_open_db_read_only(argv, steps, read_only, monkeypatch):
+    import stepwise.cli.stash.main as main
+    import stepwise.cli.stash.model as model
+    from contextlib import contextmanager
+    from unittest.mock import MagicMock
+
+    calls = []
+
+    @contextmanager
+    def open_db(path=None, *, read_only=False):
+        calls.append(bool(read_only))
+        yield MagicMock()
+
+    monkeypatch.setattr(model, 'open_db', open_db)
+    monkeypatch.setattr(main, 'protocol_from_stdin', lambda: Protocol(steps=steps))
+    monkeypatch.setattr(main.Stash, 'show_protocol', lambda self, row: None)
+    for name in dir(model):
+        if name.endswith(('_protocol', '_protocols')):
+            monkeypatch.setattr(model, name, MagicMock())
+
+    monkeypatch.setattr(sys, 'argv', ['stepwise', 'stash', *argv])
+    main.Stash().main()
+
+    assert calls == [read_only]
+
+def test_api_dispose_engines(tmp_path, monkeypatch):
+    import stepwise.cli.stash.model as model
+    monkeypatch.setattr(model, '_engines', {})
+    path = tmp_path / 'stash.sqlite'
+
+    with open_db(path) as db:
+        add_protocol(db, Protocol(steps=["A"]))
+
+    engine = model._engines[str(path)]
+    assert engine.pool.checkedin() == 1
+
+    model._dispose_engines()
+    assert model._engines == {}
+    assert engine.pool.checkedin() == 0
+
 
 @pytest.fixture
 def empty_stash(check_command):
@@ -1169,6 +1943,79 @@ No matching protocols found.
 3  step
 ''')
 
+@pytest.mark.slow
+def test_cli_ls_graph(empty_stash, check_command):
+    check_command('sw step 1 | sw stash')
+    check_command('sw step 2 | sw stash -d 1')
+    check_command('sw step 3 | sw stash -d 2')
+
+    check_command('sw stash ls -t', '''\
+#  Dep  Name      Message
+─────────────────────────
+1       step
+2    1    step
+3    2      step
+''')
+
+    check_command('sw stash ls -r', '''\
+#  Dep  Name  Message
+─────────────────────
+1       step
+2    1  step
+3    2  step
+''')
+
+    check_command('sw stash ls --blocked-by 2', '''\
+#  Dep  Name  Message
+─────────────────────
+3    2  step
+''')
+
+    check_command('sw stash ls --blocking 2', '''\
+#  Name  Message
+────────────────
+1  step
+''')
+
+    check_command(
+            'sw stash edit 1 -d 3',
+            stderr=r".*Cannot add '3' as a dependency of '1', because '3' already depends on '1'\.",
+            return_code=1,
+    )
+
+@pytest.mark.slow
+def test_cli_grep(empty_stash, check_command):
+    check_command('sw step "Golden Gate assembly" | sw stash -m M1')
+    check_command('sw step "PCR" | sw stash -m M2')
+
+    check_command('sw stash grep golden', '''\
+1  step  M1
+   \\$ sw step '\\[Golden\\] Gate assembly'
+   1. \\[Golden\\] Gate assembly
+''')
+
+    check_command('sw stash grep -n 1 m1 OR m2', r'^\d  step  M\d\n   \[M\d\]$')
+
+    check_command('sw stash grep nothing', 'No matching protocols found.')
+
+@pytest.mark.slow
+def test_cli_export_import(full_stash, check_command):
+    check_command('sw stash export', r'^\{{"id": 1, .*"protocol": "\$ sw step X\\n\\n1. X"\}}\n.*')
+    check_command('sw stash export --pickle | sw stash import', stderr='Imported 3 protocols.')
+    check_command('sw stash export -c A | sw stash import', stderr='Imported 2 protocols.')
+    check_command('sw stash -D', '''\
+ #  Dep  Name  Category  Message
+────────────────────────────────
+ 1       step            M
+ 2       step  A
+ 3    1  step
+ 4       step            M
+ 5       step  A
+ 6    4  step
+ 8       step  A
+11       step  A
+''')
+
 @pytest.mark.slow
 def test_cli_ls_completed(empty_stash, check_command):
     check_command('sw step 1 | sw stash')
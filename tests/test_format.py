@@ -19,6 +19,122 @@ def test_repr(obj, expected):
 def test_format_text(obj, width, expected, kwargs):
     assert stepwise.format_text(obj, width, **kwargs) == expected
 
+@parametrize_from_file(
+        key='test_format_text',
+        schema=[
+            cast(obj=with_sw.eval, width=with_py.eval, kwargs=with_py.eval),
+            defaults(kwargs={}),
+        ],
+)
+def test_iter_lines(obj, width, expected, kwargs):
+    lines = list(stepwise.iter_lines(obj, width, **kwargs))
+    assert '\n'.join(lines) == expected
+
+@parametrize('render', [stepwise.format_text, stepwise.iter_lines])
+def test_cache_key_once_per_render(render, monkeypatch):
+    from stepwise.format.lists import List
+    from collections import Counter
+
+    calls = Counter()
+    cache_key = List._cache_key
+
+    def spy(self):
+        calls[id(self)] += 1
+        return cache_key(self)
+
+    monkeypatch.setattr(List, '_cache_key', spy)
+
+    x = ul('a')
+    for i in range(5):
+        x = ul(x, 'b')
+
+    expected = stepwise.format_text(x, inf)
+    calls.clear()
+
+    # Change the innermost list, so that every level has to be rendered again 
+    # and every level checks its own cache.
+    y = x
+    for i in range(5):
+        y = y[0]
+    y[0] = 'c'
+
+    assert '\n'.join(render(x, inf)) != expected
+    assert len(calls) == 6
+    assert set(calls.values()) == {1}
+
+def test_table_cache():
+    x = table([['a', 'b']])
+    stepwise.format_text(x, inf)
+    assert '_format_cache' in x.__dict__
+
+    # Cells that aren't strings might be mutable, so they aren't cached.
+    y = table([['a', ['b']]], format=[str, str], align='<<')
+    stepwise.format_text(y, inf)
+    assert '_format_cache' not in y.__dict__
+
+    z = table([['a', 1]])
+    stepwise.format_text(z, inf)
+    assert '_format_cache' not in z.__dict__
+
+def test_table_width():
+    # Tables are fit to the given width, not to the terminal.
+    x = table([['a', 'b c d e f g h']], truncate='-x')
+    assert stepwise.format_text(x, 8) == 'a  b c…'
+    assert stepwise.format_text(x, inf) == 'a  b c d e f g h'
+
+@parametrize(
+        'obj', [
+            '',
+            'a b c',
+            'a  b\nc \nd',
+            '  indented\n  text',
+            'tabs\tand\ttabs',
+            'trailing whitespace \n',
+            'non-breaking space\xa0',
+            pre('a\n  b'),
+            ul('a b', 'c\nd'),
+            dl(('a', 'b c'), ('d', pre('e\nf'))),
+        ],
+)
+def test_canonical_text(obj):
+    assert stepwise.canonical_text(obj) == stepwise.format_text(obj, inf)
+
+@parametrize(
+        'text', [
+            '',
+            'a b c',
+            'a  b\nc \nd',
+            '  indented\n  text',
+            'well-hyphenated words',
+            'supercalifragilisticexpialidocious is long',
+            'tabs\tand\ttabs',
+        ],
+)
+@parametrize('width', [1, 3, 8, 13, inf])
+@parametrize(
+        'kwargs', [
+            {},
+            dict(initial_indent='1. ', subsequent_indent='   '),
+            dict(initial_indent='[1] ', subsequent_indent=''),
+            dict(break_on_hyphens=False),
+        ],
+)
+def test_layout_fill(text, width, kwargs):
+    import re, textwrap
+    from stepwise.format.layout import fill
+
+    # The layout engine should break lines exactly like `textwrap`, even when 
+    # the same text is reflowed to a different width.
+    expected = textwrap.fill(
+            textwrap.dedent(re.sub(r'(?m) $', '', text)),
+            width,
+            drop_whitespace=True,
+            break_long_words=False,
+            **kwargs,
+    )
+    assert fill(text, width, **kwargs) == expected
+    assert fill(text, width, **kwargs) == expected
+
 @parametrize_from_file(
         schema=cast(
             obj=with_sw.eval,
@@ -39,6 +155,39 @@ def test_replace_text(obj, pattern, repl, count, expected, n):
     assert obj_repl == expected
     assert state['n'] == n
 
+def test_text_spans():
+    steps = [
+            'a b',
+            pl('a', ul('b', 'a')),
+            'c',
+            dl(('a', pre('a b'))),
+    ]
+    spans = stepwise.TextSpans(*steps)
+
+    # Search the steps in reverse order, but the text within each step in 
+    # forward order.
+    assert spans.subn('a', 'x', count=3, reverse=True) == 3
+    assert spans.objs == [
+            'a b',
+            pl('x', ul('b', 'a')),
+            'c',
+            dl(('x', pre('x b'))),
+    ]
+
+    # Substitutions are made in place, where possible.
+    assert spans.objs[1] is steps[1]
+    assert spans.objs[3] is steps[3]
+
+    assert spans.subn('a', 'y') == 2
+    assert spans.objs == [
+            'y b',
+            pl('x', ul('b', 'y')),
+            'c',
+            dl(('x', pre('x b'))),
+    ]
+
+    assert spans.subn('z', 'y') == 0
+
 def test_list_operators():
     x = stepwise.List()
     assert len(x) == 0
@@ -132,6 +281,20 @@ def test_table_operators():
     assert x != stepwise.table([['a']], header=['x'], footer=['c'])
     assert x != stepwise.table([['a']], header=['b'], footer=['x'])
 
+def test_table_text_slots():
+    rows = (('a', 'b'), ('c', 'd'))
+    header = ('h', 'a')
+    x = stepwise.table(rows, header=header)
+
+    assert stepwise.TextSpans(x).subn('z', 'y') == 0
+    assert x.rows is rows
+    assert x.header is header
+
+    assert stepwise.TextSpans(x).subn('a', 'x') == 2
+    assert x == stepwise.table([['x', 'b'], ['c', 'd']], header=['h', 'x'])
+    assert rows == (('a', 'b'), ('c', 'd'))
+    assert header == ('h', 'a')
+
 def test_pre_operators():
     x = stepwise.pre('a')
     assert x == stepwise.pre('a')
@@ -42,6 +42,52 @@ def test_tabulate(rows, header, footer, format, align, truncate, max_width, expe
     )
     assert table == expected.strip('\n')
 
+    # The table should be exactly the same when written to a stream.
+    from io import StringIO
+    buf = StringIO()
+    ret = stepwise.tabulate(
+            rows,
+            header=header,
+            footer=footer,
+            format=format,
+            align=align,
+            truncate=truncate,
+            max_width=max_width,
+            file=buf,
+    )
+    assert ret is None
+    assert buf.getvalue() == expected.strip('\n')
+
+def test_iter_tabulate_stream():
+    rows = [
+            [1, 'a', 'short'],
+            [2, 'bb', 'a little longer'],
+    ]
+    header = ['#', 'Name', 'Message']
+    kwargs = dict(truncate='--x', max_width=80)
+
+    # With no more rows than the sample size, the table should be exactly the 
+    # same as usual.
+    lines = stepwise.iter_tabulate_stream(rows, header, **kwargs)
+    assert '\n'.join(lines) == stepwise.tabulate(rows, header, **kwargs)
+
+    # Once the sample is exhausted, the column widths are fixed.  Cells that 
+    # are too wide are truncated if possible, otherwise they overflow.
+    lines = stepwise.iter_tabulate_stream(
+            iter([*rows, [100, 'ccc', 'much too long to fit']]),
+            header,
+            min_widths=[2, 0, 0],
+            sample_size=2,
+            **kwargs,
+    )
+    assert list(lines) == [
+            ' #  Name  Message',
+            '─────────────────────────',
+            ' 1  a     short',
+            ' 2  bb    a little longer',
+            '100  ccc   much too long…',
+    ]
+
 @parametrize_from_file(
         schema=[
             cast(
@@ -97,6 +143,32 @@ def test_measure_cols(table, truncate, max_width, pad, expected, error):
         expected = expected['cols'], expected['table']
         assert mod._measure_cols(table, truncate, max_width, pad) == expected
 
+@pytest.mark.parametrize(
+        'widths, excess', [
+            ([], 3),
+            ([5], 0),
+            ([5], 2),
+            ([5], 7),
+            ([3, 5], 1),
+            ([3, 5], 3),
+            ([3, 5], 4),
+            ([5, 5], 1),
+            ([5, 5], 3),
+            ([4, 9, 9, 2], 12),
+            ([4, 9, 9, 2], 30),
+            ([10, 1, 7, 7, 3], 8),
+        ]
+)
+def test_shrink_widest(widths, excess):
+    # Compare to the naive algorithm: remove one character at a time from the 
+    # widest column.
+    expected = list(widths)
+    for _ in range(excess if widths else 0):
+        i = expected.index(max(expected))
+        expected[i] -= 1
+
+    assert mod._shrink_widest(widths, excess) == expected
+
 @parametrize_from_file(
         schema=[
             cast(
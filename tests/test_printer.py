@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
+import pytest, sys
 from stepwise.printer import *
 from stepwise import PrinterWarning
 from param_helpers import *
 
 class DummyPrinter(Printer):
-    pass
+
+    def __init__(self, preset=None):
+        # Never look up the system's default printer.
+        super().__init__(preset or 'dummy')
 
 @parametrize_from_file
 def test_truncate_lines(text_in, text_out, page_width, margin_width):
@@ -38,3 +42,227 @@ def test_add_margin(margin_width, pages_before, pages_after):
     printer.margin_width = int(margin_width)
 
     assert printer.add_margin(pages_before) == pages_after
+
+def test_write_pages(tmp_path):
+    printer = DummyPrinter()
+    pages = [['A'], ['B']]
+
+    printer.write_pages(pages, tmp_path / 'pages.ps')
+    assert (tmp_path / 'pages.ps').read_bytes().startswith(b'%!PS')
+
+    printer.write_pages(pages, tmp_path / 'pages.pdf')
+    assert (tmp_path / 'pages.pdf').read_bytes().startswith(b'%PDF')
+
+@pytest.fixture
+def mock_lpstat(tmp_path, monkeypatch):
+    import stepwise.printer as printer
+
+    class MockLpstat:
+        calls = 0
+        default = 'P1'
+        printers = ['P1', 'P2']
+
+    def query_printers():
+        MockLpstat.calls += 1
+        return {'default': MockLpstat.default, 'printers': MockLpstat.printers}
+
+    cups_conf = tmp_path / 'printers.conf'
+    cups_conf.write_text('')
+
+    monkeypatch.setattr(printer, '_query_printers', query_printers)
+    monkeypatch.setattr(printer, '_printer_cache', None)
+    monkeypatch.setattr(printer, '_get_printer_cache_path', lambda: tmp_path / 'cache' / 'printers.json')
+    monkeypatch.setattr(printer, '_CUPS_CONFIG_PATHS', [cups_conf])
+
+    MockLpstat.cups_conf = cups_conf
+    return MockLpstat
+
+def test_discover_printers(mock_lpstat, monkeypatch):
+    import stepwise.printer as printer
+
+    assert get_default_printer_name() == 'P1'
+    assert get_printer_names() == ['P1', 'P2']
+    assert mock_lpstat.calls == 1
+
+    # The cache should be shared between processes, via the file system.
+    monkeypatch.setattr(printer, '_printer_cache', None)
+    assert get_default_printer_name() == 'P1'
+    assert mock_lpstat.calls == 1
+
+    # The cache should expire after a while.
+    from types import SimpleNamespace
+    later = printer.time.time() + printer.PRINTER_CACHE_TTL
+    monkeypatch.setattr(printer, 'time', SimpleNamespace(time=lambda: later))
+    mock_lpstat.default = 'P2'
+    assert get_default_printer_name() == 'P2'
+    assert mock_lpstat.calls == 2
+
+    # The cache should expire if the CUPS configuration changes.
+    import os
+    os.utime(mock_lpstat.cups_conf, (0, 0))
+    mock_lpstat.default = 'P3'
+    assert get_default_printer_name() == 'P3'
+    assert mock_lpstat.calls == 3
+
+def test_printer_lazy_default(mock_lpstat):
+    printer = Printer()
+    assert mock_lpstat.calls == 0
+
+    assert printer.name == 'P1'
+    assert mock_lpstat.calls == 1
+
+    printer = Printer('P2')
+    assert printer.name == 'P2'
+    assert mock_lpstat.calls == 1
+
+@pytest.mark.parametrize(
+        'presets, renderer', [
+            ({}, 'builtin'),
+            ({'P1': {'renderer': 'paps'}}, 'paps'),
+            ({'P1': {'paps_flags': '--font X'}}, 'paps'),
+            ({'P1': {'paps_flags': '--font X', 'renderer': 'builtin'}}, 'builtin'),
+        ],
+)
+def test_print_pages(presets, renderer, monkeypatch):
+    import subprocess
+    calls = []
+
+    class MockPopen:
+        def __init__(self, cmd, **kwargs):
+            calls.append(('paps', cmd))
+
+        def communicate(self, input):
+            pass
+
+    monkeypatch.setattr(subprocess, 'run', lambda cmd, **kwargs: calls.append(('builtin', cmd)))
+    monkeypatch.setattr(subprocess, 'Popen', MockPopen)
+
+    printer = Printer('P1')
+    printer.presets = [presets]
+    printer.print_pages([['A']])
+
+    assert len(calls) == 1
+    assert calls[0][0] == renderer
+
+def test_print_pages_no_default(mock_lpstat, monkeypatch):
+    import subprocess
+    calls = []
+
+    mock_lpstat.default = None
+    monkeypatch.setattr(subprocess, 'run', lambda cmd, **kwargs: calls.append(cmd))
+
+    printer = Printer()
+    printer.presets = [{}]
+    printer.print_pages([['A']])
+
+    assert calls == [['lpr', '-o', 'sides=one-sided']]
+
+def test_output_pipeline(tmp_path, monkeypatch):
+    import stepwise.printer as printer_mod
+    from stepwise import Protocol, table
+
+    calls = []
+    iter_protocol_lines = printer_mod.iter_protocol_lines
+
+    def mock_iter_protocol_lines(*args, **kwargs):
+        calls.append(args)
+        return iter_protocol_lines(*args, **kwargs)
+
+    monkeypatch.setattr(printer_mod, 'iter_protocol_lines', mock_iter_protocol_lines)
+
+    class MockPrinterSink:
+        needs_pages = True
+
+        def write(self, layout):
+            self.pages = layout.pages
+            return "printed"
+
+    wide = 'x' * 100
+    p = Protocol(steps=["A", table([[wide]]), "B"])
+    printer = DummyPrinter('P1')
+    printer_sink = MockPrinterSink()
+
+    pipeline = OutputPipeline(p, printer, [
+        file_sink(tmp_path / 'p.txt'),
+        file_sink(tmp_path / 'p.pdf'),
+    ])
+    pipeline.add_sink(printer_sink)
+
+    assert pipeline.run() == [
+            f"Protocol saved to '{tmp_path / 'p.txt'}'",
+            f"Protocol saved to '{tmp_path / 'p.pdf'}'",
+            "printed",
+    ]
+
+    # The protocol should be formatted once for the text file, and once for 
+    # all the outputs that need pages.
+    assert len(calls) == 2
+
+    # The text file should get the whole protocol, but the pages should be 
+    # truncated to fit on the paper.
+    text = (tmp_path / 'p.txt').read_text()
+    assert text == '\n'.join(pipeline.layout.lines)
+    assert wide in text
+
+    assert (tmp_path / 'p.pdf').read_bytes().startswith(b'%PDF')
+    assert printer_sink.pages == pipeline.layout.pages
+    assert printer_sink.pages[0][-1].endswith('3. B')
+    assert not any(wide in line for line in printer_sink.pages[0])
+
+def test_output_pipeline_no_sinks(monkeypatch):
+    import stepwise.printer as printer_mod
+    from stepwise import Protocol
+
+    monkeypatch.setattr(printer_mod, 'iter_protocol_lines', None)
+
+    pipeline = OutputPipeline(Protocol(steps=["A"]), DummyPrinter())
+    assert pipeline.run() == []
+
+def test_go_help_printers(mock_lpstat, monkeypatch):
+    import stepwise.cli.go as go
+    from io import StringIO
+
+    monkeypatch.setattr(sys, 'argv', ['stepwise', 'go', '--help'])
+
+    app = go.Go()
+    app.usage_io = StringIO()
+
+    with pytest.raises(SystemExit):
+        app.main()
+
+    usage = app.usage_io.getvalue()
+    assert 'The printers recognized on your system are: P1 (default), P2' in usage
+    assert mock_lpstat.calls == 1
+
+@pytest.mark.parametrize(
+        'argv', [
+            ['-P'],
+            ['-P', '-p', 'P2'],
+            ['-F', '-p', 'P2', '--queue'],
+            ['-P', '--queue'],
+        ],
+)
+def test_go_no_lpstat(argv, tmp_path, mock_lpstat, monkeypatch):
+    import stepwise.cli.go as go
+    from stepwise import Protocol, ProtocolIO
+
+    io = ProtocolIO(Protocol(steps=["A"]))
+    queued = []
+
+    class MockQueueSink:
+        needs_pages = False
+
+        def write(self, layout):
+            queued.append(layout)
+            return "queued"
+
+    monkeypatch.setattr(go.ProtocolIO, 'from_stdin', lambda: io)
+    monkeypatch.setattr(go, 'QueueSink', MockQueueSink)
+    monkeypatch.setattr(sys, 'argv', ['stepwise', 'go', '-o', str(tmp_path / 'p.txt'), *argv])
+
+    # Neither rendering the usage text nor formatting the protocol (with no
+    # printer presets configured) should require looking up the printers.
+    go.Go().main()
+
+    assert mock_lpstat.calls == 0
+    assert not (tmp_path / 'cache').exists()
@@ -5,6 +5,7 @@ import subprocess as subp
 from pytest import raises
 from stepwise import Protocol, ProtocolIO, ParseError
 from stepwise import pl, ul, ol, dl, pre, table
+from stepwise.format.lists import List
 from functools import partial
 from param_helpers import *
 
@@ -817,6 +818,104 @@ Notes:
 
 [2] Footnote 2"""
 
+def test_protocol_format_cache():
+    import pickle
+
+    p = Protocol()
+    p.steps = ['Step 1', ul('a', 'b')]
+    p.footnotes = {1: 'Footnote 1'}
+
+    assert p.format_text(inf) == """\
+1. Step 1
+
+2. - a
+   - b
+
+Note:
+[1] Footnote 1"""
+
+    # Repeated calls return the cached text.
+    assert p.format_text(inf) is p.format_text(inf)
+
+    # Different widths are cached separately.
+    assert p.format_text(5) == """\
+1. Step
+   1
+
+2. - a
+   - b
+
+Note:
+[1] Footnote
+    1"""
+
+    # Modifying the protocol invalidates the cache, even if the modification 
+    # is made in-place to a nested formatter.
+    p.steps[1] += 'c'
+    p.steps.append('Step 3')
+    p.footnotes[1] = 'Footnote 2'
+    assert p.format_text(inf) == """\
+1. Step 1
+
+2. - a
+   - b
+   - c
+
+3. Step 3
+
+Note:
+[1] Footnote 2"""
+
+    p.steps[1].replace_text('c', 'd')
+    assert p.format_text(inf) == """\
+1. Step 1
+
+2. - a
+   - b
+   - d
+
+3. Step 3
+
+Note:
+[1] Footnote 2"""
+
+    # The cache isn't pickled.
+    assert '_format_cache' in p.__dict__
+    assert '_format_cache' in p.steps[1].__dict__
+    q = pickle.loads(pickle.dumps(p))
+    assert '_format_cache' not in q.__dict__
+    assert '_format_cache' not in q.steps[1].__dict__
+
+def test_protocol_iter_lines_uncached(monkeypatch):
+    p = Protocol()
+    p.commands = ['sw x']
+    p.steps = ['Step 1', ul('a', 'b')]
+    p.footnotes = {1: 'Footnote 1'}
+
+    formatters = []
+    format_protocol = Protocol._format_protocol
+
+    def spy(self):
+        formatters.append(format_protocol(self))
+        return formatters[-1]
+
+    monkeypatch.setattr(Protocol, '_format_protocol', spy)
+
+    assert '\n'.join(p.iter_lines(inf)) == p.format_text(inf)
+
+    # The lists that are made to render the protocol shouldn't keep a copy of 
+    # the rendered text, but the steps themselves should still be cached.
+    def iter_lists(x):
+        if isinstance(x, List):
+            yield x
+            for item in x:
+                yield from iter_lists(item)
+
+    lists = [x for f in formatters for x in iter_lists(f) if x is not p.steps[1]]
+    assert lists
+    assert not any('_format_cache' in x.__dict__ for x in lists)
+    assert '_format_cache' in p.steps[1].__dict__
+
 
 @parametrize_from_file
 def test_protocol_parse_empty(text):
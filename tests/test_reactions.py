@@ -206,6 +206,37 @@ def test_reactions_refresh_names():
             ),
     ), 'after'
 
+def test_reactions_refresh_planner():
+    rxn = Reaction()
+    rxn['a'].volume = '1 µL'
+    rxn['b'].volume = '2 µL'
+    rxn['c'].volume = '3 µL'
+
+    combos = [
+            {'a': '1', 'b': '1'},
+            {'a': '2', 'b': '1'},
+            {'a': '1', 'b': '2'},
+            {'a': '2', 'b': '2'},
+    ]
+
+    rxns = Reactions(rxn, combos)
+    mix = rxns.mix
+    planner = rxns.planner
+    misses = planner.misses
+
+    # Replanning with the same combos should reuse the memo:
+    rxns.refresh()
+
+    assert rxns.mix == mix
+    assert rxns.planner is planner
+    assert planner.misses == misses
+
+    # Changing the combos should start over with a new memo:
+    rxns.combos = combos[:2]
+
+    assert rxns.planner is not planner
+    assert rxns.mix != mix
+
 def test_reactions_refresh_reactions():
     rxn = Reaction()
     rxn['w'].volume = 'to 6 µL'
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import pytest
 from stepwise import Reaction, Extra, Combos
 from stepwise.reaction.mix import *
 from test_reaction import eval_reaction
@@ -105,6 +106,75 @@ def test_plan_mixes(reaction, combos, required_mixes, bias, expected):
     expected = parse_mix(expected)
     assert actual == expected
 
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('bias', [0, 1])
+def test_plan_mixes_pruning(seed, bias):
+    # Pruning should never change the result, so compare against scoring 
+    # every possible mix.
+    import random
+    rng = random.Random(seed)
+
+    rxn = Reaction()
+    keys = [f'r{i}' for i in range(5)]
+    for key in keys:
+        rxn.append_reagent(key)
+        if rng.random() < 0.3:
+            rxn[key].flags.add('careful')
+
+    num_variants = [rng.randint(1, 3) for k in keys]
+    combos = [
+            {k: str(rng.randrange(n)) for k, n in zip(keys, num_variants)}
+            for i in range(rng.randint(2, 8))
+    ]
+
+    memo = {}
+    components = init_components(rxn, [])
+    components = mix_matching_components(components, combos, memo)
+    careful_reagents = find_careful_reagents(rxn)
+    order_map = make_order_map(keys)
+    bits = ReagentBits(keys, combos, careful_reagents)
+    scores = []
+
+    for mix in iter_complete_mixes(components, combos, [], memo):
+        score = score_mix(mix, combos, bias, careful_reagents, order_map, memo)
+        assert score_bit_mix(bits.encode_component(mix), bias) == score
+        scores.append(score)
+
+    mix = plan_mixes(rxn, combos, bias=bias)
+    score = score_mix(mix, combos, bias, careful_reagents, order_map, memo)
+    assert score == min(scores)
+
+    components = [bits.encode_component(x) for x in components]
+    assert bound_pipetting_steps(components, bits, bias) <= \
+            score.num_pipetting_steps
+
+def test_mix_planner_memo():
+    rxn = Reaction()
+    for k in 'abcd':
+        rxn.append_reagent(k)
+
+    combos = parse_combos({
+            'a': '1 1 1 1 2 2 2 2',
+            'b': '1 1 2 2 1 1 2 2',
+            'c': '1 2 1 2 1 2 1 2',
+            'd': '1 1 1 1 1 1 1 1',
+    })
+    planner = MixPlanner(combos)
+
+    mix_1 = planner.plan_mixes(rxn, mixes=[AutoMix({'a', 'b'})])
+    hits, misses = planner.hits, planner.misses
+
+    # The automix shares the memo with the reaction as a whole.
+    assert hits > 0
+    assert misses > 0
+
+    # Replanning the same reaction shouldn't need to count anything new.
+    mix_2 = planner.plan_mixes(rxn, mixes=[AutoMix({'a', 'b'})])
+
+    assert mix_1 == mix_2
+    assert planner.misses == misses
+    assert planner.hits > hits
+
 @parametrize_from_file(schema=defaults(notable_reagents=[]))
 def test_set_mix_names(mixes, reaction, notable_reagents, expected):
     mix = eval_mix(mixes)
@@ -185,6 +255,50 @@ def test_count_pipetting_steps(mix, combos, expected):
     expected = eval(expected)
     assert count_pipetting_steps(mix, combos) == expected
 
+@parametrize_from_file
+def test_count_combos(reagents, combos, expected):
+    combos = parse_combos(combos)
+    expected = int(expected)
+    assert count_combos(reagents, combos) == expected
+    assert count_combos(reagents, combos, {}) == expected
+    assert count_combos(reagents, ComboMatrix(combos), {}) == expected
+
+def test_count_combos_many_reagents():
+    # Too many reagents to pack into a single 64-bit key without renumbering.
+    import random
+    rng = random.Random(0)
+
+    keys = [f'r{i}' for i in range(40)]
+    combos = [
+            {k: rng.randrange(10) for k in keys}
+            for i in range(500)
+    ]
+    combos += combos[:100]
+
+    expected = len({tuple(x.values()) for x in combos})
+    assert expected == 500
+    assert count_combos(keys, combos) == expected
+    assert count_combos(keys, ComboMatrix(combos), {}) == expected
+
+def test_mix_planner_matrix():
+    combos = [{'a': 1, 'b': 1}, {'a': 2, 'b': 1}]
+    planner = MixPlanner(combos)
+
+    rxn = Reaction()
+    rxn.append_reagent('a')
+    rxn.append_reagent('b')
+
+    # The matrix belongs to the planner, so it can't be shared with (or 
+    # mistaken for) the matrix of another planner with different combos.
+    assert planner.get_bits(rxn).matrix is planner.matrix
+    assert MixPlanner(combos).matrix is not planner.matrix
+
+    # Changing the combos afterwards doesn't affect the planner, which is why 
+    # planners must be replaced when their combos change.
+    combos[1]['b'] = 2
+    assert planner.matrix.count_distinct(['b']) == 1
+    assert MixPlanner(combos).matrix.count_distinct(['b']) == 2
+
 @parametrize_from_file
 def test_count_combos_by_reagent(mix, reagents, combos, expected):
     mix = parse_mix(mix)
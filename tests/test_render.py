@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import pytest, re, zlib
+from stepwise import UsageError
+from stepwise.render import *
+from stepwise.render import _str, _num
+
+@pytest.mark.parametrize(
+        'line, expected', [
+            ('', []),
+            ('   ', []),
+            ('a', [('text', 0, 3.6, 12, 'a')]),
+            ('  ab  c', [('text', 14.4, 3.6, 12, 'ab  c')]),
+            ('µ', [('text', 0, 3.6, 12, 'µ')]),
+            ('μ', [('text', 0, 3.6, 12, 'µ')]),
+            ('☃', [('text', 0, 3.6, 12, '?')]),
+            ('──', [('line', 0, 7.2, 14.4, 7.2)]),
+            ('│', [('line', 3.6, 14.4, 3.6, 0)]),
+            ('┌', [('line', 3.6, 7.2, 7.2, 7.2), ('line', 3.6, 7.2, 3.6, 0)]),
+            ('⁻', [('text', 1.44, 8.4, 7.2, '-')]),
+            ('…', [
+                ('dot', 0.7, 3.6, 1, 1),
+                ('dot', 3.1, 3.6, 1, 1),
+                ('dot', 5.5, 3.6, 1, 1),
+            ]),
+        ]
+)
+def test_layout_pages(line, expected):
+    # Make a paper size with room for exactly one 12pt line, so the
+    # coordinates are easy to work out.
+    layout = layout_pages(
+            [[line]],
+            paper=(612, 14.4),
+            top_margin=0,
+            bottom_margin=0,
+    )
+    assert layout.paper_size == (612, 14.4)
+    assert len(layout.pages) == 1
+
+    def round_op(op):
+        return tuple(round(x, 2) if isinstance(x, float) else x for x in op)
+
+    assert [round_op(x) for x in layout.pages[0]] == expected
+
+def test_layout_pages_overflow():
+    layout = layout_pages(
+            [['a'] * 5, ['b']],
+            paper=(612, 14.4 * 2),
+            top_margin=0,
+            bottom_margin=0,
+    )
+    assert len(layout.pages) == 4
+
+def test_layout_pages_lines_per_page():
+    layout = layout_pages([['a'] * 10], lines_per_page=100)
+    assert len(layout.pages) == 1
+
+def test_layout_pages_err():
+    with pytest.raises(UsageError, match="unknown paper size: 'foolscap'"):
+        layout_pages([['a']], paper='foolscap')
+
+def test_render_postscript():
+    ps = render_postscript([['A (1)'], ['B']], paper='a4').decode('ascii')
+
+    assert ps.startswith('%!PS-Adobe-3.0\n')
+    assert ps.endswith('%%EOF\n')
+    assert '%%Pages: 2\n' in ps
+    assert '%%BoundingBox: 0 0 595 842\n' in ps
+    assert re.findall(r'%%Page: \d+ \d+', ps) == ['%%Page: 1 1', '%%Page: 2 2']
+    assert r'(A \(1\)) ' in ps
+    assert ps.count('showpage') == 2
+
+def test_render_pdf():
+    pdf = render_pdf([['A (1)'], ['B']])
+
+    assert pdf.startswith(b'%PDF-1.4\n')
+    assert pdf.endswith(b'%%EOF\n')
+    assert b'/Count 2' in pdf
+
+    # Check that the cross-reference table points to each object.
+    xref = int(re.search(rb'startxref\n(\d+)\n', pdf).group(1))
+    assert pdf[xref:].startswith(b'xref\n')
+
+    offsets = re.findall(rb'(\d{10}) 00000 n ', pdf[xref:])
+    assert len(offsets) == 7
+
+    for i, offset in enumerate(offsets, 1):
+        assert pdf[int(offset):].startswith(b'%d 0 obj\n' % i)
+
+    # Check that the text made it into the content stream.
+    streams = re.findall(rb'stream\n(.*?)\nendstream', pdf, re.DOTALL)
+    content = b''.join(zlib.decompress(x) for x in streams)
+    assert rb'(A \(1\)) Tj' in content
+    assert rb'(B) Tj' in content
+
+@pytest.mark.parametrize(
+        'text, expected', [
+            ('', '()'),
+            ('abc', '(abc)'),
+            ('a(b)c', r'(a\(b\)c)'),
+            ('a\\b', r'(a\\b)'),
+            ('µ', r'(\265)'),
+        ]
+)
+def test_str(text, expected):
+    assert _str(text) == expected
+
+@pytest.mark.parametrize(
+        'x, expected', [
+            (0, '0'),
+            (1, '1'),
+            (1.5, '1.5'),
+            (1.25, '1.25'),
+            (1.256, '1.26'),
+            (612.0, '612'),
+        ]
+)
+def test_num(x, expected):
+    assert _num(x) == expected
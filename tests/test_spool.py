@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import pytest, os, stat
+from datetime import datetime
+from stepwise import Protocol, Printer, UsageError
+from stepwise.spool import PrintQueue
+
+class DummyPrinter(Printer):
+
+    def __init__(self, name):
+        self.preset = name
+
+@pytest.fixture
+def stub_lpr(tmp_path, monkeypatch):
+    """
+    Put a fake `lpr` executable on the `$PATH`.  Each call records its
+    arguments (one per line) in a log file, and exits with the status given in
+    `lpr.status` (if that file exists).
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+
+    lpr = bin_dir / 'lpr'
+    lpr.write_text(f'''\
+#!/usr/bin/env sh
+log={tmp_path}/logs/lpr.$$
+mkdir -p {tmp_path}/logs
+for arg in "$@"; do
+    case "$arg" in
+        *.ps) head -c 4 "$arg" >> "$log"; echo >> "$log";;
+        *) basename -- "$arg" >> "$log";;
+    esac
+done
+if [ -f {tmp_path}/lpr.status ]; then
+    echo "printer on fire" >&2
+    exit $(cat {tmp_path}/lpr.status)
+fi
+''')
+    lpr.chmod(lpr.stat().st_mode | stat.S_IEXEC)
+
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+
+    class StubLpr:
+
+        def set_status(self, status):
+            (tmp_path / 'lpr.status').write_text(str(status))
+
+        def calls(self):
+            logs = tmp_path / 'logs'
+            if not logs.exists():
+                return []
+
+            return [x.read_text().splitlines() for x in logs.iterdir()]
+
+    return StubLpr()
+
+@pytest.fixture
+def queue(tmp_path):
+    return PrintQueue(tmp_path / 'queue')
+
+def test_add_protocol(queue, tmp_path):
+    attachment = tmp_path / 'map.txt'
+    attachment.write_text('ATCG')
+
+    p = Protocol(steps=["A"])
+    p.attachments = [attachment]
+
+    job = queue.add_protocol(p, DummyPrinter('P1'))
+    attachment.unlink()
+
+    jobs = queue.find_jobs()
+    assert [x.id for x in jobs] == [job.id]
+
+    job = jobs[0]
+    assert job.printer == 'P1'
+    assert job.status == 'pending'
+    assert len(job.pages) == 1
+    assert '1. A' in job.pages[0][0]
+
+    # The attachment should be copied, in case it changes before printing.
+    assert [x.read_text() for x in job.attachment_paths] == ['ATCG']
+
+def test_flush(queue, stub_lpr, tmp_path):
+    attachment = tmp_path / 'map.txt'
+    attachment.write_text('ATCG')
+
+    p1 = Protocol(steps=["A"])
+    p2 = Protocol(steps=["B"])
+    p2.attachments = [attachment]
+    p3 = Protocol(steps=["C"])
+
+    queue.add_protocol(p1, DummyPrinter('P1'))
+    queue.add_protocol(p2, DummyPrinter('P1'))
+    queue.add_protocol(p3, DummyPrinter('P2'))
+
+    jobs = queue.flush(retry_delay=0)
+
+    assert [x.status for x in jobs] == ['printed'] * 3
+    assert [x.attempts for x in jobs] == [1] * 3
+    assert queue.find_jobs() == []
+
+    # Each printer should get just one job, with the attachments included.
+    calls = sorted(stub_lpr.calls())
+    opts = ['-o', 'sides=one-sided']
+    assert calls == [
+            ['-P', 'P1', *opts, '%!PS', '0-map.txt'],
+            ['-P', 'P2', *opts, '%!PS'],
+    ]
+
+def test_flush_retry(queue, stub_lpr):
+    stub_lpr.set_status(1)
+    queue.add_protocol(Protocol(steps=["A"]), DummyPrinter('P1'))
+
+    jobs = queue.flush(retries=2, retry_delay=0)
+
+    assert len(stub_lpr.calls()) == 3
+    assert [x.status for x in jobs] == ['failed']
+    assert [x.attempts for x in jobs] == [3]
+    assert [x.error for x in jobs] == ['printer on fire']
+
+    # Failed jobs stay in the queue, and keep track of previous attempts.
+    jobs = queue.find_jobs()
+    assert [x.status for x in jobs] == ['failed']
+    assert [x.attempts for x in jobs] == [3]
+
+def test_flush_concurrent(queue, stub_lpr):
+    from concurrent.futures import ThreadPoolExecutor
+
+    for step in "ABC":
+        queue.add_protocol(Protocol(steps=[step]), DummyPrinter('P1'))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: queue.flush(), range(4)))
+
+    # Each job should be printed by exactly one of the flushes.
+    assert sorted(len(x) for x in results) == [0, 0, 0, 3]
+    assert len(stub_lpr.calls()) == 1
+    assert queue.find_jobs() == []
+
+def test_add_pages_same_time(queue, monkeypatch):
+    import stepwise.spool
+
+    class FrozenDatetime:
+        @staticmethod
+        def now():
+            return datetime(2020, 1, 1)
+
+    monkeypatch.setattr(stepwise.spool, 'datetime', FrozenDatetime)
+
+    job_1 = queue.add_pages([["A"]], DummyPrinter('P1'))
+    job_2 = queue.add_pages([["B"]], DummyPrinter('P1'))
+
+    assert job_1.id != job_2.id
+    assert len(queue.find_jobs()) == 2
+
+def test_flush_negative_retries(queue, stub_lpr):
+    queue.add_protocol(Protocol(steps=["A"]), DummyPrinter('P1'))
+
+    with pytest.raises(UsageError, match='non-negative'):
+        queue.flush(retries=-1)
+
+    assert stub_lpr.calls() == []
+    assert [x.status for x in queue.find_jobs()] == ['pending']
+
+def test_clear(queue):
+    queue.add_protocol(Protocol(steps=["A"]), DummyPrinter('P1'))
+    queue.add_protocol(Protocol(steps=["B"]), DummyPrinter('P2'))
+
+    assert len(queue.clear()) == 2
+    assert queue.find_jobs() == []
+
+@pytest.mark.slow
+def test_cli(stub_lpr, tmp_path):
+    from stepwise.testing import check_command
+    from functools import partial
+
+    env = {'PATH': os.environ['PATH']}
+    check = partial(check_command, home=tmp_path, env=env)
+
+    check('sw print-queue', '^No protocols waiting to be printed.$')
+    check('sw step A | sw go -F --queue -p P1', "^Protocol queued for 'P1'")
+    check('sw step B | sw go -F --queue -p P1', "^Protocol queued for 'P1'")
+    check('sw print-queue', r'.*step\s+P1\s+1\s+0\s+pending\n.*step\s+P1\s+1\s+0\s+pending$')
+    check('sw print-queue flush', r'^printed: .*→ P1\nprinted: .*→ P1$')
+    check('sw print-queue', '^No protocols waiting to be printed.$')
+
+    assert len(stub_lpr.calls()) == 1
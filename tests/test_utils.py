@@ -2,6 +2,7 @@
 
 from param_helpers import *
 from stepwise import unanimous
+from stepwise.utils import CountingMemo, get_memo
 
 @parametrize_from_file(
         schema=[
@@ -14,4 +15,25 @@ def test_unanimous(items, kwargs, expected, error):
     with error:
         assert unanimous(items, **kwargs) == expected
 
+def test_counting_memo():
+    memo = CountingMemo()
+    f, g = object(), object()
 
+    memo_f = get_memo(memo, f)
+    memo_g = get_memo(memo, g)
+
+    assert isinstance(memo_f, CountingMemo)
+    assert get_memo(memo, f) is memo_f
+    assert memo_f is not memo_g
+
+    assert 'a' not in memo_f
+    memo_f['a'] = 1
+    assert 'a' in memo_f
+    assert 'a' in memo_f
+    assert 'a' not in memo_g
+
+    assert (memo_f.hits, memo_f.misses) == (2, 1)
+    assert (memo_g.hits, memo_g.misses) == (0, 1)
+
+    # The top-level memo isn't used to look up values directly.
+    assert (memo.hits, memo.misses) == (0, 0)